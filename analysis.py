@@ -0,0 +1,176 @@
+# Frame analysis for lapse.py
+#
+# A pipeline sink (see pipeline.py) that measures the brightness of each
+# frame as it's captured.  Statistics are taken on a strided view of the
+# frame (every 'step'th pixel in each direction), so a 1920x1080 frame is
+# reduced to ~240x135 samples without copying it first, and everything is
+# done in NumPy.  The results are used two ways:
+#  - ExposureControl nudges the camera's brightness control towards a
+#    target mean, on backends that have one
+#  - gainCurve() turns the per-frame means into smoothed per-frame gains
+#    that the renderer applies to remove flicker
+#
+# ChangeDetector uses the same kind of luma thumbnail to decide whether a
+# frame differs enough from the last one kept to be worth keeping.
+#
+# NumPy is optional; without it there is no analysis (numpy is None).
+
+import array
+import time
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Rec. 601 luma weights for R, G, B
+lumaWeights = (0.299, 0.587, 0.114)
+
+# Luma (0-255) of every 'step'th pixel of a frame, as a 2D float32 array.
+# RGB data is sampled in place; JPEG data has to be decoded and shrunk.
+def lumaThumbnail(data, size, format='RGB', step=8):
+	w, h = size
+	if format == 'JPEG':
+		import io
+		import pygame
+		# memoryview(): bytes() of a memoryview on Python 2 is its repr
+		image = pygame.image.load(io.BytesIO(memoryview(data).tobytes()),
+		  'frame.jpg')
+		w, h  = max(1, w // step), max(1, h // step)
+		data  = pygame.image.tostring(pygame.transform.scale(image, (w, h)), 'RGB')
+		step  = 1
+	pixels = numpy.frombuffer(data, numpy.uint8, w * h * 3).reshape(h, w, 3)
+	return pixels[::step, ::step].dot(numpy.array(lumaWeights, numpy.float32))
+
+# Brightness statistics of a frame, as a dict: mean and standard deviation
+# of luma (0-255), its 5th and 95th percentiles, and the fraction of
+# samples crushed to black ('low') or blown to white ('high').
+def lumaStats(data, size, format='RGB', step=8):
+	luma   = lumaThumbnail(data, size, format, step)
+	p5, p95 = numpy.percentile(luma, (5, 95))
+	return {
+	  'mean': round(float(luma.mean()), 2),
+	  'std' : round(float(luma.std()), 2),
+	  'p5'  : round(float(p5), 1),
+	  'p95' : round(float(p95), 1),
+	  'low' : round(float((luma <= 5).mean()), 4),
+	  'high': round(float((luma >= 250).mean()), 4) }
+
+# Per-frame gains that flatten brightness changes shorter than 'window'
+# frames: each frame's mean is pulled to the moving average of the means
+# around it.  'means' is a list of (index, mean); returns {index: gain}.
+def gainCurve(means, window=9, limits=(0.5, 2.0)):
+	if not means:
+		return {}
+	means   = sorted(means)
+	indexes = [i for i, m in means]
+	values  = numpy.array([max(m, 1.0) for i, m in means], numpy.float64)
+	half    = min(window // 2, len(values) - 1)
+	padded  = numpy.pad(values, half, 'edge')
+	kernel  = numpy.ones(2 * half + 1) / (2 * half + 1)
+	smooth  = numpy.convolve(padded, kernel, 'valid')
+	gains   = numpy.clip(smooth / values, limits[0], limits[1])
+	return dict(zip(indexes, [round(float(g), 4) for g in gains]))
+
+# ExposureControl steps the camera's brightness control by 'step' whenever
+# the measured mean is more than 'deadband' away from 'target'.  Small,
+# bounded steps keep it from oscillating at long intervals.
+
+class ExposureControl:
+
+	def __init__(self, camera, target=118.0, deadband=12.0, step=4):
+		self.camera   = camera
+		self.target   = target
+		self.deadband = deadband
+		self.step     = step
+		self.changes  = 0
+
+	def update(self, mean):
+		error = self.target - mean
+		if abs(error) <= self.deadband:
+			return
+		value = self.camera.getExposure()
+		if value is None:
+			return
+		self.camera.setExposure(value + (self.step if error > 0 else -self.step))
+		self.changes += 1
+
+# ChangeDetector decides which frames of a mostly static scene to keep.  A
+# frame is kept when the mean absolute luma difference between its
+# thumbnail and the last kept frame's is at least 'threshold' (0-255), or
+# when 'keyframeEvery' frames in a row have been skipped, so slow changes
+# still show up.  The first frame is always kept.
+
+class ChangeDetector:
+
+	def __init__(self, threshold=6.0, keyframeEvery=10, step=16):
+		self.threshold     = threshold
+		self.keyframeEvery = keyframeEvery
+		self.step          = step
+		self.reference     = None # Thumbnail of the last kept frame
+		self.sinceKept     = 0
+		self.kept          = 0
+		self.skipped       = 0
+		self.lastChange    = 0.0
+
+	def check(self, frame):
+		thumb = lumaThumbnail(frame.data, frame.size, frame.format, self.step)
+		if self.reference is not None and self.reference.shape == thumb.shape:
+			self.lastChange = float(numpy.abs(thumb - self.reference).mean())
+			keep = (self.lastChange >= self.threshold or
+			  (self.keyframeEvery and self.sinceKept + 1 >= self.keyframeEvery))
+		else:
+			keep = True
+		if keep:
+			self.reference = thumb
+			self.sinceKept = 0
+			self.kept     += 1
+		else:
+			self.sinceKept += 1
+			self.skipped   += 1
+		return keep
+
+# Analyzer is the pipeline sink.  onStats(index, stats) is called with each
+# frame's lumaStats() (e.g. to journal it); only the mean is kept, for
+# gains(), in a float array indexed by frame number (NaN where there's no
+# frame), so a long sequence costs 4 bytes a frame rather than a dict of
+# statistics.  'last' is the newest stats.
+
+class Analyzer:
+
+	def __init__(self, step=8, onStats=None, exposure=None):
+		self.step     = step
+		self.onStats  = onStats
+		self.exposure = exposure
+		self.means    = array.array('f')
+		self.last     = None
+		self.count    = 0
+		self.time     = 0.0
+
+	def consume(self, slot):
+		start = time.time()
+		if slot.format == 'JPEG':
+			stats = lumaStats(slot.view(), slot.size, 'JPEG', self.step)
+		else:
+			stats = lumaStats(slot.buf, slot.size, 'RGB', self.step)
+		self.time  += time.time() - start
+		self.count += 1
+		index = slot.info['index'] if slot.info else self.count
+		self.setMean(index, stats['mean'])
+		self.last = stats
+		if self.onStats:
+			self.onStats(index, stats)
+		if self.exposure:
+			self.exposure.update(stats['mean'])
+
+	def meanTime(self):
+		return self.time / self.count if self.count else 0.0
+
+	def setMean(self, index, mean):
+		if index > len(self.means):
+			self.means.extend([float('nan')] * (index - len(self.means)))
+		self.means[index - 1] = mean
+
+	def gains(self, window=9):
+		return gainCurve([(i + 1, m) for i, m in enumerate(self.means)
+		  if m == m], window) # NaN != NaN
@@ -0,0 +1,182 @@
+# HTTP/JSON control and status API for lapse.py
+#
+#   GET  /status          live status (see statusSnapshot() in lapse.py)
+#   GET  /settings        current settings and profiles
+#   PUT  /settings        change settings: {"Interval": 5000, ...}
+#   POST /start           start a sequence
+#   POST /stop            stop the running sequence
+#   POST /resume          resume the unfinished sequence, if any
+#   POST /discard         close off the unfinished sequence
+#   GET  /thumbnail.bmp   the newest frame's thumbnail
+#   GET  /metrics         timing histograms (see metrics.py)
+#
+# Status is never computed per request.  A StatusCache thread rebuilds the
+# snapshot a few times a second and keeps it already JSON-encoded with an
+# ETag, so a request costs one lookup and one write however many clients
+# poll, and a client sending If-None-Match gets a 304 until it changes.
+#
+# Requests are served on threads (BaseHTTPServer plus ThreadingMixIn; the
+# Python 2 this runs on has no asyncio).  There's no authentication, so
+# only expose it on a network you trust.
+
+import json
+import threading
+import time
+import zlib
+
+try:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+except ImportError:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+
+# Packed RGB pixels as a 24-bit BMP file, which any browser shows.
+def bmpImage(pixels, size):
+	w, h    = size
+	pad     = (4 - w * 3 % 4) % 4
+	rowSize = w * 3 + pad
+	bgr     = bytearray(pixels)
+	bgr[0::3], bgr[2::3] = bgr[2::3], bgr[0::3]
+	rows = [bytes(bgr[y * w * 3:(y + 1) * w * 3]) + b'\0' * pad
+	  for y in range(h - 1, -1, -1)] # Bottom row first
+	header = bytearray(54)
+	header[0:2] = b'BM'
+	for offset, value, n in ((2, 54 + rowSize * h, 4), (10, 54, 4), (14, 40, 4),
+	  (18, w, 4), (22, h, 4), (26, 1, 2), (28, 24, 2), (34, rowSize * h, 4)):
+		for i in range(n):
+			header[offset + i] = (value >> (8 * i)) & 0xff
+	return bytes(header) + b''.join(rows)
+
+# Encoded response body and its ETag.
+def entity(body):
+	return body, '"%08x"' % (zlib.crc32(body) & 0xffffffff)
+
+# StatusCache rebuilds the status snapshot every 'interval' seconds on its
+# own thread.  'build' returns the status dict; 'thumbnail' returns (index,
+# pixels, size) of the newest thumbnail or None, and is only encoded when
+# the index changes.
+
+class StatusCache:
+
+	def __init__(self, build, thumbnail=None, interval=0.5):
+		self.build      = build
+		self.thumbnail  = thumbnail
+		self.interval   = interval
+		self.lock       = threading.Lock()
+		self.status     = None
+		self.image      = None
+		self.imageIndex = None
+		self.builds     = 0
+		self.buildTime  = 0.0
+
+	def start(self):
+		self.update()
+		t = threading.Thread(target=self._run)
+		t.daemon = True
+		t.start()
+
+	def _run(self):
+		while True:
+			time.sleep(self.interval)
+			try:
+				self.update()
+			except Exception as e: # Keep serving the last good snapshot
+				print("Status snapshot failed: %s" % e)
+
+	def update(self):
+		start  = time.time()
+		status = entity(json.dumps(self.build(), sort_keys=True).encode('utf-8'))
+		thumb  = self.thumbnail() if self.thumbnail else None
+		image  = None
+		if thumb and thumb[0] != self.imageIndex:
+			image = entity(bmpImage(thumb[1], thumb[2]))
+		with self.lock:
+			self.status = status
+			if image:
+				self.image, self.imageIndex = image, thumb[0]
+		self.buildTime += time.time() - start
+		self.builds    += 1
+
+	# Rebuild now, e.g. after a command, so the next poll sees its effect.
+	def touch(self):
+		self.update()
+
+# Server holds the StatusCache and 'commands', a dict of (method, path) ->
+# function(body dict) returning (http status, dict), for its handlers.
+
+class Server(ThreadingMixIn, HTTPServer):
+	daemon_threads      = True
+	allow_reuse_address = True
+
+	def __init__(self, address, cache, commands):
+		HTTPServer.__init__(self, address, Handler)
+		self.cache    = cache
+		self.commands = commands
+
+class Handler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		cache = self.server.cache
+		if self.path == '/status':
+			self.sendEntity(cache.status, 'application/json')
+		elif self.path == '/thumbnail.bmp' and cache.image:
+			self.sendEntity(cache.image, 'image/bmp')
+		else:
+			self.dispatch('GET')
+
+	def do_POST(self):
+		self.dispatch('POST')
+
+	def do_PUT(self):
+		self.dispatch('PUT')
+
+	def dispatch(self, method):
+		fn = self.server.commands.get((method, self.path))
+		if fn is None:
+			return self.sendJson(404, {'error': 'not found'})
+		try:
+			length = int(self.headers.get('Content-Length') or 0)
+			body   = json.loads(self.rfile.read(length)) if length else {}
+		except ValueError:
+			return self.sendJson(400, {'error': 'body is not JSON'})
+		if not isinstance(body, dict):
+			return self.sendJson(400, {'error': 'body must be a JSON object'})
+		status, result = fn(body)
+		if method != 'GET':
+			self.server.cache.touch()
+		self.sendJson(status, result)
+
+	def sendEntity(self, entity, contentType):
+		body, etag = entity
+		if self.headers.get('If-None-Match') == etag:
+			self.send_response(304)
+			self.send_header('ETag', etag)
+			self.end_headers()
+			return
+		self.send_response(200)
+		self.send_header('Content-Type', contentType)
+		self.send_header('Content-Length', str(len(body)))
+		self.send_header('ETag', etag)
+		self.send_header('Cache-Control', 'no-cache')
+		self.end_headers()
+		self.wfile.write(body)
+
+	def sendJson(self, status, data):
+		body = json.dumps(data, sort_keys=True).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass # Pollers would flood the console
+
+# Start serving on (host, port) from a daemon thread; returns the server.
+def serve(cache, commands, host='', port=8080):
+	server = Server((host, port), cache, commands)
+	t = threading.Thread(target=server.serve_forever)
+	t.daemon = True
+	t.start()
+	return server
@@ -0,0 +1,71 @@
+# Icon atlas for lapse.py
+#
+# Loading a couple of dozen small PNGs from the SD card one at a time is a
+# noticeable part of startup on a Pi.  An atlas packs them all into one
+# PNG plus a text index of where each icon sits, so startup reads two
+# files and every Icon becomes a subsurface of the one converted image.
+#
+# Build it with "python lapse.py --build-atlas" after changing icons; a
+# stale or missing atlas is simply ignored and the PNGs are loaded
+# individually.
+
+import fnmatch
+import os
+
+def iconFiles(iconPath, exclude=()):
+	names = []
+	for file in sorted(os.listdir(iconPath)):
+		if fnmatch.fnmatch(file, '*.png'):
+			name = file.split('.')[0]
+			if name not in exclude:
+				names.append(name)
+	return names
+
+def indexPath(atlasPath):
+	return os.path.splitext(atlasPath)[0] + '.txt'
+
+# True if the atlas exists and is at least as new as every icon in it.
+def isCurrent(iconPath, atlasPath, exclude=()):
+	try:
+		built = min(os.path.getmtime(atlasPath),
+		  os.path.getmtime(indexPath(atlasPath)))
+	except OSError:
+		return False
+	for name in iconFiles(iconPath, exclude):
+		if os.path.getmtime(os.path.join(iconPath, name + '.png')) > built:
+			return False
+	return True
+
+# Pack the icons into rows no wider than 'width' pixels and write the atlas
+# image and its index.  Returns the number of icons packed.
+def build(iconPath, atlasPath, exclude=(), width=512):
+	import pygame
+	bitmaps = [(name, pygame.image.load(os.path.join(iconPath, name + '.png')))
+	  for name in iconFiles(iconPath, exclude)]
+	places = []
+	x = y = rowHeight = 0
+	for name, bitmap in bitmaps:
+		w, h = bitmap.get_size()
+		if x and x + w > width:
+			x, y, rowHeight = 0, y + rowHeight, 0
+		places.append((name, bitmap, x, y))
+		x += w
+		rowHeight = max(rowHeight, h)
+	sheet = pygame.Surface((width, max(1, y + rowHeight)), pygame.SRCALPHA, 32)
+	with open(indexPath(atlasPath), 'w') as index:
+		for name, bitmap, x, y in places:
+			sheet.blit(bitmap, (x, y))
+			index.write("%s %d %d %d %d\n" % ((name, x, y) + bitmap.get_size()))
+	pygame.image.save(sheet, atlasPath)
+	return len(places)
+
+# Returns (surface, {name: (x, y, w, h)}).  The surface is as loaded; the
+# caller converts it to the display format once the display is set up.
+def load(atlasPath):
+	import pygame
+	rects = {}
+	with open(indexPath(atlasPath)) as index:
+		for line in index:
+			name, x, y, w, h = line.split()
+			rects[name] = (int(x), int(y), int(w), int(h))
+	return pygame.image.load(atlasPath), rects
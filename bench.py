@@ -0,0 +1,399 @@
+#!/usr/bin/python
+# Benchmarks for lapse.py
+#
+# Each benchmark runs without a camera or display: frames come from the
+# fake capture backend, the UI runs on SDL's dummy video driver, and
+# renders go through a stub encoder that reads its input and reports
+# progress like avconv without encoding anything.
+#
+#   analysis  brightness analysis per frame
+#   metrics   cost of the timing instrumentation
+#   merge     burst merging per frame, averaged and fused
+#   capture   capture loop throughput and jitter at several intervals
+#   memory    resident memory over a long run of the frame path
+#   render    batch, chunked and deflickered render throughput
+#   ui        UI loop time and CPU per frame on screens 0, 1 and 2
+#   startup   time to interactive
+#
+# The ui and startup benchmarks run lapse.py itself in a child process
+# started in a scratch directory, so nothing it writes lands next to
+# lapse.py.  Results are printed as JSON along with the Python version and
+# machine they came from, so runs can be compared between versions.
+#
+# Usage: python bench.py [-o results.json] [benchmark ...]   (default: all)
+
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import analysis
+import burst
+import capture
+import encoder
+import metrics
+import pipeline
+import scheduler
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# A synthetic RGB frame of the given size, as the fake backend makes them.
+def syntheticFrame(size):
+	fake = capture.FakeCapture(resolution=size, fps=0)
+	fake._openDevice()
+	return capture.Frame(fake._grab(bytearray(size[0] * size[1] * 3)), size)
+
+# Time the analysis stage on full-size frames.  It keeps up with capture
+# if even the slowest frame is analyzed well within the shortest interval.
+def benchAnalysis(frames=100, size=(1920, 1080), interval=1.0):
+	if analysis.numpy is None:
+		return {'skipped': 'numpy not installed'}
+	slot = pipeline.Slot(size[0] * size[1] * 3)
+	slot.load(syntheticFrame(size), None)
+	analyzer = analysis.Analyzer()
+	times = []
+	for i in range(frames):
+		slot.info = {'index': i + 1}
+		start = time.time()
+		analyzer.consume(slot)
+		times.append(time.time() - start)
+	start = time.time()
+	analyzer.gains()
+	curveTime = time.time() - start
+	return {
+	  'frames'        : frames,
+	  'size'          : '%dx%d' % size,
+	  'meanMs'        : round(1000 * sum(times) / frames, 3),
+	  'maxMs'         : round(1000 * max(times), 3),
+	  'framesPerSec'  : round(frames / sum(times), 1),
+	  'gainCurveMs'   : round(1000 * curveTime, 3),
+	  'keepsUp'       : max(times) < interval / 2,
+	  'intervalSec'   : interval }
+
+# Cost of the timing instrumentation.  Each frame records about six
+# samples (capture, jitter, encode or write, sync, ui, ...); the share of
+# the default 3s interval that costs should be negligible.
+def benchMetrics(samples=100000, perFrame=6, interval=3.0):
+	perSample = metrics.measureOverhead(samples)
+	return {
+	  'samples'        : samples,
+	  'usPerSample'    : round(perSample * 1e6, 3),
+	  'usPerFrame'     : round(perSample * perFrame * 1e6, 3),
+	  'intervalPercent': round(100.0 * perSample * perFrame / interval, 6) }
+
+# Time merging bursts of full-size frames, each way.  A merge has to fit in
+# the interval along with the burst itself.
+def benchMerge(counts=(3, 5), repeats=5, size=(1920, 1080)):
+	if analysis.numpy is None:
+		return {'skipped': 'numpy not installed'}
+	fake = capture.FakeCapture(resolution=size, fps=0)
+	fake._openDevice()
+	results = {'size': '%dx%d' % size}
+	for mode in ('mean', 'fusion'):
+		for count in counts:
+			frames = [capture.Frame(fake._grab(bytearray(size[0] * size[1] * 3)),
+			  size) for i in range(count)]
+			merger = burst.Merger(mode)
+			times  = []
+			for i in range(repeats):
+				start = time.time()
+				merger.merge(frames)
+				times.append(time.time() - start)
+			results['%s%d' % (mode, count)] = {
+			  'meanMs': round(1000 * sum(times) / repeats, 1),
+			  'maxMs' : round(1000 * max(times), 1) }
+	return results
+
+# The capture loop of lapse.timeLapse() (scheduler, capture, pipeline
+# submit) at each interval, writing JPEGs to a scratch directory.
+def benchCapture(intervals=(0.05, 0.1, 0.25), frames=20, size=(1920, 1080)):
+	cam     = capture.openCapture('fake', 'fake', size)
+	work    = tempfile.mkdtemp(prefix='lapse-bench-')
+	results = {'size': '%dx%d' % size}
+	try:
+		for interval in intervals:
+			pipe  = pipeline.FramePipeline(size[0] * size[1] * 3)
+			sched = scheduler.IntervalScheduler(interval)
+			sched.start()
+			latencies = []
+			started   = time.time()
+			for i in range(frames):
+				sched.wait()
+				start = time.time()
+				frame = cam.capture()
+				latencies.append(time.time() - start)
+				pipe.submit(frame, os.path.join(work, "%07d.jpg" % (i + 1)),
+				  interval / 2)
+			pipe.close()
+			elapsed = time.time() - started
+			results['%gs' % interval] = {
+			  'frames'       : frames,
+			  'written'      : pipe.written,
+			  'dropped'      : pipe.dropped,
+			  'framesPerSec' : round(pipe.written / elapsed, 2),
+			  'jitterMeanMs' : round(sched.meanJitter() * 1000, 3),
+			  'jitterSdMs'   : round(sched.jitterStdDev() * 1000, 3),
+			  'jitterMaxMs'  : round(sched.jitterMax * 1000, 3),
+			  'overruns'     : sched.overruns,
+			  'captureMeanMs': round(1000 * sum(latencies) / frames, 3),
+			  'captureMaxMs' : round(1000 * max(latencies), 3) }
+	finally:
+		cam.close()
+		shutil.rmtree(work)
+	return results
+
+# Resident set size of this process in bytes (peak RSS where /proc isn't
+# available).
+def rss():
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (IOError, OSError):
+		import resource
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# The frame path of a sequence, as fast as it will go: capture from the
+# fake camera, the writer pipeline with the analysis sink, and the
+# viewfinder shrinking every frame.  Files are written over a few names so
+# the scratch directory stays small.  RSS is sampled every 'sample'
+# frames; once warmed up (the first tenth of the run) it should stay flat,
+# since every frame buffer comes from, and goes back to, a fixed pool.
+def benchMemory(frames=10000, size=(640, 480), sample=500):
+	import preview
+	cam  = capture.FakeCapture('fake', size, fps=1000)
+	cam.open()
+	work = tempfile.mkdtemp(prefix='lapse-bench-')
+	sinks = [analysis.Analyzer()] if analysis.numpy is not None else []
+	pipe  = pipeline.FramePipeline(size[0] * size[1] * 3, sinks=sinks)
+	view  = preview.Preview(cam, (0, 0, 176, 99), 0)
+	warm  = max(sample, frames // 10)
+	samples = []
+	try:
+		started = time.time()
+		for i in range(frames):
+			frame = cam.capture()
+			pipe.submit(frame, os.path.join(work, "%07d.jpg" % (i % 8)), 1.0)
+			view.update()
+			if (i + 1) % sample == 0:
+				samples.append((i + 1, rss()))
+		pipe.close()
+		elapsed = time.time() - started
+	finally:
+		cam.close()
+		shutil.rmtree(work)
+	steady = [r for n, r in samples if n >= warm] or [samples[-1][1]]
+	mb = lambda n: round(n / 1048576.0, 2)
+	return {
+	  'frames'      : frames,
+	  'size'        : '%dx%d' % size,
+	  'framesPerSec': round(frames / elapsed, 1),
+	  'frameMB'     : mb(size[0] * size[1] * 3),
+	  'rssWarmMB'   : mb(steady[0]),
+	  'rssEndMB'    : mb(steady[-1]),
+	  'rssMaxMB'    : mb(max(steady)),
+	  'growthMB'    : mb(steady[-1] - steady[0]),
+	  'rssMB'       : [mb(r) for n, r in samples],
+	  'poolBuffers' : cam.pool.allocated,
+	  'shared'      : pipe.submitted - pipe.copied,
+	  'copied'      : pipe.copied,
+	  'dropped'     : pipe.dropped }
+
+# The stub encoder reads all of its input, the %07d.jpg files or stdin,
+# prints avconv's "frame=" progress for files and writes a dummy output.
+stubEncoder = r'''
+import os, sys
+args = sys.argv[1:]
+n    = 0
+if args[args.index('-i') + 1] == '-':
+	while sys.stdin.read(1 << 16):
+		pass
+elif 'concat' not in args:
+	pattern = args[args.index('-i') + 1]
+	index   = int(args[args.index('-start_number') + 1])
+	count   = int(args[args.index('-frames:v') + 1]) if '-frames:v' in args else None
+	while (count is None or n < count) and os.path.exists(pattern % index):
+		with open(pattern % index, 'rb') as f:
+			f.read()
+		n     += 1
+		index += 1
+		sys.stderr.write('frame=%5d\r' % n)
+with open(args[-1], 'wb') as f:
+	f.write(b'stub')
+'''
+
+def writeStubEncoder(directory):
+	path = os.path.join(directory, 'stub-encoder')
+	with open(path, 'w') as f:
+		f.write('#!%s\n%s' % (sys.executable, stubEncoder))
+	os.chmod(path, 0o755)
+	return path
+
+# Render a scratch sequence of JPEGs through the stub encoder: in one batch,
+# in one chunk per core, and deflickered (decoded, scaled and piped in
+# Python).  Nothing is actually encoded, so this is the cost of everything
+# around the encoder.
+def benchRender(frames=120, size=(640, 480)):
+	import pygame
+	work = tempfile.mkdtemp(prefix='lapse-bench-')
+	try:
+		stub  = writeStubEncoder(work)
+		image = pygame.image.frombuffer(syntheticFrame(size).data, size, 'RGB')
+		for i in range(frames):
+			pygame.image.save(image, os.path.join(work, "%07d.jpg" % (i + 1)))
+		results = {'frames': frames, 'size': '%dx%d' % size,
+		  'workers': multiprocessing.cpu_count()}
+		runs = [
+		  ('batch',   lambda p: encoder.renderBatch(work, command=stub,
+		    progress=p)),
+		  ('chunked', lambda p: encoder.renderChunked(work, command=stub,
+		    progress=p, minChunk=10)) ]
+		if analysis.numpy is not None:
+			gains = dict((i + 1, 1.1) for i in range(frames))
+			runs.append(('deflicker', lambda p: encoder.renderDeflickered(work,
+			  gains, command=stub, progress=p)))
+		for name, run in runs:
+			progress = encoder.RenderProgress(frames)
+			start    = time.time()
+			status   = run(progress)
+			elapsed  = time.time() - start
+			results[name] = {
+			  'status'      : status,
+			  'framesPerSec': round(frames / elapsed, 1),
+			  'reported'    : progress.done() }
+	finally:
+		shutil.rmtree(work)
+	return results
+
+# Run "bench.py --drive 'mode'" (see drive()) in a scratch directory that
+# has the icons, and return the JSON it prints.
+def runLapse(mode, frames=0):
+	work = tempfile.mkdtemp(prefix='lapse-bench-')
+	try:
+		os.symlink(os.path.join(here, 'icons'), os.path.join(work, 'icons'))
+		for name in os.listdir(here):
+			if name.startswith('icons') and os.path.isfile(os.path.join(here, name)):
+				shutil.copy(os.path.join(here, name), work)
+		env = dict(os.environ, SDL_VIDEODRIVER='dummy')
+		out = subprocess.check_output([sys.executable,
+		  os.path.join(here, 'bench.py'), '--drive', mode, str(frames)],
+		  cwd=work, env=env)
+		return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+	finally:
+		shutil.rmtree(work)
+
+def runScript(path, g):
+	exec(compile(open(path).read(), path, 'exec'), g)
+
+# Child side of runLapse(): run lapse.py with the fake camera and no API,
+# with pygame.event.wait() replaced by a script.  Its first call means
+# startup is over.  After that each call is one loop iteration, 'frames'
+# per screen with nothing to repaint, then 'frames' repainting it all.
+# Loop times come from the 'ui' histogram, CPU time from os.times().
+def drive(mode, frames):
+	import api
+	import pygame
+	realOpen = capture.openCapture
+	capture.openCapture = lambda backend, device, resolution: realOpen('fake',
+	  device, resolution)
+	api.serve = lambda *args: None
+	G       = {'__name__': '__main__', '__file__': os.path.join(here, 'lapse.py')}
+	results = {}
+	script  = []
+	def wait():
+		if not script:
+			times = G['startupTimes']
+			results['timeToInteractiveMs'] = round(1000 * (times[-1][1] -
+			  times[0][1]), 1)
+			results['steps'] = dict((times[i][0], round(1000 * (times[i][1] -
+			  times[i - 1][1]), 1)) for i in range(1, len(times)))
+			if mode == 'startup':
+				raise SystemExit
+			G['maxFps'] = 0 # clock.tick() mustn't sleep
+			for screen in (0, 1, 2):
+				for full in (False, True):
+					script.append(('start', screen, full))
+					script.append(('mark', screen, full))
+					script.extend([('frame', screen, full)] * frames)
+					script.append(('end', screen, full))
+			script.append(('exit', None, None))
+		step, screen, full = script.pop(0)
+		key = 'screen%s%s' % (screen, 'Full' if full else 'Idle')
+		if step == 'start': # Switching screens isn't counted
+			G['screenMode'] = screen
+		elif step == 'mark':
+			metrics.histogram('ui').reset()
+			results[key] = os.times()
+		if step in ('mark', 'frame') and full:
+			G['screenModePrior'] = -1
+		if step == 'end':
+			cpu0, cpu1 = results[key], os.times()
+			ui = metrics.histogram('ui')
+			results[key] = {
+			  'loopMs'   : round(1000 * ui.mean(), 3),
+			  'loopP90Ms': round(1000 * ui.percentile(90), 3),
+			  'cpuMs'    : round(1000 * max(0.0, cpu1[0] + cpu1[1] - cpu0[0] -
+			    cpu0[1]) / max(1, ui.count), 3) }
+		elif step == 'exit':
+			raise SystemExit
+		return pygame.event.Event(pygame.USEREVENT + 1)
+	pygame.event.wait = wait
+	try:
+		runScript(os.path.join(here, 'lapse.py'), G)
+	except SystemExit:
+		pass
+	G['closeCamera']()
+	print(json.dumps(results, sort_keys=True))
+
+# os.times() counts in clock ticks, so this needs enough frames per screen.
+def benchUI(frames=200):
+	results = runLapse('ui', frames)
+	del results['steps'], results['timeToInteractiveMs'] # See benchStartup()
+	return results
+
+def benchStartup(runs=3):
+	results = [runLapse('startup') for i in range(runs)]
+	times   = sorted(r['timeToInteractiveMs'] for r in results)
+	return {
+	  'runs'               : runs,
+	  'timeToInteractiveMs': times[len(times) // 2],
+	  'minMs'              : times[0],
+	  'maxMs'              : times[-1],
+	  'steps'              : results[-1]['steps'] }
+
+benchmarks = {
+  'analysis': benchAnalysis,
+  'metrics' : benchMetrics,
+  'merge'   : benchMerge,
+  'capture' : benchCapture,
+  'memory'  : benchMemory,
+  'render'  : benchRender,
+  'ui'      : benchUI,
+  'startup' : benchStartup }
+
+def main(args):
+	if args[:1] == ['--drive']:
+		return drive(args[1], int(args[2]))
+	output = None
+	if args[:1] in (['-o'], ['--output']):
+		output, args = args[1], args[2:]
+	results = {'meta': {
+	  'python' : platform.python_version(),
+	  'machine': platform.machine(),
+	  'system' : platform.system(),
+	  'cpus'   : multiprocessing.cpu_count(),
+	  'time'   : time.time() }}
+	for name in args or sorted(benchmarks):
+		results[name] = benchmarks[name]()
+	text = json.dumps(results, indent=2, sort_keys=True)
+	print(text)
+	if output:
+		with open(output, 'w') as f:
+			f.write(text + '\n')
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,189 @@
+# Burst capture and frame merging for lapse.py
+#
+# In burst mode every tick of a sequence takes 'count' frames back to back
+# from the already-open cameras and merges them into the one frame that's
+# written as that tick's %07d.jpg:
+#  - 'mean'   : the frames are averaged, which cuts sensor noise by about
+#               sqrt(count) in dark scenes
+#  - 'fusion' : the frames are an exposure bracket (the brightness control
+#               is stepped by 'bracketStep' between them) and each pixel is
+#               a weighted average favouring the frames in which it's
+#               neither crushed nor blown.  This is single-scale exposure
+#               fusion, Mertens et al. without the pyramids: cheap enough
+#               for every frame, at the cost of soft halos at hard edges.
+#
+# Merging is vectorized in NumPy, into buffers allocated once for the
+# sequence (merged frames come from a capture.BufferPool, so the pipeline
+# shares rather than copies them), and runs on the capture thread, so the burst plus the merge
+# have to fit in the interval or the scheduler counts an overrun.  Each
+# merge's time goes in the 'merge' histogram (metrics.py) and in the
+# frame's journal record.  Backends without a brightness control
+# (getExposure() returns None) can't bracket; their bursts are averaged.
+#
+# NumPy is required (see analysis.numpy).
+
+import io
+import time
+
+import capture
+import metrics
+
+from analysis import lumaWeights, numpy
+
+# A frame's pixels as an (h, w, 3) uint8 array, without copying RGB data.
+# JPEGs (from fswebcam) are decoded first.
+def pixels(frame):
+	w, h = frame.size
+	data = frame.data
+	if frame.format == 'JPEG':
+		import pygame
+		image = pygame.image.load(io.BytesIO(bytes(data)), 'frame.jpg')
+		w, h  = image.get_size()
+		data  = pygame.image.tostring(image, 'RGB')
+	return numpy.frombuffer(data, numpy.uint8, w * h * 3).reshape(h, w, 3)
+
+# Merger merges bursts of same-sized frames with 'mode'.  The merged frame
+# is an RGB Frame over a pooled buffer, which is reused once the Frame has
+# been let go of.  'sigma' is the spread of the fusion weights around mid-grey (0-1).
+
+class Merger:
+
+	def __init__(self, mode='mean', sigma=0.2):
+		self.mode  = mode
+		self.sigma = sigma
+		self.shape = None
+		self.count = 0
+		self.time  = 0.0
+
+	def _allocate(self, shape):
+		h, w = shape[:2]
+		self.shape  = shape
+		self.pool   = capture.BufferPool(h * w * 3)
+		if self.mode == 'mean':
+			self.acc = numpy.zeros(shape, numpy.uint16) # Room for 257 frames
+		else:
+			# One plane per channel: long inner loops, unlike broadcasting
+			# a weight across the 3 bytes of each pixel
+			self.acc     = numpy.zeros((3, h, w), numpy.float32)
+			self.product = numpy.zeros((h, w), numpy.float32)
+			self.weights = numpy.zeros((h, w), numpy.float32)
+			self.weight  = numpy.zeros((h, w), numpy.float32)
+			self.luma    = numpy.zeros((h, w), numpy.uint16)
+			self.term    = numpy.zeros((h, w), numpy.uint16)
+			# Luma weights in 8.8 fixed point, and the weight of each luma value
+			self.coeffs  = [numpy.uint16(round(c * 256)) for c in lumaWeights]
+			levels       = numpy.arange(256, dtype=numpy.float32) / 255 - 0.5
+			self.table   = numpy.exp(levels * levels / (-2 * self.sigma ** 2)) + 1e-6
+
+	def merge(self, frames):
+		start  = time.time()
+		images = [pixels(f) for f in frames]
+		if images[0].shape != self.shape:
+			self._allocate(images[0].shape)
+		out    = self.pool.get()
+		result = numpy.frombuffer(out, numpy.uint8, len(out)).reshape(self.shape)
+		if self.mode == 'mean':
+			self._mean(images, result)
+		else:
+			self._fuse(images, result)
+		self.time  += time.time() - start
+		self.count += 1
+		first = frames[0]
+		return capture.Frame(out, (self.shape[1], self.shape[0]), 'RGB',
+		  first.seq, first.timestamp, first.latency, self.pool)
+
+	# Rounded mean of the frames, summed in uint16.
+	def _mean(self, images, result):
+		acc = self.acc
+		acc[...] = images[0]
+		for image in images[1:]:
+			numpy.add(acc, image, out=acc)
+		acc += len(images) // 2
+		numpy.floor_divide(acc, len(images), out=acc)
+		result[...] = acc
+
+	# Each frame weighted per pixel by how close its luma is to mid-grey,
+	# looked up in a table rather than computed.  The table's floor of 1e-6
+	# means a pixel blown in every frame still gets a value.
+	def _fuse(self, images, result):
+		acc, product, weights, w = self.acc, self.product, self.weights, self.weight
+		acc.fill(0)
+		weights.fill(0)
+		luma, term = self.luma, self.term
+		for image in images:
+			numpy.multiply(image[..., 0], self.coeffs[0], out=luma)
+			for c in (1, 2):
+				numpy.multiply(image[..., c], self.coeffs[c], out=term)
+				luma += term
+			luma >>= 8
+			self.table.take(luma, out=w)
+			weights += w
+			for c in range(3):
+				numpy.multiply(image[..., c], w, out=product)
+				acc[c] += product
+		acc /= weights
+		acc += 0.5
+		for c in range(3):
+			result[..., c] = acc[c]
+
+	def meanTime(self):
+		return self.time / self.count if self.count else 0.0
+
+# BurstCapture stands in for a capture.CameraGroup: capture() takes 'count'
+# frames from every camera of 'group' and returns one merged frame per
+# camera.  When bracketing, frame k is taken with the brightness control at
+# its usual value + (k - (count - 1) / 2) * bracketStep, after throwing
+# away 'settle' frames while the new value takes effect; the control is
+# put back after every burst.  'lastMerge' is the last burst's merge time,
+# and 'overBudget' counts bursts whose capture and merge together took
+# longer than 'budget' seconds (the interval).
+
+class BurstCapture:
+
+	def __init__(self, group, count=3, mode='mean', bracketStep=16, settle=1,
+	  budget=None):
+		self.group       = group
+		self.count       = count
+		self.bracketStep = bracketStep
+		self.settle      = settle
+		self.budget      = budget
+		self.bracket     = mode == 'fusion' and all(cam.getExposure() is not None
+		  for cam in group.cameras)
+		if mode == 'fusion' and not self.bracket:
+			print("No brightness control to bracket with; averaging bursts")
+		self.mergers     = [Merger('fusion' if self.bracket else 'mean')
+		  for cam in group.cameras]
+		self.lastMerge   = 0.0
+		self.mergeMax    = 0.0
+		self.overBudget  = 0
+
+	def capture(self):
+		started = time.time()
+		cams    = self.group.cameras
+		shots   = []
+		if self.bracket:
+			bases = [cam.getExposure() for cam in cams]
+		try:
+			for k in range(self.count):
+				if self.bracket:
+					offset = int(round((k - (self.count - 1) / 2.0) * self.bracketStep))
+					for cam, base in zip(cams, bases):
+						cam.setExposure(base + offset)
+					for n in range(self.settle):
+						self.group.capture()
+				shots.append(self.group.capture())
+		finally:
+			if self.bracket:
+				for cam, base in zip(cams, bases):
+					cam.setExposure(base)
+		start  = time.time()
+		merged = [m.merge([s[i] for s in shots]) for i, m in enumerate(self.mergers)]
+		self.lastMerge = time.time() - start
+		self.mergeMax  = max(self.mergeMax, self.lastMerge)
+		metrics.histogram('merge').record(self.lastMerge)
+		if self.budget and time.time() - started > self.budget:
+			self.overBudget += 1
+		return merged
+
+	def meanMerge(self):
+		return sum(m.time for m in self.mergers) / max(1, self.mergers[0].count)
@@ -0,0 +1,444 @@
+# Capture backends for lapse.py
+#
+# A capture backend owns the camera for the lifetime of the program (or of a
+# sequence).  Rather than forking fswebcam for every frame, which reopens
+# the device, renegotiates the format and throws away warm-up frames, the
+# streaming backends open the device once, keep it running on a grab thread
+# and hand back the most recent frame on demand.
+#
+# Three backends are provided:
+#  - 'v4l2'     : long-lived session through pygame.camera (Video4Linux2)
+#  - 'fswebcam' : the original one-process-per-frame fallback
+#  - 'fake'     : synthetic frames, for testing/benchmarking without a camera
+#
+# openCapture() picks one by name; 'auto' tries v4l2 and falls back to
+# fswebcam.
+#
+# The streaming backends grab into buffers from a BufferPool rather than
+# allocating ~6MB per 1080p frame.  A frame is shared, not copied, by
+# everything that uses it (the writer pipeline, analysis, the viewfinder),
+# and its buffer goes back to the pool once the last of them lets go of
+# the Frame, so after warming up a sequence allocates no frame memory.
+
+import collections
+import subprocess
+import threading
+import time
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+# Frame is one captured image.  'data' holds either packed 24-bit RGB
+# pixels (format 'RGB') or an already-encoded JPEG file (format 'JPEG'),
+# 'size' is (width, height), 'seq' is the backend's running frame counter,
+# 'timestamp' is when the frame was delivered and 'latency' is how long
+# the grab took, in seconds.  A frame whose 'data' came from 'pool' hands
+# it back when the Frame is garbage collected, so keep the Frame (not just
+# its data) for as long as the pixels are needed.
+
+class Frame:
+
+	def __init__(self, data, size, format='RGB', seq=0, timestamp=None,
+	  latency=0.0, pool=None):
+		self.data      = data
+		self.size      = size
+		self.format    = format
+		self.seq       = seq
+		self.timestamp = timestamp if timestamp is not None else time.time()
+		self.latency   = latency
+		self.pool      = pool
+
+	def __del__(self):
+		if self.pool is not None:
+			self.pool.put(self.data)
+
+# BufferPool recycles frame buffers ('nbytes' bytearrays).  get() takes a
+# free one or, if none is free, allocates another, which then stays in the
+# pool: the pool grows to the number of frames in use at once (the ring
+# depth plus a few) and no further.  'allocated' counts buffers made.
+
+class BufferPool:
+
+	def __init__(self, nbytes):
+		self.nbytes    = nbytes
+		self.free      = collections.deque() # append() and pop() are atomic
+		self.allocated = 0
+
+	def get(self):
+		try:
+			return self.free.pop()
+		except IndexError:
+			self.allocated += 1
+			return bytearray(self.nbytes)
+
+	def put(self, buf):
+		self.free.append(buf)
+
+# CaptureBackend is the common interface.  open() claims the device,
+# capture() returns a frame grabbed after the call was made, latest()
+# returns the most recent frame without waiting (or None), close()
+# releases the device.  Backends with an exposure/brightness control
+# return its value from getExposure(); the rest return None.
+# setOnDemand(True) lets a backend that grabs continuously grab only when
+# a frame is asked for instead, e.g. while nothing is being captured.
+
+class CaptureBackend(object):
+
+	name = 'none'
+
+	def __init__(self, device='/dev/video0', resolution=(1920, 1080)):
+		self.device     = device
+		self.resolution = resolution
+		self.isOpen     = False
+
+	def open(self):
+		self.isOpen = True
+
+	def close(self):
+		self.isOpen = False
+
+	def capture(self):
+		raise NotImplementedError
+
+	def latest(self):
+		return None
+
+	def getExposure(self):
+		return None
+
+	def setExposure(self, value):
+		pass
+
+	def setOnDemand(self, on):
+		pass
+
+# StreamingCapture runs _grab() in a loop on a background thread and keeps
+# only the newest frame.  capture() blocks until a frame delivered after
+# the call is available, so callers never get a stale image.
+# On demand, the thread grabs only when capture() or latest() has asked for
+# a frame since the last one: latest() still returns at once, with the
+# frame before, so a viewfinder polling at 5 fps gets 5 grabs a second
+# rather than the camera's full rate.
+# Subclasses implement _openDevice(), _grab(buf) and _closeDevice().
+# _grab() fills 'buf', a pooled bytearray of width * height * 3 bytes, and
+# returns it (or returns other data, and the buffer goes back unused).
+
+class StreamingCapture(CaptureBackend):
+
+	def __init__(self, device='/dev/video0', resolution=(1920, 1080)):
+		CaptureBackend.__init__(self, device, resolution)
+		self.cond     = threading.Condition()
+		self.frame    = None
+		self.seq      = 0
+		self.error    = None
+		self.running  = False
+		self.thread   = None
+		self.pool     = None
+		self.onDemand = False
+		self.wanted   = False # A frame has been asked for since the last grab
+
+	def open(self):
+		if self.isOpen: return
+		self._openDevice()
+		w, h = self.resolution
+		if self.pool is None or self.pool.nbytes != w * h * 3:
+			self.pool = BufferPool(w * h * 3)
+		self.running = True
+		self.isOpen  = True
+		self.thread  = threading.Thread(target=self._run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def close(self):
+		if not self.isOpen: return
+		self.running = False
+		with self.cond:
+			self.cond.notify_all()
+		self.thread.join()
+		self._closeDevice()
+		self.isOpen = False
+
+	def setOnDemand(self, on):
+		with self.cond:
+			self.onDemand = on
+			self.cond.notify_all()
+
+	def _run(self):
+		pool = self.pool
+		while self.running:
+			with self.cond:
+				while self.running and self.onDemand and not self.wanted:
+					self.cond.wait()
+				self.wanted = False
+			if not self.running:
+				break
+			start = time.time()
+			buf   = pool.get()
+			try:
+				data = self._grab(buf)
+			except Exception as e:
+				pool.put(buf)
+				with self.cond:
+					self.error  = e
+					self.wanted = True # Try again, asked for or not
+					self.cond.notify_all()
+				time.sleep(0.1)
+				continue
+			end = time.time()
+			if data is not buf:
+				pool.put(buf)
+			frame = Frame(data, self.resolution, 'RGB', self.seq + 1, end,
+			  end - start, pool if data is buf else None)
+			with self.cond:
+				self.seq  += 1
+				self.error = None
+				old, self.frame = self.frame, frame
+				self.cond.notify_all()
+			del old # Outside the lock: it may hand its buffer back
+
+	def capture(self, timeout=10.0):
+		if not self.isOpen: self.open()
+		requested = time.time()
+		deadline  = requested + timeout
+		with self.cond:
+			self.wanted = True
+			self.cond.notify_all()
+			# Only a frame delivered after the request is fresh enough
+			while self.frame is None or self.frame.timestamp < requested:
+				remaining = deadline - time.time()
+				if remaining <= 0 or not self.running:
+					raise IOError("No frame from %s: %s" %
+					  (self.device, self.error or 'timeout'))
+				self.cond.wait(remaining)
+			return self.frame
+
+	def latest(self):
+		with self.cond:
+			if self.onDemand and not self.wanted:
+				self.wanted = True
+				self.cond.notify_all()
+			return self.frame
+
+# V4L2Capture keeps a pygame.camera session streaming.  Each pooled buffer
+# gets a Surface made over it with pygame.image.frombuffer() (packed RGB,
+# no row padding), and the camera converts every grab straight into one of
+# those, so the pixels are never copied after leaving the driver.
+
+class V4L2Capture(StreamingCapture):
+
+	name = 'v4l2'
+
+	def _openDevice(self):
+		import pygame
+		import pygame.camera
+		pygame.camera.init()
+		self.pygame  = pygame
+		self.camera  = pygame.camera.Camera(self.device, self.resolution, 'RGB')
+		self.camera.start()
+		# The driver may not honour the requested size exactly
+		self.resolution = self.camera.get_size()
+		self.surfaces   = {} # id(buffer) -> Surface over it
+
+	def _grab(self, buf):
+		surface = self.surfaces.get(id(buf))
+		if surface is None:
+			surface = self.pygame.image.frombuffer(buf, self.resolution, 'RGB')
+			self.surfaces[id(buf)] = surface
+		image = self.camera.get_image(surface)
+		if image is not surface: # A camera module that won't fill ours
+			buf[:] = self.pygame.image.tostring(image, 'RGB')
+		return buf
+
+	def _closeDevice(self):
+		self.camera.stop()
+
+	# pygame.camera exposes the V4L2 brightness control
+	def getExposure(self):
+		return self.camera.get_controls()[2]
+
+	def setExposure(self, value):
+		self.camera.set_controls(brightness=int(value))
+
+# FswebcamCapture is the original behaviour: one fswebcam process per
+# frame, reading the JPEG back over a pipe rather than through a shell.
+
+class FswebcamCapture(CaptureBackend):
+
+	name = 'fswebcam'
+
+	def __init__(self, device='/dev/video0', resolution=(1920, 1080)):
+		CaptureBackend.__init__(self, device, resolution)
+		self.frame = None
+		self.seq   = 0
+
+	def capture(self):
+		start = time.time()
+		proc  = subprocess.Popen(["fswebcam", "-q", "-d", self.device,
+		  "-r", "%dx%d" % self.resolution, "--no-banner", "-"],
+		  stdout=subprocess.PIPE)
+		data, _ = proc.communicate()
+		if proc.returncode != 0 or not data:
+			raise IOError("fswebcam failed on %s" % self.device)
+		self.seq  += 1
+		end = time.time()
+		self.frame = Frame(data, self.resolution, 'JPEG', self.seq, end,
+		  end - start)
+		return self.frame
+
+	def latest(self):
+		return self.frame
+
+# FakeCapture produces a synthetic moving gradient at a fixed frame rate.
+# The pattern is built once at twice the frame width and each frame is a
+# slice of it at a moving offset, so frames are cheap to make and still
+# differ from each other.  'delay' simulates per-grab sensor latency.
+# Frames are written straight into the pooled buffer, doubling the filled
+# part with each copy, so a frame costs a dozen memmoves.
+
+class FakeCapture(StreamingCapture):
+
+	name = 'fake'
+
+	def __init__(self, device='fake', resolution=(1920, 1080), fps=30.0,
+	  delay=0.0):
+		StreamingCapture.__init__(self, device, resolution)
+		self.period = 1.0 / fps if fps else 0.0
+		self.delay  = delay
+
+	def _openDevice(self):
+		w, h = self.resolution
+		row  = bytearray(w * 2 * 3)
+		for x in range(w * 2):
+			row[x*3]     = (x * 255 // (w * 2)) & 0xff
+			row[x*3 + 1] = (x * 7) & 0xff
+			row[x*3 + 2] = 255 - row[x*3]
+		self.pattern = bytes(row)
+		self.rowLen  = w * 3
+		self.offset  = 0
+		self.next    = time.time()
+
+	def _grab(self, buf):
+		if self.period:
+			self.next += self.period
+			wait = self.next - time.time()
+			if wait > 0: time.sleep(wait)
+			else:        self.next = time.time()
+		if self.delay: time.sleep(self.delay)
+		w, h = self.resolution
+		self.offset = (self.offset + 3 * 8) % self.rowLen
+		view   = memoryview(buf)
+		filled = self.rowLen
+		view[:filled] = self.pattern[self.offset:self.offset + self.rowLen]
+		while filled < len(buf):
+			n = min(filled, len(buf) - filled)
+			view[filled:filled + n] = view[:n]
+			filled += n
+		return buf
+
+	def _closeDevice(self):
+		self.pattern = None
+
+# CameraGroup captures from several backends at once.  Each camera has
+# its own thread, so capture() asks all of them at the same moment and
+# returns their frames in camera order.  The spread of the frames'
+# timestamps is the group's skew; 'offsets' accumulates each camera's
+# timestamp relative to the first camera.
+
+class CameraGroup:
+
+	def __init__(self, cameras):
+		self.cameras  = cameras
+		self.results  = queue.Queue()
+		self.requests = []
+		self.threads  = []
+		self.ticks    = 0
+		self.skewSum  = 0.0
+		self.skewMax  = 0.0
+		self.offsets  = [0.0] * len(cameras)
+		if len(cameras) > 1:
+			for i, cam in enumerate(cameras):
+				q = queue.Queue()
+				t = threading.Thread(target=self._run, args=(i, cam, q))
+				t.daemon = True
+				t.start()
+				self.requests.append(q)
+				self.threads.append(t)
+
+	def _run(self, i, cam, requests):
+		while requests.get():
+			try:
+				self.results.put((i, cam.capture(), None))
+			except Exception as e:
+				self.results.put((i, None, e))
+
+	# One frame from every camera; raises IOError if any of them failed.
+	def capture(self):
+		if len(self.cameras) == 1:
+			return [self.cameras[0].capture()]
+		for q in self.requests:
+			q.put(True)
+		frames = [None] * len(self.cameras)
+		failed = None
+		for n in range(len(self.cameras)):
+			i, frame, e = self.results.get()
+			frames[i] = frame
+			if e is not None:
+				failed = "camera %d: %s" % (i, e)
+		if failed:
+			raise IOError(failed)
+		stamps = [f.timestamp for f in frames]
+		skew   = max(stamps) - min(stamps)
+		self.ticks   += 1
+		self.skewSum += skew
+		self.skewMax  = max(self.skewMax, skew)
+		for i, t in enumerate(stamps):
+			self.offsets[i] += t - stamps[0]
+		return frames
+
+	def meanSkew(self):
+		return self.skewSum / self.ticks if self.ticks else 0.0
+
+	def meanOffsets(self):
+		return [o / self.ticks if self.ticks else 0.0 for o in self.offsets]
+
+	def close(self):
+		for q in self.requests:
+			q.put(False)
+		for t in self.threads:
+			t.join()
+		self.requests = []
+		self.threads  = []
+
+backends = {
+  'v4l2'    : V4L2Capture,
+  'fswebcam': FswebcamCapture,
+  'fake'    : FakeCapture }
+
+# Create and open a backend by name.  'auto' prefers the persistent v4l2
+# session and falls back to spawning fswebcam if pygame.camera can't open
+# the device (missing module, unsupported format, busy device...).
+
+def openCapture(backend='auto', device='/dev/video0', resolution=(1920, 1080)):
+	if backend == 'auto':
+		try:
+			return openCapture('v4l2', device, resolution)
+		except Exception as e:
+			print("v4l2 capture unavailable (%s), using fswebcam" % e)
+			return openCapture('fswebcam', device, resolution)
+	cam = backends[backend](device, resolution)
+	cam.open()
+	return cam
+
+# Write a frame to 'path' as a JPEG.  Frames that are already JPEG are
+# written as-is; raw RGB frames are encoded with pygame.
+
+def saveFrame(frame, path):
+	if frame.format == 'JPEG':
+		with open(path, 'wb') as f:
+			f.write(frame.data)
+		return
+	import pygame
+	surface = pygame.image.frombuffer(frame.data, frame.size, 'RGB')
+	pygame.image.save(surface, path)
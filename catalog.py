@@ -0,0 +1,331 @@
+# Session catalog and batch post-processing for lapse.py
+#
+# Every sequence leaves a directory under timelapseRoot with its frames and
+# journal (journal.py).  The catalog is a small SQLite database,
+# catalog.db in timelapseRoot, with one row per session directory:
+#   sessions  dir, started, frames, bytes, finished, interval, images,
+#             fps, size, cameras, window, journalMtime, journalSize
+#   outputs   dir, output, key, bytes, mtime, seconds, made
+# Rows are kept up to date incrementally: lapse.py updates a session's row
+# when its sequence starts and ends, and scan() only re-reads journals
+# whose mtime or size changed since they were catalogued.
+#
+# Batch jobs re-render old sessions at another frame rate or size,
+# cropped, and/or deflickered from the brightness in their journals.  Jobs
+# run on a process pool, one encoder per job.  Before a job runs, its key
+# is worked out: a hash of its parameters and the name, size and mtime of
+# every input frame (plus the journal, for deflickering).  A job whose
+# output is still on the card, unchanged, and was made with the same key
+# is skipped; hashing stat() results rather than the frames' contents
+# keeps checking thousands of frames to a fraction of a second.
+#
+# Run "python catalog.py" for the commands:
+#   python catalog.py scan [root]
+#   python catalog.py list [root]
+#   python catalog.py render [--fps N] [--size WxH] [--crop X,Y,W,H]
+#     [--deflicker] [--workers N] [--root root] [session dir...]
+# 'render' runs over every catalogued session when none are named.
+
+import contextlib
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+
+import encoder
+import journal
+
+catalogName = 'catalog.db'
+
+schema = '''
+create table if not exists sessions (
+  dir          text primary key,
+  started      real,
+  frames       integer,
+  bytes        integer,
+  finished     integer,
+  interval     integer,
+  images       integer,
+  fps          integer,
+  size         text,
+  cameras      integer,
+  window       text,
+  journalMtime real,
+  journalSize  integer);
+create table if not exists outputs (
+  dir          text,
+  output       text,
+  key          text,
+  bytes        integer,
+  mtime        real,
+  seconds      real,
+  made         real,
+  primary key (dir, output));
+'''
+
+# The directories holding a session's frames: the session directory, or
+# its cam0, cam1... subdirectories when several cameras were captured.
+def frameDirs(sessionDir):
+	cams = sorted(d for d in os.listdir(sessionDir) if d.startswith('cam') and
+	  d[3:].isdigit() and os.path.isdir(os.path.join(sessionDir, d)))
+	if not cams:
+		return [sessionDir]
+	return [os.path.join(sessionDir, d) for d in cams]
+
+# Catalog opens the database for each operation, so one Catalog can be
+# used from any thread (SQLite connections can't be shared between them).
+
+class Catalog:
+
+	def __init__(self, root):
+		self.root = root
+		self.path = os.path.join(root, catalogName)
+		with self._connect() as db:
+			db.executescript(schema)
+
+	# A connection for one transaction: committed at the end of the with
+	# block (rolled back on an exception) and closed.
+	@contextlib.contextmanager
+	def _connect(self):
+		db = sqlite3.connect(self.path, timeout=10)
+		db.row_factory = sqlite3.Row
+		try:
+			with db:
+				yield db
+		finally:
+			db.close()
+
+	# Re-read 'sessionDir's journal into its row, unless 'force' is false
+	# and the journal hasn't changed since.  Returns True if it was read.
+	def update(self, sessionDir, force=False):
+		path = os.path.join(sessionDir, journal.journalName)
+		try:
+			st = os.stat(path)
+		except OSError:
+			return False
+		with self._connect() as db:
+			row = db.execute('select journalMtime, journalSize from sessions '
+			  'where dir = ?', (sessionDir,)).fetchone()
+			if (not force and row and row['journalMtime'] == st.st_mtime and
+			  row['journalSize'] == st.st_size):
+				return False
+			s = journal.read(sessionDir)
+			db.execute('insert or replace into sessions values '
+			  '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (sessionDir,
+			  s.started or st.st_mtime,
+			  len(s.frames), s.totalBytes(), int(s.finished()),
+			  s.settings.get('Interval'), s.settings.get('Images'),
+			  s.settings.get('Fps'), s.settings.get('Size'),
+			  len(frameDirs(sessionDir)), s.window, st.st_mtime, st.st_size))
+		return True
+
+	# Catalogue every session directory under the root, and forget ones
+	# that have been deleted.  Returns the number of journals read.
+	def scan(self):
+		try:
+			dirs = [os.path.join(self.root, d) for d in os.listdir(self.root)]
+		except OSError:
+			dirs = []
+		dirs = [d for d in dirs
+		  if os.path.isfile(os.path.join(d, journal.journalName))]
+		read = sum(1 for d in dirs if self.update(d))
+		with self._connect() as db:
+			for row in db.execute('select dir from sessions').fetchall():
+				if row['dir'] not in dirs:
+					db.execute('delete from sessions where dir = ?', (row['dir'],))
+					db.execute('delete from outputs where dir = ?', (row['dir'],))
+		return read
+
+	# Catalogued sessions, oldest first, as dicts.
+	def sessions(self):
+		with self._connect() as db:
+			return [dict(row) for row in
+			  db.execute('select * from sessions order by started')]
+
+	def output(self, sessionDir, output):
+		with self._connect() as db:
+			row = db.execute('select * from outputs where dir = ? and output = ?',
+			  (sessionDir, output)).fetchone()
+		return dict(row) if row else None
+
+	def recordOutput(self, sessionDir, output, key, seconds):
+		st = os.stat(os.path.join(sessionDir, output))
+		with self._connect() as db:
+			db.execute('insert or replace into outputs values (?, ?, ?, ?, ?, ?, ?)',
+			  (sessionDir, output, key, st.st_size, st.st_mtime, seconds,
+			  time.time()))
+
+	# True if 'job's output is on the card as it was made, from the same
+	# inputs and parameters.
+	def current(self, job):
+		row  = self.output(job.dir, job.output)
+		path = os.path.join(job.dir, job.output)
+		if not row or row['key'] != job.key() or not os.path.isfile(path):
+			return False
+		st = os.stat(path)
+		return row['bytes'] == st.st_size and row['mtime'] == st.st_mtime
+
+# Job renders the frames in 'photosDir' into 'output' (in photosDir) at
+# 'fps' and 'size', cropped first to 'crop' ((x, y, w, h) in pixels) and
+# deflickered with gains from the journal in 'sessionDir' if asked.  Jobs
+# are pickled over to the pool's processes, so they hold only plain values.
+
+class Job:
+
+	def __init__(self, photosDir, fps=12, size='1920x1080', crop=None,
+	  deflicker=False, sessionDir=None, command=None):
+		self.dir        = photosDir
+		self.sessionDir = sessionDir or photosDir
+		self.fps        = fps
+		self.size       = size
+		self.crop       = tuple(crop) if crop else None
+		self.deflicker  = deflicker
+		self.command    = command
+		self.output     = "timelapse-%sfps-%s%s%s.mp4" % (fps, size,
+		  "-crop%dx%d+%d+%d" % (self.crop[2], self.crop[3], self.crop[0],
+		  self.crop[1]) if self.crop else "", "-deflicker" if deflicker else "")
+		self.keyCache   = None
+
+	def describe(self):
+		return os.path.join(os.path.basename(self.sessionDir.rstrip('/')),
+		  os.path.relpath(os.path.join(self.dir, self.output), self.sessionDir))
+
+	# Hash of the parameters and the stat() of every input.
+	def key(self):
+		if self.keyCache is None:
+			h = hashlib.sha1(repr((self.fps, self.size, self.crop,
+			  self.deflicker)).encode('utf-8'))
+			paths = [os.path.join(self.dir, f) for f in sorted(os.listdir(self.dir))
+			  if len(f) == 11 and f.endswith('.jpg') and f[:7].isdigit()]
+			if self.deflicker:
+				paths.append(os.path.join(self.sessionDir, journal.journalName))
+			for path in paths:
+				st = os.stat(path)
+				h.update(("%s %d %r\n" % (os.path.basename(path), st.st_size,
+				  st.st_mtime)).encode('utf-8'))
+			self.keyCache = h.hexdigest()
+		return self.keyCache
+
+	# Render, returning the encoder's exit status (1 if there's nothing to
+	# render).
+	def run(self):
+		found = encoder.frameRange(self.dir)
+		if not found:
+			return 1
+		if self.deflicker:
+			import analysis
+			luma  = journal.read(self.sessionDir).luma
+			gains = analysis.gainCurve([(i, r['mean']) for i, r in luma.items()
+			  if os.path.exists(os.path.join(self.dir, "%07d.jpg" % i))])
+			if gains:
+				return encoder.renderDeflickered(self.dir, gains, self.fps,
+				  self.size, self.output, self.command, crop=self.crop)
+		return encoder.renderBatch(self.dir, self.fps, self.size, self.output,
+		  self.command, found[0], crop=self.crop)
+
+def report(line):
+	print(line)
+
+# Pool worker: (job, exit status, seconds taken).
+def runJob(job):
+	start = time.time()
+	try:
+		status = job.run()
+	except Exception as e:
+		print("%s failed: %s" % (job.describe(), e))
+		status = 1
+	return job, status, time.time() - start
+
+# Run 'jobs' on 'workers' processes (by default one per core), skipping
+# those whose output is current in 'catalog'.  Outputs that were made are
+# recorded in the catalog as they finish.  Returns (done, skipped,
+# failed) counts.
+def runJobs(catalog, jobs, workers=None, log=None):
+	log     = log or report
+	pending = []
+	skipped = 0
+	for job in jobs:
+		if catalog.current(job):
+			skipped += 1
+			log("%s is up to date" % job.describe())
+		else:
+			pending.append(job)
+	done = failed = 0
+	if pending:
+		pool = multiprocessing.Pool(min(workers or multiprocessing.cpu_count(),
+		  len(pending)))
+		try:
+			for job, status, seconds in pool.imap_unordered(runJob, pending):
+				if status == 0:
+					done += 1
+					catalog.recordOutput(job.dir, job.output, job.key(), seconds)
+				else:
+					failed += 1
+				log("[%d/%d] %s: %s in %.1fs" % (done + failed, len(pending),
+				  job.describe(), "done" if status == 0 else "failed", seconds))
+		finally:
+			pool.close()
+			pool.join()
+	return done, skipped, failed
+
+# One Job per frame directory of each session (deflickering only the first
+# camera's, as only its brightness is journaled).
+def jobsFor(sessionDirs, fps=12, size='1920x1080', crop=None, deflicker=False,
+  command=None):
+	jobs = []
+	for sessionDir in sessionDirs:
+		for i, d in enumerate(frameDirs(sessionDir)):
+			jobs.append(Job(d, fps, size, crop, deflicker and i == 0, sessionDir,
+			  command))
+	return jobs
+
+def main(args):
+	command = args[0] if args else None
+	if command in ('scan', 'list'):
+		catalog = Catalog(os.path.abspath(args[1] if len(args) > 1 else
+		  '/home/pi/timelapse'))
+		read    = catalog.scan()
+		if command == 'scan':
+			print("%d journal(s) read" % read)
+			return
+		for s in catalog.sessions():
+			print("%s: %s, %d frame(s), %d bytes, %sms, %s fps, %s" % (s['dir'],
+			  "finished" if s['finished'] else "unfinished", s['frames'],
+			  s['bytes'], s['interval'], s['fps'], s['size']))
+		return
+	if command != 'render':
+		print("usage: python catalog.py scan|list [root]\n"
+		  "       python catalog.py render [--fps N] [--size WxH] "
+		  "[--crop X,Y,W,H] [--deflicker]\n"
+		  "         [--workers N] [--root root] [session dir...]")
+		return
+	options = {'--fps': 12, '--size': '1920x1080', '--crop': None,
+	  '--workers': None, '--root': '/home/pi/timelapse'}
+	deflicker = False
+	sessions  = []
+	args      = args[1:]
+	while args:
+		arg = args.pop(0)
+		if arg == '--deflicker':
+			deflicker = True
+		elif arg in options:
+			options[arg] = args.pop(0)
+		else:
+			sessions.append(os.path.abspath(arg).rstrip('/'))
+	crop    = options['--crop']
+	crop    = [int(n) for n in crop.split(',')] if crop else None
+	workers = options['--workers']
+	catalog = Catalog(os.path.abspath(options['--root']))
+	catalog.scan()
+	if not sessions:
+		sessions = [s['dir'] for s in catalog.sessions()]
+	jobs = jobsFor(sessions, int(options['--fps']), options['--size'], crop,
+	  deflicker)
+	done, skipped, failed = runJobs(catalog, jobs,
+	  int(workers) if workers else None)
+	print("%d rendered, %d up to date, %d failed" % (done, skipped, failed))
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
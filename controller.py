@@ -0,0 +1,120 @@
+# Capture controller for lapse.py
+#
+# One CaptureController owns the state of the sequence, which used to be
+# spread across globals written from several threads:
+#
+#   idle ---start---> capturing ---stop---> stopping
+#    ^                    |                    |
+#    |                    +------> rendering <-+
+#    |                                 |
+#    +------------ idle or error <-----+
+#
+# 'error' is idle after a sequence that failed (card full, render failed,
+# an exception); the message stays up until the next start clears it.
+#
+# Commands are posted to a queue and carried out on the controller's own
+# thread, and the sequence runs on a thread of its own, so a button
+# callback or API request only ever waits for the queue.  Stopping sets
+# the 'stop' Event, which the scheduler waits on between frames (see
+# IntervalScheduler.wait()), so a stop is noticed at once rather than at
+# the next deadline.
+
+import threading
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+class CaptureController:
+
+	# 'sequence' is called with the start command's arguments on a new
+	# thread for every start; it captures and renders, calling
+	# setState('rendering') between.
+	def __init__(self, sequence):
+		self.sequence = sequence
+		self.lock     = threading.Lock()
+		self.state    = 'idle'
+		self.error    = ''    # Message for the status line
+		self.failed   = False # The sequence ends in 'error'
+		self.frame    = 0     # Frames captured so far
+		self.stop     = threading.Event()
+		self.worker   = None
+		self.commands = queue.Queue()
+		self.handlers = {'start': self._start, 'stop': self._stop}
+		t = threading.Thread(target=self._run)
+		t.daemon = True
+		t.start()
+
+	# Queue 'command': 'start', with any arguments for the sequence (see
+	# lapse.timeLapse()), or 'stop'.  Returns an Event that's set once it
+	# has been handled, for callers that want to report the outcome: its
+	# 'result' is then True if the command took effect (a start while a
+	# sequence is running, or a stop while none is, doesn't).
+	def post(self, command, *args):
+		done = threading.Event()
+		done.result = False
+		self.commands.put((command, args, done))
+		return done
+
+	def _run(self):
+		while True:
+			command, args, done = self.commands.get()
+			try:
+				done.result = self.handlers[command](*args)
+			except Exception as e:
+				print("Command %s failed: %s" % (command, e))
+			done.set()
+
+	def _start(self, *args):
+		with self.lock:
+			if self.busy():
+				return False
+			self.state  = 'capturing'
+			self.error  = ''
+			self.failed = False
+			self.frame  = 0
+			self.stop.clear()
+		self.worker = threading.Thread(target=self._sequence, args=args)
+		self.worker.start()
+		return True
+
+	def _stop(self):
+		with self.lock:
+			if self.state != 'capturing':
+				return False
+			self.state = 'stopping'
+			self.stop.set()
+		return True
+
+	def _sequence(self, *args):
+		try:
+			self.sequence(*args)
+		except Exception as e:
+			print("Sequence failed: %s" % e)
+			self.fail(str(e))
+		with self.lock:
+			self.state = 'error' if self.failed else 'idle'
+			self.frame = 0
+
+	def setState(self, state):
+		with self.lock:
+			self.state = state
+
+	# Show 'message' without changing state, e.g. a capture that failed but
+	# will be retried at the next deadline.
+	def report(self, message):
+		self.error = message
+
+	# Show 'message' and end the sequence in 'error'.
+	def fail(self, message):
+		with self.lock:
+			self.error  = message
+			self.failed = True
+
+	# A sequence is running, from start until it has finished rendering.
+	def busy(self):
+		return self.state in ('capturing', 'stopping', 'rendering')
+
+	def capturing(self):
+		return self.state in ('capturing', 'stopping')
@@ -0,0 +1,367 @@
+# Video encoding for lapse.py
+#
+# Two ways of turning a sequence into timelapse.mp4:
+#  - renderBatch() runs one encoder over the %07d.jpg files after the
+#    sequence, as lapse.py always did.  It's also how an existing sequence
+#    is re-encoded at another frame rate or resolution.
+#  - renderChunked() does the same with the frame range split into one
+#    chunk per core, each encoded by its own encoder process, then joins
+#    the segments with the concat demuxer without re-encoding.  A single
+#    encoder leaves most cores idle while it decodes JPEGs.
+#  - StreamingEncoder keeps one encoder process alive for the whole
+#    sequence and pipes each frame into its stdin as it's captured, so the
+#    video is finished a few seconds after the last frame instead of
+#    re-reading every JPEG from the card afterwards.
+#
+# The image2 demuxer the batch renderers read frames with stops at the
+# first missing number, so a range with gaps in it (a frame whose write
+# failed) is piped into the encoder as an MJPEG stream of the files that
+# are there instead, as StreamingEncoder does.
+#
+# The batch renderers take an optional RenderProgress, updated from the
+# "frame=" counts the encoders print, for an ETA on screen.
+#
+# avconv is used when installed (as on Raspbian), otherwise ffmpeg; both
+# take the same arguments here.
+
+import math
+import multiprocessing
+import os
+import re
+import subprocess
+import threading
+import time
+
+try:
+	from shutil import which
+except ImportError:
+	from distutils.spawn import find_executable as which
+
+def findEncoder(preferred='avconv'):
+	for name in (preferred, 'avconv', 'ffmpeg'):
+		if name and which(name):
+			return name
+	return preferred
+
+# RenderProgress counts the frames the encoders have finished.  Each
+# chunk reports its own count, so 'total' can be spread over any number of
+# encoders.  eta() is None until there is a rate to go by.
+
+class RenderProgress:
+
+	def __init__(self, total=0):
+		self.total   = total
+		self.counts  = {} # chunk -> frames done
+		self.started = time.time()
+		self.lock    = threading.Lock()
+
+	def update(self, chunk, frames):
+		with self.lock:
+			self.counts[chunk] = frames
+
+	def done(self):
+		with self.lock:
+			return sum(self.counts.values())
+
+	def eta(self):
+		done = self.done()
+		if not done or not self.total:
+			return None
+		rate = done / (time.time() - self.started)
+		return max(0.0, (self.total - done) / rate)
+
+frameCount = re.compile(br'frame=\s*(\d+)')
+
+# Run the encoder with 'args', feeding its frame counts to 'progress'
+# under 'chunk'.  stdin is closed so that parallel encoders don't fight
+# over the terminal, unless 'paths' are given: then those files are
+# written to it, one after another, from a thread.  Returns the exit
+# status.
+def runEncoder(args, progress=None, chunk=0, paths=None):
+	if paths is None:
+		with open(os.devnull, 'rb') as null:
+			proc = subprocess.Popen(args, stdin=null, stderr=subprocess.PIPE)
+	else:
+		proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+		  stderr=subprocess.PIPE)
+		feeder = threading.Thread(target=feedFiles, args=(proc.stdin, paths))
+		feeder.daemon = True
+		feeder.start()
+	tail = b''
+	while True:
+		data = os.read(proc.stderr.fileno(), 4096)
+		if not data:
+			break
+		tail = (tail + data)[-4096:]
+		counts = frameCount.findall(tail)
+		if progress and counts:
+			progress.update(chunk, int(counts[-1]))
+	status = proc.wait()
+	if paths is not None:
+		feeder.join()
+	if status != 0:
+		lines = tail.strip().splitlines()
+		print("Encoder failed: %s" % (lines[-1].decode('utf-8', 'replace')
+		  if lines else status))
+	return status
+
+# Write the files at 'paths' to 'pipe', then close it.  An encoder that
+# dies early just ends the feed; runEncoder() reports its status.
+def feedFiles(pipe, paths):
+	try:
+		for path in paths:
+			with open(path, 'rb') as f:
+				pipe.write(f.read())
+	except EnvironmentError:
+		pass
+	finally:
+		try:
+			pipe.close()
+		except EnvironmentError:
+			pass
+
+# The numbers of the %07d.jpg files in 'photosDir', in order.
+def frameNumbers(photosDir):
+	return sorted(int(f[:7]) for f in os.listdir(photosDir)
+	  if len(f) == 11 and f.endswith('.jpg') and f[:7].isdigit())
+
+# The numbers of the first and last %07d.jpg in 'photosDir', or None.
+def frameRange(photosDir):
+	numbers = frameNumbers(photosDir)
+	return (numbers[0], numbers[-1]) if numbers else None
+
+# Encoder arguments cropping the input to 'crop' ((x, y, w, h) in
+# pixels) before it's scaled, or none.
+def cropArgs(crop):
+	if not crop:
+		return []
+	x, y, w, h = crop
+	return ["-vf", "crop=%d:%d:%d:%d" % (w, h, x, y)]
+
+def imageArgs(command, photosDir, fps, start):
+	return [command, "-y", "-f", "image2", "-start_number", str(start),
+	  "-r", str(fps), "-i", os.path.join(photosDir, "%07d.jpg")]
+
+# Encoder input arguments for frames 'numbers' (in order) of 'photosDir',
+# and the paths to pipe in for them (None when the encoder reads them
+# itself).  An unbroken run is read by image2; one with gaps is piped.
+def inputArgs(command, photosDir, fps, numbers):
+	if numbers[-1] - numbers[0] + 1 == len(numbers):
+		return imageArgs(command, photosDir, fps, numbers[0]) + [
+		  "-frames:v", str(len(numbers))], None
+	return [command, "-y", "-f", "image2pipe", "-c:v", "mjpeg", "-r", str(fps),
+	  "-i", "-"], [os.path.join(photosDir, "%07d.jpg" % n) for n in numbers]
+
+# Re-encode the JPEG sequence in 'photosDir' into 'output' (relative to
+# photosDir), starting at frame number 'start', cropped to 'crop' if given.
+# Returns the encoder's exit status.
+
+def renderBatch(photosDir, fps=12, size='1920x1080', output='timelapse.mp4',
+  command=None, start=1, progress=None, crop=None):
+	numbers = [n for n in frameNumbers(photosDir) if n >= start]
+	if not numbers:
+		return 1
+	args, paths = inputArgs(command or findEncoder(), photosDir, fps, numbers)
+	return runEncoder(args + cropArgs(crop) + ["-s", size, "-pix_fmt", "yuv420p",
+	  os.path.join(photosDir, output)], progress, paths=paths)
+
+# Like renderBatch(), but frames 'start' to 'end' (by default the last one
+# in photosDir) are split into 'workers' chunks (by default one per core)
+# encoded in parallel, each single-threaded.  Every segment starts on a
+# keyframe, so joining them with "-c copy" loses nothing.  Sequences too
+# short to be worth splitting ('minChunk' frames per chunk) are rendered
+# by renderBatch().  Returns the first non-zero exit status, or 0.
+
+def renderChunked(photosDir, fps=12, size='1920x1080', output='timelapse.mp4',
+  command=None, start=1, end=None, workers=None, progress=None, minChunk=50):
+	command = command or findEncoder()
+	numbers = [n for n in frameNumbers(photosDir)
+	  if n >= start and (end is None or n <= end)]
+	frames  = len(numbers)
+	workers = min(workers or multiprocessing.cpu_count(), frames // minChunk)
+	if progress:
+		progress.total = frames
+	if workers < 2:
+		return renderBatch(photosDir, fps, size, output, command, start, progress)
+
+	base     = os.path.splitext(output)[0]
+	segments = [os.path.join(photosDir, "%s-part%02d.mp4" % (base, n))
+	  for n in range(workers)]
+	statuses = [None] * workers
+	def encode(n):
+		args, paths = inputArgs(command, photosDir, fps,
+		  numbers[frames * n // workers:frames * (n + 1) // workers])
+		statuses[n] = runEncoder(args + ["-s", size, "-pix_fmt", "yuv420p",
+		  "-threads", "1", segments[n]], progress, n, paths)
+	threads = [threading.Thread(target=encode, args=(n,))
+	  for n in range(workers)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+
+	listPath = os.path.join(photosDir, base + "-parts.txt")
+	try:
+		status = next((s for s in statuses if s != 0), 0)
+		if status == 0:
+			with open(listPath, 'w') as f: # Relative to the list's directory
+				for path in segments:
+					f.write("file '%s'\n" % os.path.basename(path))
+			status = runEncoder([command, "-y", "-f", "concat", "-i", listPath,
+			  "-c", "copy", os.path.join(photosDir, output)])
+	finally:
+		for path in segments + [listPath]:
+			if os.path.exists(path):
+				os.remove(path)
+	return status
+
+# Encode pygame Surfaces from the iterable 'images' into 'output', piping
+# them to the encoder as rawvideo.  Frames are scaled to the size of the
+# first one if they differ, and cropped to 'crop' if given.  Returns the
+# encoder's exit status.
+
+def renderSurfaces(images, output, fps=12, size='1920x1080', command=None,
+  progress=None, crop=None):
+	import pygame
+	proc = None
+	try:
+		for n, image in enumerate(images):
+			if proc is None:
+				frameSize = image.get_size()
+				proc = subprocess.Popen([command or findEncoder(), "-y",
+				  "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+				  "-s", "%dx%d" % frameSize, "-r", str(fps), "-i", "-"] +
+				  cropArgs(crop) + ["-s", size, "-pix_fmt", "yuv420p", output],
+				  stdin=subprocess.PIPE)
+			elif image.get_size() != frameSize:
+				image = pygame.transform.scale(image, frameSize)
+			proc.stdin.write(pygame.image.tostring(image, 'RGB'))
+			if progress:
+				progress.update(0, n + 1)
+	finally:
+		# Reaped even when the encoder died mid-write (a broken pipe)
+		if proc is not None:
+			try:
+				proc.stdin.close()
+			except EnvironmentError:
+				pass
+			status = proc.wait()
+	return status if proc is not None else 1
+
+# Like renderBatch(), but each frame's pixels are multiplied by its entry in
+# 'gains' ({index: gain}, see analysis.gainCurve()) on the way into the
+# encoder, which removes flicker between frames.  Frames are decoded,
+# scaled in NumPy and piped in as rawvideo; none are rewritten on the card.
+
+def renderDeflickered(photosDir, gains, fps=12, size='1920x1080',
+  output='timelapse.mp4', command=None, progress=None, crop=None):
+	import numpy
+	import pygame
+	if progress:
+		progress.total = len(gains)
+	def frames():
+		for index in sorted(gains):
+			path = os.path.join(photosDir, "%07d.jpg" % index)
+			if not os.path.exists(path):
+				continue # Deleted from a ring buffer
+			image  = pygame.image.load(path)
+			pixels = numpy.frombuffer(pygame.image.tostring(image, 'RGB'),
+			  numpy.uint8)
+			pixels = numpy.clip(pixels * numpy.float32(gains[index]), 0, 255)
+			yield pygame.image.frombuffer(pixels.astype(numpy.uint8).tobytes(),
+			  image.get_size(), 'RGB')
+	return renderSurfaces(frames(), os.path.join(photosDir, output), fps, size,
+	  command, progress, crop)
+
+# Tile the same-numbered frames of several cameras' directories into a
+# grid, 'columns' wide (by default as square as possible), and encode that
+# into 'output' in 'photosDir'.  The output keeps the grid's aspect ratio
+# at the width of 'size'.  The frames are those of the first camera that
+# every other camera has too, so a ring buffer's deleted frames and
+# failed writes are skipped.  Returns 1 if there are none.
+
+def renderComposite(photosDir, cameraDirs, fps=12, size='1920x1080',
+  output='composite.mp4', columns=None, command=None, progress=None):
+	import pygame
+	n       = len(cameraDirs)
+	columns = columns or int(math.ceil(math.sqrt(n)))
+	rows    = int(math.ceil(n / float(columns)))
+	numbers = [index for index in frameNumbers(cameraDirs[0])
+	  if all(os.path.exists(os.path.join(d, "%07d.jpg" % index))
+	  for d in cameraDirs[1:])]
+	if not numbers:
+		return 1
+	first   = pygame.image.load(os.path.join(cameraDirs[0],
+	  "%07d.jpg" % numbers[0]))
+	tw, th  = first.get_size()
+	width   = int(size.split('x')[0])
+	height  = int(width * th * rows / float(tw * columns)) // 2 * 2
+	def frames():
+		grid = pygame.Surface((tw * columns, th * rows))
+		for index in numbers:
+			paths = [os.path.join(d, "%07d.jpg" % index) for d in cameraDirs]
+			grid.fill(0)
+			for i, path in enumerate(paths):
+				tile = pygame.image.load(path)
+				if tile.get_size() != (tw, th):
+					tile = pygame.transform.scale(tile, (tw, th))
+				grid.blit(tile, ((i % columns) * tw, (i // columns) * th))
+			yield grid
+	if progress:
+		progress.total = len(numbers)
+	return renderSurfaces(frames(), os.path.join(photosDir, output), fps,
+	  "%dx%d" % (width, height), command, progress)
+
+# StreamingEncoder is a pipeline sink (see pipeline.py).  The encoder is
+# started on the first frame, once the frame format and size are known:
+# JPEGs from fswebcam go in as an image2pipe MJPEG stream, RGB frames from
+# the in-process backends as rawvideo.  If the encoder dies, 'failed' is
+# set and later frames are ignored; the caller can fall back to
+# renderBatch() from the files on the card.
+
+class StreamingEncoder:
+
+	def __init__(self, output, fps=12, size='1920x1080', command=None):
+		self.output  = output
+		self.fps     = fps
+		self.size    = size
+		self.command = command or findEncoder()
+		self.proc    = None
+		self.frames  = 0
+		self.failed  = False
+
+	def _start(self, slot):
+		if slot.format == 'JPEG':
+			source = ["-f", "image2pipe", "-c:v", "mjpeg"]
+		else:
+			source = ["-f", "rawvideo", "-pix_fmt", "rgb24",
+			  "-s", "%dx%d" % tuple(slot.size)]
+		self.proc = subprocess.Popen([self.command, "-y", "-loglevel", "error"] +
+		  source + ["-r", str(self.fps), "-i", "-",
+		  "-s", self.size, "-pix_fmt", "yuv420p", self.output],
+		  stdin=subprocess.PIPE)
+
+	def consume(self, slot):
+		if self.failed:
+			return
+		try:
+			if self.proc is None:
+				self._start(slot)
+			self.proc.stdin.write(slot.view())
+			self.frames += 1
+		except (IOError, OSError) as e:
+			print("Streaming encoder failed: %s" % e)
+			self.failed = True
+
+	# Close the encoder's input and wait for it to write out the file.
+	# Returns True if the video is complete.
+	def finish(self):
+		if self.proc is None:
+			return False
+		try:
+			self.proc.stdin.close()
+		except (IOError, OSError):
+			self.failed = True
+		if self.proc.wait() != 0:
+			self.failed = True
+		return not self.failed
@@ -0,0 +1,155 @@
+# Per-session capture journal for lapse.py
+#
+# Every session directory gets an append-only journal.jsonl, one JSON
+# record per line:
+#   {"type": "session", "settings": {...}, "started": t,
+#    "devices": [...], "window": w}                        settings used, and
+#                                                           the planned window
+#   {"type": "plan", "start": t, "interval": s, "first": n} deadlines are
+#                                                           start + k*interval
+#   {"type": "frame", "index": n, "time": t, "deadline": t,
+#    "bytes": b, "latency": s[, "camera": c]
+#    [, "merge": s]}                                        a frame on the card
+#   {"type": "luma", "index": n, "mean": m, ...}           brightness stats
+#   {"type": "end", "frames": n, "reason": r}              sequence finished
+#
+# Times are wall-clock (time.time()).  A session that was resumed has a
+# second plan record.  Each record is handed to the kernel as it's made, so
+# the process dying loses nothing, but fsyncs are batched: one per
+# 'batchSize' frame records or 'syncInterval' seconds, whichever comes
+# first, and one for every other record.  A power cut loses at most that
+# batch, and a torn final line is skipped when reading.  A journal without
+# an end record belongs to a sequence that never finished and can be
+# resumed.
+#
+# Run "python journal.py <session dir>..." to print each session's index
+# as rebuilt from its journal, without looking at the image files.
+
+import json
+import os
+import sys
+import threading
+import time
+
+journalName = 'journal.jsonl'
+
+class Journal:
+
+	def __init__(self, sessionDir, batchSize=16, syncInterval=5.0):
+		self.path         = os.path.join(sessionDir, journalName)
+		self.batchSize    = batchSize
+		self.syncInterval = syncInterval
+		self.lock         = threading.Lock()
+		self.unsynced     = 0
+		self.lastSync     = time.time()
+		self.file         = open(self.path, 'a')
+
+	def record(self, kind, **fields):
+		fields['type'] = kind
+		line = json.dumps(fields, sort_keys=True) + '\n'
+		with self.lock:
+			self.file.write(line)
+			self.file.flush()
+			self.unsynced += 1
+			if (self.unsynced >= self.batchSize or
+			  time.time() - self.lastSync >= self.syncInterval or
+			  kind != 'frame'):
+				self._sync()
+
+	def _sync(self):
+		os.fsync(self.file.fileno())
+		self.unsynced = 0
+		self.lastSync = time.time()
+
+	def sync(self):
+		with self.lock:
+			self._sync()
+
+	def close(self):
+		with self.lock:
+			self._sync()
+			self.file.close()
+
+# Session is a journal read back: the settings, plans and frame records,
+# and whether the sequence reached its end record.
+
+class Session:
+
+	def __init__(self, sessionDir):
+		self.dir      = sessionDir
+		self.settings = {}
+		self.started  = None
+		self.window   = None # Spec of the planned window it ran for
+		self.plans    = []
+		self.frames   = {} # index -> frame record (of the first camera)
+		self.others   = [] # Frame records of any further cameras
+		self.luma     = {} # index -> brightness record (analysis.lumaStats)
+		self.end      = None
+
+	def finished(self):
+		return self.end is not None
+
+	# Number of the next frame to capture when resuming.
+	def nextFrame(self):
+		return max(self.frames) + 1 if self.frames else 1
+
+	def totalBytes(self):
+		return sum(f.get('bytes', 0) for f in
+		  list(self.frames.values()) + self.others)
+
+	def meanLatency(self):
+		if not self.frames: return 0.0
+		return (sum(f.get('latency', 0.0) for f in self.frames.values()) /
+		  len(self.frames))
+
+def read(sessionDir):
+	session = Session(sessionDir)
+	with open(os.path.join(sessionDir, journalName)) as f:
+		for line in f:
+			try:
+				rec = json.loads(line)
+			except ValueError:
+				continue # Torn write at a crash
+			kind = rec.get('type')
+			if kind == 'session':
+				session.settings = rec.get('settings', {})
+				session.started  = rec.get('started')
+				session.window   = rec.get('window')
+			elif kind == 'plan':
+				session.plans.append(rec)
+			elif kind == 'frame' and rec.get('camera', 0):
+				session.others.append(rec)
+			elif kind == 'frame':
+				session.frames[rec['index']] = rec
+			elif kind == 'luma':
+				session.luma[rec['index']] = rec
+			elif kind == 'end':
+				session.end = rec
+	return session
+
+# The most recently active unfinished session under 'root', or None.
+def findUnfinished(root):
+	try:
+		dirs = [os.path.join(root, d) for d in os.listdir(root)]
+	except OSError:
+		return None
+	journals = [(os.path.getmtime(os.path.join(d, journalName)), d)
+	  for d in dirs if os.path.isfile(os.path.join(d, journalName))]
+	if not journals:
+		return None
+	session = read(max(journals)[1])
+	return None if session.finished() else session
+
+def main(args):
+	for sessionDir in args:
+		s = read(sessionDir)
+		print("%s: %s, %d frame(s) [%s], %d bytes, %.1fms mean latency" % (
+		  sessionDir, "finished" if s.finished() else "unfinished",
+		  len(s.frames), "%d-%d" % (min(s.frames), max(s.frames))
+		  if s.frames else "-", s.totalBytes(), s.meanLatency() * 1000))
+		for index in sorted(s.frames):
+			f = s.frames[index]
+			print("%07d.jpg %.3f %d" % (index, f['time'], f.get('bytes', 0)))
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
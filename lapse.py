@@ -12,30 +12,76 @@
 # based on cam.py by Phil Burgess / Paint Your Dragon for Adafruit Industries.
 # BSD license, all text above must be included in any redistribution.
 
-import cPickle
+import analysis
+import api
+import atexit
+import atlas
+import burst
+import capture
+import catalog
+import controller
+import encoder
 import fnmatch
+import journal
+import metrics
 import os
+import pipeline
+import planner
+import playback
+import preview
 import pygame
+import scheduler
+import settings
+import storage
+import subprocess
+import sys
 import threading
-from pygame.locals import FULLSCREEN, MOUSEBUTTONDOWN, MOUSEBUTTONUP
+import time
+from collections import OrderedDict
+from pygame.locals import FULLSCREEN, MOUSEBUTTONDOWN, MOUSEBUTTONUP, USEREVENT
 from time import sleep
 from datetime import datetime, timedelta
 
+startupTimes = [('imports', time.time())] # (step, time finished) for the report
+
 # UI classes ---------------------------------------------------------------
 
 # Icon is a very simple bitmap class, just associates a name and a pygame
 # image (PNG loaded from icons directory) for each.
-# There isn't a globally-declared fixed list of Icons.  Instead, the list
-# is populated at runtime from the contents of the 'icons' directory.
+# There isn't a globally-declared fixed list of Icons.  Instead, the icons
+# dict (name -> Icon) is populated at runtime from the contents of the
+# 'icons' directory.  The bitmap itself is only loaded the first time it's
+# drawn, and converted to the display's pixel format then so blits don't
+# convert on the fly.  If the icon atlas is current, the bitmap is a
+# subsurface of the atlas instead of a separate file.
 
-class Icon:
+class Icon(object):
 
 	def __init__(self, name):
-		self.name = name
-		try:
-			self.bitmap = pygame.image.load(iconPath + '/' + name + '.png')
-		except:
-			pass
+		self.name    = name
+		self._bitmap = None
+
+	@property
+	def bitmap(self):
+		if self._bitmap is None:
+			self._bitmap = loadIcon(self.name)
+		return self._bitmap
+
+iconSheet = None # (converted atlas surface, {name: rect}) once loaded
+
+def loadIcon(name):
+	global iconSheet
+	if iconSheet is None and useAtlas:
+		iconSheet = False
+		if atlas.isCurrent(iconPath, atlasPath, ('LapsePi_hi',)):
+			sheet, rects = atlas.load(atlasPath)
+			iconSheet = (sheet.convert_alpha(), rects)
+	if iconSheet and name in iconSheet[1]:
+		return iconSheet[0].subsurface(iconSheet[1][name])
+	bitmap = pygame.image.load(iconPath + '/' + name + '.png')
+	if bitmap.get_flags() & pygame.SRCALPHA:
+		return bitmap.convert_alpha()
+	return bitmap.convert()
 
 # Button is a simple tappable screen region.  Each has:
 #  - bounding rect ((X,Y,W,H) in pixels)
@@ -52,6 +98,8 @@ class Icon:
 # may take input precedence (e.g. the Effect labels & buttons).
 # After Icons are loaded at runtime, a pass is made through the global
 # buttons[] list to assign the Icon objects (from names) to each Button.
+# The centered blit position of each Icon is worked out on its first draw
+# (when the bitmap is loaded) rather than on every draw.
 
 class Button:
 
@@ -60,6 +108,8 @@ class Button:
 		self.color    = None # Background fill color, if any
 		self.iconBg   = None # Background Icon (atop color fill)
 		self.iconFg   = None # Foreground Icon (atop background)
+		self.bgPos    = None # Blit position of iconBg
+		self.fgPos    = None # Blit position of iconFg
 		self.bg       = None # Background Icon name
 		self.fg       = None # Foreground Icon name
 		self.callback = None # Callback function
@@ -71,41 +121,125 @@ class Button:
 			elif key == 'cb'   : self.callback = value
 			elif key == 'value': self.value    = value
 
+	def contains(self, pos):
+		return (self.rect[0] <= pos[0] < self.rect[0] + self.rect[2] and
+		        self.rect[1] <= pos[1] < self.rect[1] + self.rect[3])
+
+	def press(self):
+		if self.callback:
+			if self.value is None:
+				self.callback()
+			else:
+				self.callback(self.value)
+
 	def selected(self, pos):
-		x1 = self.rect[0]
-		y1 = self.rect[1]
-		x2 = x1 + self.rect[2] - 1
-		y2 = y1 + self.rect[3] - 1
-		if ((pos[0] >= x1) and (pos[0] <= x2) and
-		  (pos[1] >= y1) and (pos[1] <= y2)):
-			if self.callback:
-				if self.value is None:
-					self.callback()
-				else:
-					self.callback(self.value)
-					return True
-				return False
+		if self.contains(pos) and self.callback:
+			self.press()
+			return True
+		return False
 
 	def draw(self, screen):
 		if self.color:
 			screen.fill(self.color, self.rect)
 		if self.iconBg:
-			screen.blit(self.iconBg.bitmap,
-		  (self.rect[0]+(self.rect[2]-self.iconBg.bitmap.get_width())/2,
-		   self.rect[1]+(self.rect[3]-self.iconBg.bitmap.get_height())/2))
+			if self.bgPos is None: self.bgPos = self.center(self.iconBg)
+			screen.blit(self.iconBg.bitmap, self.bgPos)
 		if self.iconFg:
-			screen.blit(self.iconFg.bitmap,
-		  (self.rect[0]+(self.rect[2]-self.iconFg.bitmap.get_width())/2,
-		   self.rect[1]+(self.rect[3]-self.iconFg.bitmap.get_height())/2))
+			if self.fgPos is None: self.fgPos = self.center(self.iconFg)
+			screen.blit(self.iconFg.bitmap, self.fgPos)
+
+	def center(self, icon):
+		return (self.rect[0]+(self.rect[2]-icon.bitmap.get_width())/2,
+		        self.rect[1]+(self.rect[3]-icon.bitmap.get_height())/2)
 
 	def setBg(self, name):
-		if name is None:
-			self.iconBg = None
+		self.iconBg = icons.get(name) if name is not None else None
+		self.bgPos  = None
+		invalidateScreens()
+
+	def setFg(self, name):
+		self.iconFg = icons.get(name) if name is not None else None
+		self.fgPos  = None
+		invalidateScreens()
+
+# ButtonIndex maps a touch position to a Button without scanning the
+# screen's button list.  Each tappable Button is filed under every grid
+# cell its rect overlaps, in list order, so a lookup only checks the
+# (usually one) Button in the touched cell and the first/lowest Button
+# still takes precedence where Buttons overlap.
+
+class ButtonIndex:
+
+	def __init__(self, buttons, cell=20):
+		self.cell = cell
+		self.grid = {}
+		for b in buttons:
+			if not b.callback: continue
+			x, y, w, h = b.rect
+			for cx in range(x // cell, (x + w - 1) // cell + 1):
+				for cy in range(y // cell, (y + h - 1) // cell + 1):
+					self.grid.setdefault((cx, cy), []).append(b)
+
+	def find(self, pos):
+		for b in self.grid.get((pos[0] // self.cell, pos[1] // self.cell), ()):
+			if b.contains(pos): return b
+		return None
+
+# Fonts are created once per (face, size) and kept; SysFont() scans the
+# system font directories every time it's called.
+
+fonts = {}
+
+def getFont(face, size):
+	font = fonts.get((face, size))
+	if font is None:
+		font = fonts[(face, size)] = pygame.font.SysFont(face, size)
+	return font
+
+# Each screen mode's static content (background image plus its buttons) is
+# composited once into a display-format surface, so repainting part of the
+# screen is a single blit.  Changing a Button's icons discards the cache.
+
+screenSurfaces = {}
+
+def screenSurface(mode):
+	surface = screenSurfaces.get(mode)
+	if surface is None:
+		surface = pygame.Surface(screen.get_size()).convert()
+		drawBackground(surface)
+		for b in buttons[mode]:
+			b.draw(surface)
+		screenSurfaces[mode] = surface
+	return surface
+
+def invalidateScreens():
+	screenSurfaces.clear()
+
+# TextCache holds the most recently used rendered label surfaces, keyed by
+# (text, face, size, color), so static captions and unchanged values are
+# rasterized once.  The least recently used surface is evicted when the
+# cache is full.  'hits' and 'misses' count lookups.
+
+class TextCache:
+
+	def __init__(self, capacity=64):
+		self.capacity = capacity
+		self.surfaces = OrderedDict()
+		self.hits     = 0
+		self.misses   = 0
+
+	def render(self, text, face, size, color=(255,255,255)):
+		key     = (text, face, size, color)
+		surface = self.surfaces.pop(key, None)
+		if surface is None:
+			self.misses += 1
+			surface = getFont(face, size).render(text, 1, color)
+			if len(self.surfaces) >= self.capacity:
+				self.surfaces.popitem(last=False)
 		else:
-			for i in icons:
-				if name == i.name:
-					self.iconBg = i
-					break
+			self.hits += 1
+		self.surfaces[key] = surface # (Re)insert as most recently used
+		return surface
 
 def numericCallback(n): # Pass 1 (next setting) or -1 (prev setting)
 	global screenMode
@@ -118,8 +252,11 @@ def numericCallback(n): # Pass 1 (next setting) or -1 (prev setting)
 		screenMode = 1
 	elif n == 12:
 		screenMode = returnScreen
-		numeric = int(numberstring)
-		v[dict_idx] = numeric
+		try:
+			numeric = settings.check(dict_idx, numberstring)
+			v[dict_idx] = numeric
+		except ValueError as e: # Keep the old value
+			print("Rejected %s" % e)
 
 def settingCallback(n): # Pass 1 (next setting) or -1 (prev setting)
 	global screenMode
@@ -138,6 +275,9 @@ def valuesCallback(n): # Pass 1 (next setting) or -1 (prev setting)
 	if n == -1:
 		screenMode = 0
 		saveSettings()
+	elif n == 1: # Next profile; the current one keeps any edits
+		saveSettings()
+		v = profiles.select(profiles.nextName())
 	elif n == 2:
 		dict_idx='Interval'
 		numberstring = str(v[dict_idx])
@@ -148,6 +288,16 @@ def valuesCallback(n): # Pass 1 (next setting) or -1 (prev setting)
 		numberstring = str(v[dict_idx])
 		screenMode = 2
 		returnScreen = 1
+	elif n == 4:
+		dict_idx='Fps'
+		numberstring = str(v[dict_idx])
+		screenMode = 2
+		returnScreen = 1
+	elif n == 5: # Step through videoSizes
+		if v['Size'] in videoSizes:
+			v['Size'] = videoSizes[(videoSizes.index(v['Size']) + 1) % len(videoSizes)]
+		else:
+			v['Size'] = videoSizes[0]
 
 def viewCallback(n): # Viewfinder buttons
 	global screenMode, screenModePrior
@@ -161,91 +311,508 @@ def doneCallback(): # Exit settings
 	screenMode = 0 # Switch back to main window
 
 def startCallback(n): # start/Stop the timelapse thread
-	global t, busy, threadExited
-	global currentframe
+	# Both return at once; the controller's thread does the work
+	control.post('start' if n == 1 else 'stop')
+
+def resumeCallback(n): # Resume (1) or discard (0) the unfinished session
+	global screenMode, unfinished
 	if n == 1:
-		if busy == False:
-			if (threadExited == True):
-				# Re-instanciate the object for the next start
-				t = threading.Thread(target=timeLapse)
-				threadExited = False
-			t.start()
-	if n == 0:
-		if busy == True:
-			busy = False
-			t.join()
-			currentframe = 0
-			# Re-instanciate the object for the next time around.
-			t = threading.Thread(target=timeLapse)
+		# A planned window may have just started a sequence; the offer then
+		# stays up until it's over
+		done = control.post('start', unfinished)
+		done.wait()
+		if not done.result:
+			return
+	elif n == 0:
+		# Close it off so it isn't offered again
+		log = journal.Journal(unfinished.dir)
+		log.record('end', frames=len(unfinished.frames), reason='abandoned')
+		log.close()
+	unfinished = None
+	screenMode = 0
+
+def playbackCallback(n): # Open (4), step (-1/1), play (2), pause (3),
+	global screenMode, player       # scrub (5) or close (0) playback
+	if n == 4:
+		sessionDir = playback.findLatest(timelapseRoot)
+		if sessionDir:
+			# The file can still be torn between findLatest() and here; if
+			# so there's nothing to play
+			try:
+				player = playback.Player(playback.ThumbnailFile(sessionDir),
+				  playRect, stripRect, maxFps)
+			except playback.fileErrors as e:
+				print("Can't open thumbnails in %s: %s" % (sessionDir, e))
+		screenMode = 4
+	elif n == 0:
+		if player:
+			player.thumbs.close()
+			player = None
+		screenMode = 0
+	elif player is None:
+		return
+	elif n == 2:
+		player.play()
+	elif n == 3:
+		player.play(False)
+	elif n == 5:
+		player.scrub(pygame.mouse.get_pos()[0])
+	else:
+		player.play(False)
+		player.step(n)
+	pygame.time.set_timer(PLAYBACKEVENT,
+	  int(1000 / maxFps) if player and player.playing else 0)
+
+def overlayCallback(): # Tap along the top of screen 0
+	global debugOverlay, screenModePrior
+	debugOverlay    = not debugOverlay
+	screenModePrior = -1 # Repaint all of it, the viewfinder included
 
 def quitCallback(): # Quit confirmation button
+	closeCamera()
 	raise SystemExit
 
 def offCallback(): # Turn Off Rasp
+	closeCamera()
 	os.system("sudo halt")
 	raise SystemExit
 
-def render_video(photos_dir):
-	global rendering
-	rendering = True
-	os.system(
-		"avconv -f image2 -i " + photos_dir + "/" + "%07d.jpg -r 12 -s 1920x1080 " + photos_dir + "/" + "timelapse.mp4")
-	rendering = False
-
-def timeLapse():
+# Encode a finished sequence from its JPEGs, frames 'start' to 'end', on
+# renderWorkers encoders at once.  Also usable to re-render an old
+# sequence at another frame rate or size.
+# With 'gains' ({frame: gain}) the frames' brightness is evened out on
+# the way into the encoder.
+def render_video(photos_dir, fps=None, size=None, output="timelapse.mp4",
+  start=1, gains=None, end=None):
+	global renderProgress
+	renderProgress = encoder.RenderProgress()
+	try:
+		if gains:
+			status = encoder.renderDeflickered(photos_dir, gains,
+			  fps or v['Fps'], size or v['Size'], output,
+			  progress=renderProgress)
+		else:
+			status = encoder.renderChunked(photos_dir, fps or v['Fps'],
+			  size or v['Size'], output, start=start, end=end,
+			  workers=renderWorkers, progress=renderProgress)
+		if status != 0:
+			control.fail("Render failed")
+		elif renderProgress.total:
+			elapsed = time.time() - renderProgress.started
+			metrics.histogram('render').record(elapsed / renderProgress.total)
+			metrics.setGauge('renderFps', round(renderProgress.total / elapsed, 2))
+	except EnvironmentError as e: # No encoder installed, or it died
+		control.fail("Render failed: %s" % e)
+
+# Run a sequence, on the thread control (a controller.CaptureController)
+# starts for it.  With 'resume' (a journal.Session) the sequence carries
+# on in that session's directory, with its settings, at the frame after the
+# last one journaled.  With several captureDevices every camera fires on
+# the same deadlines and writes to its own camN subdirectory.  With
+# 'occurrence' (a planner.Occurrence) the sequence runs until the end of
+# that window instead of for v['Images'] frames, at its interval ramp.
+def timeLapse(resume=None, occurrence=None):
 	global v
-	global settling_time
-	global rendering
-	global busy, threadExited, r
-	global currentframe
-	global error
-
-	busy = True
-
-	photos_dir = os.path.join("/home/pi/timelapse/", datetime.now().strftime('%d-%m-%Y\ %H:%M'))
-	os.system("sudo mkdir " + photos_dir)
-
-	for frame in range( 1 , v['Images'] + 1 ):
-		if not busy:
+	global sched, pipe, pipes, analyzer, detector, group, thumbnails
+	global renderProgress, session, planned, plannedFrames
+
+	if resume:
+		photos_dir = resume.dir
+		v.update(resume.settings)
+		frame = resume.nextFrame() - 1
+	else:
+		photos_dir = os.path.join(timelapseRoot, datetime.now().strftime('%d-%m-%Y %H:%M'))
+		frame = 0
+	control.frame = frame
+	session       = photos_dir
+
+	cams = getCameras()
+	for cam in cams: # Grab continuously, so every capture gets a fresh frame
+		cam.setOnDemand(False)
+	if len(cams) == 1:
+		dirs = [photos_dir]
+	else:
+		dirs = [os.path.join(photos_dir, "cam%d" % i) for i in range(len(cams))]
+	for d in dirs:
+		if not os.path.isdir(d):
+			os.makedirs(d)
+
+	log = journal.Journal(photos_dir)
+	store.reset(ringFrames, int(ringGigabytes * (1 << 30)), len(cams))
+	if not resume:
+		log.record('session', settings=dict(v), started=time.time(),
+		  devices=list(captureDevices),
+		  window=occurrence.window.spec if occurrence else None)
+	catalogSession(photos_dir)
+
+	# Brightness of every frame, journaled and used for exposure/deflicker.
+	# Only the first camera is analyzed.
+	if analysisEnabled and analysis.numpy is not None:
+		def journalLuma(index, stats):
+			log.record('luma', index=index, **stats)
+		analyzer = analysis.Analyzer(onStats=journalLuma,
+		  exposure=analysis.ExposureControl(cams[0]) if autoExposure else None)
+		if resume:
+			for index, rec in resume.luma.items():
+				analyzer.setMean(index, rec['mean'])
+	else:
+		analyzer = None
+	# Each frame is journaled and accounted for once it's safely written.
+	# One that couldn't be written is reported and leaves a gap, which the
+	# renderers skip over.
+	def journalFrame(slot, nbytes):
+		log.record('frame', bytes=nbytes, **slot.info)
+		store.recordFrame(slot.path, nbytes, slot.info['index'])
+	def writeFailed(slot, error):
+		control.report("Write failed: %s" % error)
+	# Encoding and writing happen on the pipelines' writer threads (one
+	# pipeline per camera), so this thread only captures and copies each
+	# frame into a ring.
+	pipes      = []
+	videos     = []
+	thumbnails = None
+	for i, cam in enumerate(cams):
+		w, h = cam.resolution
+		sinks = []
+		if i == 0 and analyzer:
+			sinks.append(analyzer)
+		# Thumbnails for the playback screen; a ring buffer would outgrow
+		# its own frames, so it has none
+		if i == 0 and thumbnailsEnabled and not store.ringMode():
+			thumbnails = playback.ThumbnailWriter(dirs[0],
+			  onWrite=store.recordBytes)
+			sinks.append(thumbnails)
+		# Deflickering needs every frame's brightness first, so it renders after
+		if renderMode == 'stream' and not resume and not (deflicker and analyzer):
+			# Frames are also piped into a single encoder as they're captured
+			videos.append(encoder.StreamingEncoder(
+			  os.path.join(dirs[i], "timelapse.mp4"), v['Fps'], v['Size']))
+			sinks.append(videos[-1])
+		pipes.append(pipeline.FramePipeline(w * h * 3, ringSlots, writerThreads,
+		  sinks=sinks, onWrite=journalFrame, onError=writeFailed))
+	pipe  = pipes[0]
+	group = capture.CameraGroup(cams)
+	interval = v['Interval'] / 1000.0
+	# A burst of frames per tick, merged into one (see burst.py)
+	source = group
+	if burstFrames > 1 and analysis.numpy is not None:
+		source = burst.BurstCapture(group, burstFrames, burstMode, bracketStep,
+		  budget=interval)
+	# Frames fire at start + n*Interval regardless of how long each
+	# capture takes; see scheduler.py for the overrun policies.
+	sched = scheduler.IntervalScheduler(interval, overrunPolicy)
+	planStart = time.time()
+	monoStart = sched.t0
+	if occurrence:
+		planned       = occurrence
+		plannedFrames = frame + plan.frames(occurrence, interval, planStart)
+		log.record('plan', start=planStart, interval=interval, first=frame + 1,
+		  until=occurrence.stop, ramp=occurrence.window.ramp)
+	else:
+		log.record('plan', start=planStart, interval=interval, first=frame + 1)
+	if changeDetect and analysis.numpy is not None:
+		detector = analysis.ChangeDetector(changeThreshold, keyframeEvery)
+	else:
+		detector = None
+	failures = 0     # Captures failed in a row
+	writing  = False # A write failure is being reported
+	errors   = 0     # Write failures seen so far
+	# In ring-buffer mode the sequence runs until stopped
+	while (occurrence or imagesDone(frame) < v['Images'] or store.ringMode()):
+		if store.full(): # Cached statvfs(), cheap enough for every frame
+			control.fail("Card full")
 			break
-		currentframe = frame
-
-		filename = str(frame).zfill(7) + ".jpg"
-		os.system("fswebcam -d /dev/video0 -r 1920x1080 --no-banner " + photos_dir + "/" + filename)
-
-		sleep(settling_time)
-
-	print("Rendering")
-	r = threading.Thread(target=render_video)
-	r.join()
+		if occurrence:
+			sched.setInterval(plan.intervalAt(occurrence, time.time(), interval))
+		tick = sched.wait(control.stop)
+		if tick is None or (occurrence and time.time() >= occurrence.stop):
+			break
+		metrics.histogram('jitter').record(tick.jitter)
+		try:
+			started = time.time()
+			shots = source.capture()
+		except IOError as e:
+			failures += 1
+			if failures >= captureRetries:
+				control.fail("Camera failed: %s" % e)
+				break
+			control.report(str(e))
+			continue
+		finally:
+			latency = time.time() - started
+			metrics.histogram('capture').record(latency)
+			captureStats['count'] += 1
+			captureStats['total'] += latency
+			captureStats['max']    = max(captureStats['max'], latency)
+		if failures:
+			failures = 0
+			control.report('')
+		# A card that keeps failing writes ends the sequence; once writes
+		# work again the report is cleared
+		failing = max(p.errorsInRow for p in pipes)
+		if failing >= writeRetries:
+			control.fail("Write failed: %s" % next(p.lastError for p in pipes
+			  if p.errorsInRow == failing))
+			break
+		if writing and not failing:
+			control.report('')
+		writing = failing > 0 or sum(p.errors for p in pipes) != errors
+		errors  = sum(p.errors for p in pipes)
+
+		# Frames too similar to the last one kept are skipped (judged on
+		# the first camera, so the cameras stay in step)
+		if detector and not detector.check(shots[0]):
+			continue
+
+		# Dropped frames don't take a number, keeping the sequence
+		# contiguous.  A tick's frames go in for every camera or for none:
+		# a slot is reserved in each camera's pipeline before any frame is
+		# queued, so the cameras' journals and videos stay in step.
+		filename = str(frame + 1).zfill(7) + ".jpg"
+		deadline = time.time() + sched.interval / 2
+		slots    = []
+		for p in pipes:
+			slot = p.reserve(max(0.0, deadline - time.time()))
+			if slot is None:
+				break
+			slots.append(slot)
+		if len(slots) < len(pipes):
+			for p, slot in zip(pipes, slots):
+				p.unreserve(slot)
+			continue
+		for i, shot in enumerate(shots):
+			info = {'index': frame + 1, 'time': shot.timestamp,
+			  'deadline': planStart + tick.deadline - monoStart, 'latency': latency}
+			if len(shots) > 1:
+				info['camera'] = i
+			if source is not group:
+				info['merge'] = round(source.lastMerge, 4)
+			pipes[i].fill(slots[i], shot, os.path.join(dirs[i], filename), info)
+		frame += 1
+		control.frame = frame
+
+	control.setState('rendering')
+	for p in pipes:
+		p.close()
+	if thumbnails:
+		thumbnails.close()
+	group.close()
+	for cam in cams:
+		cam.setOnDemand(True)
+	if occurrence:
+		reason = 'window' if time.time() >= occurrence.stop else 'stopped'
+	else:
+		reason = 'complete' if imagesDone(frame) >= v['Images'] else 'stopped'
+	log.record('end', frames=frame, reason=reason)
+	log.close()
+	catalogSession(photos_dir)
+	planned = None
+	for i, p in enumerate(pipes):
+		if p.dropped:
+			print("Camera %d dropped %d frame(s), writers stalled %d time(s)" %
+			  (i, p.dropped, p.backpressure))
+	print("Jitter: mean %.1fms, sd %.1fms, max %.1fms, %d overrun(s)" % (
+	  sched.meanJitter() * 1000, sched.jitterStdDev() * 1000,
+	  sched.jitterMax * 1000, sched.overruns))
+	if captureStats['count']:
+		print("Capture latency: mean %.1fms, max %.1fms" % (
+		  captureStats['total'] * 1000 / captureStats['count'],
+		  captureStats['max'] * 1000))
+	if len(cams) > 1:
+		print("Camera skew: mean %.1fms, max %.1fms; offsets %s" % (
+		  group.meanSkew() * 1000, group.skewMax * 1000,
+		  ", ".join("%.1fms" % (o * 1000) for o in group.meanOffsets())))
+	if viewfinder:
+		print("Preview: %.1f fps, %.1fms per downscale" % (viewfinder.fps(),
+		  viewfinder.meanScaleTime() * 1000))
+	if source is not group:
+		print("Burst: %d frames, %.1fms per merge (max %.1fms), %d over the interval"
+		  % (burstFrames, source.meanMerge() * 1000, source.mergeMax * 1000,
+		  source.overBudget))
+	if analyzer:
+		print("Analysis: %.1fms per frame" % (analyzer.meanTime() * 1000))
+	if thumbnails:
+		print("Thumbnails: %.1fms per frame" % (thumbnails.meanTime() * 1000))
+	streamed = bool(videos)
+	if videos:
+		print("Finishing video")
+		renderProgress = None
+		for video in videos:
+			streamed = video.finish() and streamed
+	if frame and not streamed:
+		print("Rendering")
+		for i, d in enumerate(dirs):
+			# Older frames of a ring buffer are gone
+			found = encoder.frameRange(d)
+			if not found:
+				continue
+			gains = analyzer.gains() if i == 0 and deflicker and analyzer else None
+			render_video(d, start=found[0], gains=gains, end=frame)
+	if frame and len(dirs) > 1 and compositeRender:
+		print("Rendering composite")
+		renderProgress = encoder.RenderProgress()
+		try:
+			if encoder.renderComposite(photos_dir, dirs, v['Fps'], v['Size'],
+			  progress=renderProgress) != 0:
+				control.fail("Composite failed")
+		except Exception as e:
+			control.fail("Composite failed: %s" % e)
 
-	currentframe = 0
-	busy = False
-	threadExited = True
+	exportMetrics()
 
 # Global stuff -------------------------------------------------------------
 
-t = threading.Thread(target=timeLapse)
-r = threading.Thread(target=render_video)
-busy            = False
-threadExited    = False
-rendering		= False
+# Sequence state (idle, capturing, stopping, rendering, error), the frame
+# count and the status message; see controller.py.
+control         = controller.CaptureController(timeLapse)
 screenMode      =  0      # Current screen mode; default = viewfinder
 screenModePrior = -1      # Prior screen mode (for detecting changes)
 iconPath        = 'icons' # Subdirectory containing UI bitmaps (PNG format)
+useAtlas        = True    # Load icons from atlasPath when it's up to date
+atlasPath       = 'icons-atlas.png'
+startupLog      = 'startup.log' # Startup timing reports are appended here
 numeric         = 0       # number from numeric keypad
 numberstring	= "0"
 returnScreen   = 0
-currentframe   = 0
-settling_time  = 2.3
-interval_delay = 0.2
+overrunPolicy  = 'skip'  # 'skip' or 'catchup' missed deadlines
+sched          = None    # Scheduler of the running (or last) sequence
+pipe           = None    # Writer pipeline of the running (or last) sequence
+pipes          = []      # One per camera; pipe is the first
+ringSlots      = 4       # Frames that may wait for the writers
+writerThreads  = 1       # JPEG encode/write threads
+renderMode     = 'batch' # 'batch' renders after the sequence, 'stream' during
+renderWorkers  = 0       # Encoders for a batch render; 0 is one per core
+renderProgress = None    # encoder.RenderProgress of the render under way
+videoSizes     = settings.videoSizes # Choices for v['Size']
 dict_idx	   = "Interval"
-v = {
-	"Interval": 3000,
-	"Images": 150}
-error = ''
-
-icons = [] # This list gets populated at startup
+profiles       = settings.SettingsStore() # Named sets of v, see settings.py
+v = settings.defaults()
+
+# UI refresh: redraws are event driven and capped at maxFps; while nothing
+# is touched the screen is only re-checked statusPollHz times a second.
+maxFps         = 10
+statusPollHz   = 2
+idleCpuTarget  = 5.0  # Percent; measured CPU above this while idle is logged
+cpuReportSecs  = 60   # Measurement window for the CPU figure
+uiCpu          = 0.0  # Last measured process CPU, percent
+uiStats        = {'redraws': 0, 'full': 0, 'rects': 0}
+drawnLabels    = {}   # key -> ((size, text), rect, surface) now on screen
+textCache      = TextCache()
+cpuSample      = None
+
+# Timing histograms (metrics.py) are written to metricsPath every
+# metricsSecs and after each sequence, and served at /metrics.  Tapping
+# the top of screen 0 shows them over the viewfinder.
+metricsPath    = 'metrics.json'
+metricsSecs    = 60
+metricsWritten = time.time()
+debugOverlay   = False
+
+# Capture backend: 'auto' keeps one v4l2 session open and falls back to
+# spawning fswebcam per frame; 'fake' generates frames without a camera.
+captureBackend    = 'auto'
+captureDevices    = ['/dev/video0'] # Several devices are captured together
+captureResolution = (1920, 1080)
+cameras           = []   # Opened on first use, then kept streaming
+group             = None # capture.CameraGroup of the running sequence
+compositeRender   = False # Also render all cameras tiled into composite.mp4
+captureStats      = {'count': 0, 'total': 0.0, 'max': 0.0} # cam.capture() time
+captureRetries    = 5    # Failed captures in a row before the sequence fails
+writeRetries      = 5    # Failed writes in a row before the sequence fails
+timelapseRoot     = "/home/pi/timelapse/" # One directory per session in here
+unfinished        = None # journal.Session offered for resuming at startup
+
+# Headless (--headless, or when no display can be opened): no screen or
+# touch input, the rig is driven through the HTTP API (api.py) instead.
+# The API listens on apiHost:apiPort in either mode; '' is every interface.
+headless          = '--headless' in sys.argv
+apiEnabled        = True
+apiHost           = ''
+apiPort           = 8080
+statusCache       = None # api.StatusCache serving statusSnapshot()
+apiLock           = threading.Lock() # One API command at a time
+session           = None # Directory of the running (or last) sequence
+
+# Session catalog (catalog.py): an SQLite index of the sessions under
+# timelapseRoot, brought up to date at startup and as sequences start and
+# end, and served at /sessions.  "python catalog.py render" re-renders
+# old sessions from it.
+catalogEnabled    = True
+sessionCatalog    = None
+
+# Storage: free space is checked from a cached statvfs().  A non-zero
+# ringFrames and/or ringGigabytes keeps only that many of the newest frames
+# and runs the sequence until it's stopped.
+store             = storage.StorageManager(timelapseRoot)
+ringFrames        = 0
+ringGigabytes     = 0
+
+# Brightness analysis (needs NumPy): autoExposure steers the camera's
+# brightness control, deflicker evens out frame brightness when rendering.
+analysisEnabled   = True
+autoExposure      = False
+deflicker         = False
+analyzer          = None
+
+# Bursts (needs NumPy): with burstFrames above 1 each tick takes that many
+# frames back to back and merges them into one (see burst.py).  'mean'
+# averages them to cut noise; 'fusion' brackets the brightness control by
+# bracketStep per frame and fuses the exposures.
+burstFrames       = 1
+burstMode         = 'mean'
+bracketStep       = 16
+
+# Change detection (needs NumPy): only frames that differ from the last
+# kept one by changeThreshold (mean luma difference, 0-255) are kept, plus
+# one every keyframeEvery intervals.  Kept frames are numbered contiguously.
+# Skipped frames still count toward v['Images'], so the sequence takes
+# Images intervals however static the scene is.
+changeDetect      = False
+changeThreshold   = 6.0
+keyframeEvery     = 10
+detector          = None
+
+# Planned sequences (see planner.py): each entry of planWindows is a
+# planner.Window, and a sequence is started for every occurrence of one
+# and stopped at its end, e.g. every evening around sunset, faster near it:
+#   planWindows = [planner.Window('sunset-60', 'sunset+45', ramp=(2000, 20))]
+# latitude and longitude (degrees, north and east positive) place the sun.
+# Between windows the rig idles: once screen 0 has gone untouched for
+# idleAfterSecs the cameras are closed, the viewfinder stops and the
+# screen is re-checked every idlePollSecs, until a tap or wakeLeadSecs
+# before the next window.
+planWindows       = []
+latitude          = 53.35
+longitude         = -6.26
+planDays          = 1     # How far ahead the forecast on screen 0 looks
+idleAfterSecs     = 60
+idlePollSecs      = 10
+wakeLeadSecs      = 10    # Cameras reopen this long before a window
+planPollSecs      = 30    # The planner thread's longest sleep
+plan              = None  # planner.Planner of planWindows
+planned           = None  # planner.Occurrence being captured
+plannedFrames     = 0     # Frames expected by the end of it
+lowPower          = False
+lastTouch         = time.time()
+powerLock         = threading.Lock()
+
+# Playback (screen 4) of the newest session's thumbnails, opened by
+# tapping the viewfinder: the frame in playRect, a strip across the whole
+# session in stripRect.
+thumbnailsEnabled = True
+thumbnails        = None # playback.ThumbnailWriter of the running sequence
+playRect          = (0, 0, 320, 240)
+stripRect         = (0, 250, 480, 60)
+player            = None
+
+# Viewfinder on screen 0, fed from the frames the shared capture session is
+# already grabbing.  previewRect is the viewport (x, y, w, h).
+previewEnabled    = True
+previewRect       = (296, 176, 176, 99)
+previewFps        = 5
+viewfinder        = None
+
+icons = {} # name -> Icon; this dict gets populated at startup
 
 # buttons[] is a list of lists; each top-level list element corresponds
 # to one screen mode (e.g. viewfinder, image playback, storage settings),
@@ -263,13 +830,17 @@ buttons = [
    Button((150,180,60, 60), bg='stop',  cb=startCallback, value=0),
    # Button((223,180,60, 60), bg='quit', cb=quitCallback),
    # Button((296,180,60, 60), bg='off', cb=offCallback)],
-   Button((223,180,60, 60), bg='off', cb=offCallback)],
+   Button((223,180,60, 60), bg='off', cb=offCallback),
+   Button((296,176,176,99),             cb=playbackCallback, value=4),
+   Button((  0,  0,480, 40),             cb=overlayCallback)],
 
   # Screen 1 for changing values and setting motor direction
-  # [Button((260,  0, 60, 60), bg='cog',   cb=valuesCallback, value=1),
-   [Button((260, 60, 60, 60), bg='cog',   cb=valuesCallback, value=2),
+  [Button((260,  0, 60, 60), bg='cog',   cb=valuesCallback, value=1),
+   Button((260, 60, 60, 60), bg='cog',   cb=valuesCallback, value=2),
    Button((260,120, 60, 60), bg='cog',   cb=valuesCallback, value=3),
-   Button((  0,180,160, 60), bg='ok',    cb=valuesCallback, value=-1),],
+   Button((  0,180,160, 60), bg='ok',    cb=valuesCallback, value=-1),
+   Button((420, 60, 60, 60), bg='cog',   cb=valuesCallback, value=4),
+   Button((420,120, 60, 60), bg='cog',   cb=valuesCallback, value=5),],
 
   # Screen 2 for numeric input
   [Button((  0,  0,320, 60), bg='box'),
@@ -285,7 +856,19 @@ buttons = [
    Button((120, 60, 60, 60), bg='9',     cb=numericCallback, value=9),
    Button((240,120, 80, 60), bg='del',   cb=numericCallback, value=10),
    Button((180,180,140, 60), bg='ok',    cb=numericCallback, value=12),
-   Button((180, 60,140, 60), bg='cancel',cb=numericCallback, value=11)]
+   Button((180, 60,140, 60), bg='cancel',cb=numericCallback, value=11)],
+
+  # Screen 3 offers to resume a sequence that never finished
+  [Button((  0,180,160, 60), bg='ok',    cb=resumeCallback, value=1),
+   Button((160,180,160, 60), bg='cancel',cb=resumeCallback, value=0)],
+
+  # Screen 4 plays back the thumbnails of the newest session
+  [Button((330, 10, 60, 60), bg='left',  cb=playbackCallback, value=-1),
+   Button((400, 10, 60, 60), bg='right', cb=playbackCallback, value=1),
+   Button((330, 80, 60, 60), bg='start', cb=playbackCallback, value=2),
+   Button((400, 80, 60, 60), bg='stop',  cb=playbackCallback, value=3),
+   Button((320,180,160, 60), bg='ok',    cb=playbackCallback, value=0),
+   Button((  0,250,480, 60),             cb=playbackCallback, value=5)]
 ]
 
 
@@ -293,149 +876,634 @@ buttons = [
 
 
 def saveSettings():
-	global v
 	try:
-		outfile = open('lapse.pkl', 'wb')
-		# Use a dictionary (rather than pickling 'raw' values) so
-		# the number & order of things can change without breaking.
-		cPickle.dump(v, outfile)
-		outfile.close()
-	except:
-		pass
+		profiles.save(v)
+	except (IOError, OSError) as e:
+		print("Can't save settings: %s" % e)
 
 def loadSettings():
 	global v
 	try:
-		infile = open('lapse.pkl', 'rb')
-		v = cPickle.load(infile)
-		infile.close()
-	except:
-		pass
+		v = profiles.load()
+	except (IOError, OSError) as e:
+		print("Can't load settings: %s" % e)
+
+# The capture session is opened once and shared by every sequence, so the
+# device isn't reopened (and re-warmed) for each frame or each run.
+# Between sequences they grab only the frames the viewfinder asks for.
+def getCameras():
+	if not cameras:
+		for device in captureDevices:
+			cameras.append(capture.openCapture(captureBackend, device,
+			  captureResolution))
+			cameras[-1].setOnDemand(not control.busy())
+	return cameras
+
+# The first camera, which the viewfinder shows
+def getCamera():
+	return getCameras()[0]
+
+def closeCamera():
+	while cameras:
+		cameras.pop().close()
+
+# Bring 'sessionDir's catalog row up to date, or every session's.  The
+# catalog is only an index, so failing to update it doesn't stop anything.
+def catalogSession(sessionDir=None):
+	if not sessionCatalog:
+		return
+	try:
+		if sessionDir:
+			sessionCatalog.update(sessionDir)
+		else:
+			sessionCatalog.scan()
+	except Exception as e:
+		print("Catalog not updated: %s" % e)
+
+# Close the cameras (they stop grabbing) or reopen them.  A capture from a
+# closed camera reopens it anyway, so a sequence never finds one asleep.
+def sleepCameras(asleep):
+	with powerLock:
+		for cam in cameras:
+			if asleep:
+				cam.close()
+			else:
+				cam.open()
+
+# Nothing to do until a window: no sequence, and none starting soon.
+def planIdle():
+	if not plan or control.busy():
+		return False
+	occ = plan.next(time.time())
+	return occ is None or occ.start - time.time() > wakeLeadSecs
+
+def setLowPower(on):
+	global lowPower
+	lowPower = on
+	pygame.time.set_timer(REFRESHEVENT,
+	  int(1000 * idlePollSecs) if on else int(1000 / statusPollHz))
+	if viewfinder:
+		pygame.time.set_timer(PREVIEWEVENT, 0 if on else int(1000 / previewFps))
+	sleepCameras(on)
+
+# Start a sequence for each occurrence of planWindows, waking the cameras
+# wakeLeadSecs before.  Runs on its own thread, in sleeps no longer than
+# planPollSecs so a changed clock or plan is picked up.  A window that is
+# already under way (e.g. after a reboot) is started late rather than
+# missed; one that a manual sequence overlaps entirely is skipped.
+def planLoop():
+	started = set()
+	while True:
+		now = time.time()
+		occ = plan.next(now)
+		if occ is None or occ.key() in started:
+			sleep(planPollSecs)
+			continue
+		if occ.start - now > wakeLeadSecs:
+			sleep(min(planPollSecs, occ.start - now - wakeLeadSecs))
+			continue
+		sleepCameras(False)
+		if occ.start > now:
+			sleep(occ.start - now)
+		if control.busy():
+			sleep(1)
+			continue
+		started.add(occ.key())
+		if time.time() < occ.stop:
+			print("Starting planned window %s" % occ.describe())
+			control.post('start', None, occ).wait()
+
+# Screen rendering ---------------------------------------------------------
+
+# Each screen's text is described by screenLabels() as a list of
+# (key, position, font size, text).  redraw() compares that list with
+# what's already on the display and repaints only the rectangles of the
+# labels that changed, or the whole screen when the screen mode changed.
+
+def screenLabels():
+	labels = []
+	if screenMode == 2:
+		labels.append(('number', (10, 2), 50, numberstring))
+	if screenMode == 1:
+		labels.append(('profileTitle',  ( 10, 10), 30, "Profile:"))
+		labels.append(('profile',       (130, 10), 30, profiles.current))
+		labels.append(('intervalTitle', ( 10, 70), 30, "Interval:"))
+		labels.append(('framesTitle',   ( 10,130), 30, "Frames:"))
+		labels.append(('interval',      (130, 70), 30, str(v['Interval']) + "ms"))
+		labels.append(('frames',        (130,130), 30, str(v['Images'])))
+		labels.append(('fpsTitle',      (330, 70), 30, "Fps:"))
+		labels.append(('fps',           (380, 70), 30, str(v['Fps'])))
+		labels.append(('sizeTitle',     (330,130), 20, "Video size:"))
+		labels.append(('size',          (330,155), 20, v['Size']))
+	if screenMode == 4:
+		if player and player.thumbs.frames:
+			labels.append(('playFrame', (330,150), 20, "%d of %d" %
+			  (player.index, player.thumbs.frames)))
+		else:
+			labels.append(('playFrame', (10,100), 30, "Nothing to play yet"))
+	if screenMode == 3:
+		labels.append(('resumeTitle', (10, 50), 30, "Resume unfinished sequence?"))
+		labels.append(('resumeDir',   (10, 90), 30,
+		  os.path.basename(unfinished.dir.rstrip('/'))))
+		labels.append(('resumeFrame', (10,130), 30, "At frame %d of %d" %
+		  (unfinished.nextFrame(), unfinished.settings.get('Images', v['Images']))))
+		if control.busy():
+			labels.append(('resumeBusy', (10,170), 20,
+			  "A sequence is running; resume once it ends"))
+	if screenMode == 0:
+		labels.append(('intervalTitle',  ( 10, 50), 30, "Interval:"))
+		labels.append(('framesTitle',    ( 10, 90), 30, "Frames:"))
+		labels.append(('remainingTitle', ( 10,130), 30, "Remaining:"))
+		labels.append(('interval', (280, 50), 30, str(v['Interval']) + "ms"))
+		if planned:
+			labels.append(('frames', (280, 90), 30,
+			  "%d of ~%d" % (control.frame, plannedFrames)))
+		else:
+			labels.append(('frames', (280, 90), 30,
+			  str(imagesDone()) + " of " + str(v['Images'])))
+		if plan:
+			frames, occs = plan.forecast(time.time(), v['Interval'] / 1000.0)
+			occ = planned or (occs[0] if occs else plan.next(time.time()))
+			labels.append(('plan', (10, 170), 20, "%s: %s, plan ~%d frames" %
+			  ("Now" if planned else "Next", occ.describe(), frames)
+			  if occ else "Nothing planned"))
+
+		state = control.state
+		if state == 'rendering' and renderProgress and renderProgress.total:
+			eta = renderProgress.eta()
+			labels.append(('status', (10, 280), 30, "Rendering %d/%d, %s left" % (
+			  renderProgress.done(), renderProgress.total,
+			  "%dm %ds" % divmod(int(eta), 60) if eta is not None else "?")))
+		elif state == 'rendering':
+			labels.append(('status', (10, 280), 30, "Please wait, Rendering video..."))
+		elif state == 'stopping':
+			labels.append(('status', (10, 280), 30, "Stopping..."))
+		elif state == 'capturing':
+			labels.append(('status', (10, 280), 30, "Recording..."))
+			details = []
+			if pipe is not None:
+				details.append("Queue %d/%d  Dropped %d" %
+				  (pipe.pending(), pipe.depth, pipe.dropped))
+			if detector is not None:
+				details.append("Kept %d  Skipped %d" %
+				  (detector.kept, detector.skipped))
+			if group is not None and len(group.cameras) > 1:
+				details.append("Skew %.0fms" % (group.meanSkew() * 1000))
+			if details:
+				labels.append(('details', (10, 248), 20, "  ".join(details)))
+
+		sec = timedelta(seconds=int(remainingSeconds()))
+		d = datetime(1,1,1) + sec
+		remainingStr = "%dh %dm %ds" % (d.hour, d.minute, d.second)
+		labels.append(('remaining', (280, 130), 30, remainingStr))
+
+		if not plan:
+			frames = v['Images'] - imagesDone()
+		needed, free, fits = store.forecast(frames * len(captureDevices))
+		if fits:
+			forecast = "Needs %s of %s free" % (storage.formatBytes(needed),
+			  storage.formatBytes(free))
+		else:
+			forecast = "Won't fit: needs %s, %s free" % (
+			  storage.formatBytes(needed), storage.formatBytes(free))
+		labels.append(('storage', (10, 10), 30, forecast))
+
+		if debugOverlay:
+			for i, line in enumerate(overlayLines()):
+				labels.append(('debug%d' % i,
+				  (previewRect[0], previewRect[1] + 18 * i), 16, line))
+
+		if control.error:
+			labels.append(('error', (10, 280), 30, control.error))
+	return labels
+
+# Time left in the sequence.  Once a sequence is running, this is estimated
+# from its measured cadence.
+# Of v['Images'], how many the running sequence has used up: the frames
+# kept ('frame', by default the count so far) and any change detection
+# skipped.
+def imagesDone(frame=None):
+	frame = control.frame if frame is None else frame
+	if detector is not None and control.busy():
+		return frame + detector.skipped
+	return frame
+
+def remainingSeconds():
+	frame = imagesDone()
+	if planned:
+		return max(0.0, planned.stop - time.time())
+	if control.capturing() and sched is not None:
+		return sched.remaining(v['Images'] - frame)
+	return float((v['Interval'] * (v['Images'] - frame)) / 1000)
+
+# The debug overlay: p50/p99 of each histogram with samples, in ms.
+def overlayLines():
+	lines = []
+	for name, h in metrics.histograms.items():
+		if h.count:
+			lines.append("%s %.1f/%.1fms" % (name, h.percentile(50) * 1000,
+			  h.percentile(99) * 1000))
+	if 'renderFps' in metrics.gauges:
+		lines.append("render %.1f fps" % metrics.gauges['renderFps'])
+	return lines[:5] or ["No timings yet"]
+
+def exportMetrics():
+	global metricsWritten
+	metricsWritten = time.time()
+	if metricsPath:
+		try:
+			metrics.writeFile(metricsPath)
+		except (IOError, OSError) as e:
+			print("Can't write %s: %s" % (metricsPath, e))
 
+def drawBackground(surface):
+	if img is None or img.get_height() < 240: # Letterbox, clear background
+		surface.fill(0)
+	if img:
+		surface.blit(img,
+			((480 - img.get_width() ) / 2,
+			(320 - img.get_height()) / 2))
 
+# Repaint everything that lies within 'rect': the precomposited background
+# and buttons, then labels, so overlapping items keep their stacking order.
+def paint(rect):
+	screen.blit(screenSurface(screenMode), rect, rect)
+	if screenMode == 4 and player:
+		player.draw(screen, rect)
+	if (screenMode == 0 and viewfinder and not debugOverlay and
+	  viewfinder.rect.colliderect(rect)):
+		viewfinder.draw(screen, rect)
+		screen.set_clip(rect)
+		for b in buttons[screenMode]: # Keep buttons above the image
+			if viewfinder.rect.colliderect(b.rect): b.draw(screen)
+	screen.set_clip(rect)
+	for key, (content, r, surface) in drawnLabels.items():
+		if rect.colliderect(r): screen.blit(surface, r)
+	screen.set_clip(None)
+
+# 'extra' lists further rectangles to repaint, e.g. a new preview image.
+def redraw(full, extra=()):
+	global drawnLabels
+	if full: drawnLabels = {}
+	current = {}
+	dirty   = list(extra)
+	for key, pos, size, text in screenLabels():
+		old = drawnLabels.get(key)
+		if old and old[0] == (size, text) and old[1].topleft == pos:
+			current[key] = old
+			continue
+		surface = textCache.render(text, "Arial", size)
+		rect    = surface.get_rect(topleft=pos)
+		current[key] = ((size, text), rect, surface)
+		dirty.append(rect)
+		if old: dirty.append(old[1])
+	for key in drawnLabels:
+		if key not in current: dirty.append(drawnLabels[key][1])
+	drawnLabels = current
+
+	if full:
+		paint(screen.get_rect())
+		pygame.display.update()
+		uiStats['full'] += 1
+	elif dirty:
+		for rect in dirty: paint(rect)
+		pygame.display.update(dirty)
+		uiStats['rects'] += len(dirty)
+	else:
+		return
+	uiStats['redraws'] += 1
+
+# Process CPU use (all threads) over the last cpuReportSecs, in percent.
+# Logged when it exceeds idleCpuTarget while no sequence is running.
+def measureCpu():
+	global cpuSample, uiCpu
+	now = os.times()
+	if cpuSample is None:
+		cpuSample = now
+		return
+	elapsed = now[4] - cpuSample[4]
+	if elapsed < cpuReportSecs:
+		return
+	used = (now[0] + now[1]) - (cpuSample[0] + cpuSample[1])
+	uiCpu     = 100.0 * used / elapsed
+	cpuSample = now
+	if not control.busy() and uiCpu > idleCpuTarget:
+		print("Idle CPU %.1f%% above target %.1f%% (%d redraws, text cache %d/%d hits)" %
+		  (uiCpu, idleCpuTarget, uiStats['redraws'], textCache.hits,
+		  textCache.hits + textCache.misses))
+
+# Record the end of a startup step for the timing report.
+def startupStep(name):
+	startupTimes.append((name, time.time()))
+
+# Print the time taken by each startup step and the total time to
+# interactive, and append the same line to startupLog.
+def startupReport():
+	steps = ["%s %.3fs" % (startupTimes[i][0],
+	  startupTimes[i][1] - startupTimes[i-1][1])
+	  for i in range(1, len(startupTimes))]
+	total = startupTimes[-1][1] - startupTimes[0][1]
+	report = "Startup: %s; interactive after %.3fs" % (", ".join(steps), total)
+	print(report)
+	if startupLog:
+		try:
+			with open(startupLog, 'a') as log:
+				log.write("%s %s\n" % (datetime.now().isoformat(), report))
+		except IOError:
+			pass
+
+# HTTP API -----------------------------------------------------------------
+
+# Everything a client polls for; built by statusCache a few times a
+# second, never per request.
+def statusSnapshot():
+	state    = control.state
+	progress = renderProgress if state == 'rendering' else None
+	latest   = thumbnails.latest if thumbnails else None
+	return {
+	  'state'       : state,
+	  'busy'        : state in ('capturing', 'stopping'),
+	  'currentframe': control.frame,
+	  'images'      : v['Images'],
+	  'interval'    : v['Interval'],
+	  'remaining'   : round(remainingSeconds(), 1),
+	  'rendering'   : state == 'rendering',
+	  'render'      : {'done': progress.done(), 'total': progress.total,
+	                   'eta': progress.eta()} if progress else None,
+	  'queue'       : pipe.pending() if pipe and control.capturing() else 0,
+	  'dropped'     : pipe.dropped if pipe else 0,
+	  'writeErrors' : sum(p.errors for p in pipes),
+	  'error'       : control.error,
+	  'profile'     : profiles.current,
+	  'session'     : session,
+	  'unfinished'  : unfinished.dir if unfinished else None,
+	  'thumbnail'   : latest[0] if latest else None,
+	  'plan'        : planStatus(),
+	  'time'        : time.time() }
+
+# The window under way or next, and the frames the whole plan will take.
+def planStatus():
+	if not plan:
+		return None
+	now          = time.time()
+	frames, occs = plan.forecast(now, v['Interval'] / 1000.0)
+	occ          = planned or (occs[0] if occs else plan.next(now))
+	return {
+	  'next'  : occ.window.spec if occ else None,
+	  'start' : occ.start if occ else None,
+	  'stop'  : occ.stop if occ else None,
+	  'frames': frames }
+
+def apiThumbnail():
+	return thumbnails.latest if thumbnails else None
+
+# Commands go through the same queue as the buttons; waiting for them to
+# be handled (not for the sequence) means the next poll sees their effect.
+def apiStart(body):
+	with apiLock:
+		done = control.post('start')
+		done.wait()
+		if not done.result:
+			return 409, {'error': 'a sequence is running'}
+	return 200, {'started': True}
+
+def apiStop(body):
+	with apiLock:
+		done = control.post('stop')
+		done.wait()
+		if not done.result:
+			return 409, {'error': 'no sequence is running'}
+	return 200, {'stopped': True}
+
+def apiResume(body):
+	global unfinished, screenMode
+	with apiLock:
+		if not unfinished:
+			return 404, {'error': 'no unfinished sequence'}
+		if control.busy():
+			return 409, {'error': 'a sequence is running'}
+		done = control.post('start', unfinished)
+		done.wait()
+		if not done.result: # Something started it first
+			return 409, {'error': 'a sequence is running'}
+		unfinished = None
+		screenMode = 0
+	return 200, {'started': True}
+
+def apiDiscard(body):
+	with apiLock:
+		if not unfinished:
+			return 404, {'error': 'no unfinished sequence'}
+		resumeCallback(0)
+	return 200, {'discarded': True}
+
+def apiMetrics(body):
+	return 200, metrics.export()
+
+def apiSessions(body):
+	if not sessionCatalog:
+		return 404, {'error': 'no catalog'}
+	return 200, {'sessions': sessionCatalog.sessions()}
+
+def apiGetSettings(body):
+	return 200, {'settings': v, 'profile': profiles.current,
+	  'profiles': profiles.names()}
+
+# {"profile": name} switches profile first; every other key must be a
+# valid setting, or nothing is changed.
+def apiPutSettings(body):
+	global v
+	with apiLock:
+		if control.busy():
+			return 409, {'error': 'a sequence is running'}
+		profile = body.pop('profile', None)
+		if profile is not None and profile not in profiles.names():
+			return 400, {'error': 'no profile %r' % profile}
+		try:
+			values = dict((name, settings.check(name, value))
+			  for name, value in body.items())
+		except (KeyError, ValueError) as e:
+			return 400, {'error': 'bad setting %s' % e}
+		if profile is not None:
+			saveSettings()
+			v = profiles.select(profile)
+		v.update(values)
+		saveSettings()
+	return apiGetSettings(None)
+
+apiCommands = {
+  ('POST', '/start')   : apiStart,
+  ('POST', '/stop')    : apiStop,
+  ('POST', '/resume')  : apiResume,
+  ('POST', '/discard') : apiDiscard,
+  ('GET',  '/metrics') : apiMetrics,
+  ('GET',  '/sessions'): apiSessions,
+  ('GET',  '/settings'): apiGetSettings,
+  ('PUT',  '/settings'): apiPutSettings }
 
 # Initialization -----------------------------------------------------------
 
-# Init framebuffer/touchscreen environment variables
-os.putenv('SDL_VIDEODRIVER', 'fbcon')
-# Init pygame and screen
-print ("Initting...")
-pygame.init()
-print("Setting fullscreen...")
-modes = pygame.display.list_modes(16)
-screen = pygame.display.set_mode(modes[0], FULLSCREEN, 16)
+if '--build-atlas' in sys.argv:
+	n = atlas.build(iconPath, atlasPath, ('LapsePi_hi',))
+	print("Packed %d icons into %s" % (n, atlasPath))
+	raise SystemExit
+
+img = None
+if not headless:
+	# Init framebuffer/touchscreen environment variables, unless the caller
+	# picked a driver (bench.py runs the UI on SDL's dummy driver)
+	if 'SDL_VIDEODRIVER' not in os.environ:
+		os.putenv('SDL_VIDEODRIVER', 'fbcon')
+	# Init pygame and screen
+	print ("Initting...")
+	pygame.init()
+	startupStep('pygame')
+	print("Setting fullscreen...")
+	try:
+		modes = pygame.display.list_modes(16)
+		if modes in (-1, []): # Any size will do; use the PiTFT's
+			modes = [(480, 320)]
+		screen = pygame.display.set_mode(modes[0], FULLSCREEN, 16)
+		startupStep('display')
+	except pygame.error as e:
+		print("No display (%s), running headless" % e)
+		headless = True
+
+if not headless:
+	# The splash stays up only as long as the rest of initialization takes
+	print("loading background..")
+	img    = pygame.image.load("icons/LapsePi_hi.png").convert()
+
+	drawBackground(screen)
+	pygame.display.update()
+	startupStep('splash')
 
 print ("Loading Icons...")
-# Load all icons at startup.
+# Register all icons at startup; bitmaps load on first use.
 for file in os.listdir(iconPath):
 	if fnmatch.fnmatch(file, '*.png'):
-		icons.append(Icon(file.split('.')[0]))
-# Assign Icons to Buttons, now that they're loaded
+		name = file.split('.')[0]
+		icons[name] = Icon(name)
+# Assign Icons to Buttons, now that they're registered
 print("Assigning Buttons")
 for s in buttons:        # For each screenful of buttons...
 	for b in s:            #  For each button on screen...
-		for i in icons:      #   For each icon...
-			if b.bg == i.name: #    Compare names; match?
-				b.iconBg = i     #     Assign Icon to Button
-				b.bg     = None  #     Name no longer used; allow garbage collection
-			if b.fg == i.name:
-				b.iconFg = i
-				b.fg     = None
+		if b.bg in icons:    #   Look up icons by name
+			b.setBg(b.bg)
+			b.bg = None        #    Name no longer used; allow garbage collection
+		if b.fg in icons:
+			b.setFg(b.fg)
+			b.fg = None
+# Touch lookup for each screenful of buttons
+buttonIndex = [ButtonIndex(s) for s in buttons]
+startupStep('icons')
 
 print("Load Settings")
 loadSettings() # Must come last; fiddles with Button/Icon states
+startupStep('settings')
+
+atexit.register(closeCamera) # Stop the grab thread however we exit
+# A sequence cut short by a crash or power loss can carry on where it was
+unfinished = journal.findUnfinished(timelapseRoot)
+if unfinished:
+	screenMode = 3
+
+if apiEnabled:
+	statusCache = api.StatusCache(statusSnapshot, apiThumbnail,
+	  1.0 / statusPollHz)
+	statusCache.start()
+	try:
+		api.serve(statusCache, apiCommands, apiHost, apiPort)
+		print("API on port %d" % apiPort)
+	except (IOError, OSError) as e:
+		print("No API: %s" % e)
+	startupStep('api')
 
-print("loading background..")
-img    = pygame.image.load("icons/LapsePi_hi.png")
-
-if img is None or img.get_height() < 240: # Letterbox, clear background
-	screen.fill(0)
-if img:
-	screen.blit(img,
-	((480 - img.get_width() ) / 2,
-	 (320 - img.get_height()) / 2))
-pygame.display.update()
-sleep(2)
+if catalogEnabled:
+	try:
+		if not os.path.isdir(timelapseRoot):
+			os.makedirs(timelapseRoot)
+		sessionCatalog = catalog.Catalog(timelapseRoot)
+		t = threading.Thread(target=catalogSession) # Reads changed journals only
+		t.daemon = True
+		t.start()
+	except Exception as e:
+		print("No catalog: %s" % e)
+
+if planWindows:
+	plan = planner.Planner(planWindows, latitude, longitude, planDays)
+	t = threading.Thread(target=planLoop)
+	t.daemon = True
+	t.start()
+
+if previewEnabled and not headless:
+	try:
+		viewfinder = preview.Preview(getCamera(), previewRect, previewFps)
+	except Exception as e:
+		print("No viewfinder: %s" % e)
+	startupStep('camera')
 
 # Main loop ----------------------------------------------------------------
 
-
+# Headless, everything happens on the sequence and API threads.
+if headless:
+	startupStep('ready')
+	startupReport()
+	while True:
+		sleep(metricsSecs)
+		if planIdle():
+			sleepCameras(True)
+		measureCpu()
+		exportMetrics()
+
+# The loop sleeps in pygame.event.wait() until there is a touch or the
+# status poll timer fires, then repaints only what changed.  Clock.tick()
+# caps the redraw rate at maxFps.
+REFRESHEVENT = USEREVENT + 1
+PREVIEWEVENT = USEREVENT + 2
+PLAYBACKEVENT = USEREVENT + 3 # Runs only while playing
+pygame.time.set_timer(REFRESHEVENT, int(1000 / statusPollHz))
+if viewfinder:
+	pygame.time.set_timer(PREVIEWEVENT, int(1000 / previewFps))
+clock = pygame.time.Clock()
 
 print("mainloop..")
+redraw(True) # First full screen; startup is over once it's displayed
+screenModePrior = screenMode
+startupStep('interactive')
+startupReport()
 while(True):
 
 	# Process touchscreen input
-	while True:
-		for event in pygame.event.get():
-			if(event.type is MOUSEBUTTONDOWN):
-				pos = pygame.mouse.get_pos()
-				for b in buttons[screenMode]:
-					if b.selected(pos): break
-			elif(event.type is MOUSEBUTTONUP):
-				motorRunning = 0
-
-		if screenMode >= 0 or screenMode != screenModePrior: break
-
-
-	if img is None or img.get_height() < 240: # Letterbox, clear background
-		screen.fill(0)
-	if img:
-		screen.blit(img,
-			((480 - img.get_width() ) / 2,
-			(320 - img.get_height()) / 2))
-
-	# Overlay buttons on display and update
-	for i,b in enumerate(buttons[screenMode]):
-		b.draw(screen)
-	if screenMode == 2:
-		myfont = pygame.font.SysFont("Arial", 50)
-		label = myfont.render(numberstring, 1, (255,255,255))
-		screen.blit(label, (10, 2))
-	if screenMode == 1:
-		myfont = pygame.font.SysFont("Arial", 30)
-		label = myfont.render("Interval:" , 1, (255,255,255))
-		screen.blit(label, (10, 70))
-		label = myfont.render("Frames:" , 1, (255,255,255))
-		screen.blit(label, (10,130))
-
-		label = myfont.render(str(v['Interval']) + "ms" , 1, (255,255,255))
-		screen.blit(label, (130, 70))
-		label = myfont.render(str(v['Images']) , 1, (255,255,255))
-		screen.blit(label, (130,130))
-
-	if screenMode == 0:
-		myfont = pygame.font.SysFont("Arial", 30)
-		label = myfont.render("Interval:" , 1, (255,255,255))
-		screen.blit(label, (10, 50))
-		label = myfont.render("Frames:" , 1, (255,255,255))
-		screen.blit(label, (10, 90))
-		label = myfont.render("Remaining:" , 1, (255,255,255))
-		screen.blit(label, (10,130))
-
-		label = myfont.render(str(v['Interval']) + "ms" , 1, (255,255,255))
-		screen.blit(label, (280, 50))
-		label = myfont.render(str(currentframe) + " of " + str(v['Images']) , 1, (255,255,255))
-		screen.blit(label, (280, 90))
-
-		if rendering:
-			label = myfont.render("Please wait, Rendering video...", 1, (255, 255, 255))
-			screen.blit(label, (10, 280))
-		elif busy:
-			label = myfont.render("Recording...", 1, (255, 255, 255))
-			screen.blit(label, (10, 280))
-
-		intervalLength = float((v['Interval'] + (settling_time*1000)))
-		remaining = float((intervalLength * (v['Images'] - currentframe)) / 1000)
-		sec = timedelta(seconds=int(remaining))
-		d = datetime(1,1,1) + sec
-		remainingStr = "%dh %dm %ds" % (d.hour, d.minute, d.second)
-
-		label = myfont.render(remainingStr , 1, (255,255,255))
-		screen.blit(label, (280, 130))
-
-		label = myfont.render(str(error) , 1, (255,255,255))
-		screen.blit(label, (10, 280))
-	pygame.display.update()
-
+	events  = [pygame.event.wait()] + pygame.event.get()
+	started = time.time()
+	for event in events:
+		if(event.type is MOUSEBUTTONDOWN):
+			lastTouch = time.time()
+			pos = pygame.mouse.get_pos()
+			b = buttonIndex[screenMode].find(pos)
+			if b: b.press()
+		elif(event.type is MOUSEBUTTONUP):
+			motorRunning = 0
+
+	newImage = []
+	if (screenMode == 0 and viewfinder and not debugOverlay and
+	  viewfinder.update()):
+		newImage.append(viewfinder.rect)
+	if screenMode == 4 and player and player.update():
+		newImage.extend((player.rect, player.strip))
+		if not player.playing:
+			pygame.time.set_timer(PLAYBACKEVENT, 0)
+	redraw(screenMode != screenModePrior, newImage)
 	screenModePrior = screenMode
+	metrics.histogram('ui').record(time.time() - started)
+
+	idle = (screenMode == 0 and time.time() - lastTouch > idleAfterSecs and
+	  planIdle())
+	if idle != lowPower:
+		setLowPower(idle)
 
+	measureCpu()
+	if time.time() - metricsWritten >= metricsSecs:
+		exportMetrics()
+	clock.tick(maxFps)
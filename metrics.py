@@ -0,0 +1,119 @@
+# Timing instrumentation for lapse.py
+#
+# Hot paths record their durations into fixed-size histograms: a sorted
+# list of bucket bounds made once, and a list of counts that's only ever
+# incremented, so recording a sample costs a bisect and a few additions
+# and nothing is kept per sample.  Histograms are registered by name in
+# 'histograms'; 'gauges' holds single values such as render throughput.
+#
+#   capture   device capture, per frame (all cameras)
+#   merge     merging a burst into one frame (burst.py)
+#   jitter    how late the scheduler woke up for each deadline
+#   encode    JPEG encode and write of an RGB frame (pygame does both)
+#   write     write of a frame that arrived as JPEG
+#   sync      fsync of a frame, when the pipeline fsyncs
+#   ui        UI loop work per iteration: input, preview, redraw
+#   render    seconds per frame of a finished render
+#
+# export() turns everything into a dict for the status API or writeFile().
+# measureOverhead() times record() itself, so the cost is known.
+
+import bisect
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+# Bucket upper bounds in seconds, four per decade from 10us to 100s
+defaultBounds = [10 ** (e / 4.0) for e in range(-20, 9)]
+
+class Histogram:
+
+	def __init__(self, name, bounds=defaultBounds):
+		self.name   = name
+		self.bounds = bounds
+		self.lock   = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		self.counts = [0] * (len(self.bounds) + 1) # Last one is overflow
+		self.count  = 0
+		self.total  = 0.0
+		self.max    = 0.0
+
+	def record(self, value):
+		i = bisect.bisect_left(self.bounds, value)
+		with self.lock:
+			self.counts[i] += 1
+			self.count     += 1
+			self.total     += value
+			if value > self.max:
+				self.max = value
+
+	def mean(self):
+		return self.total / self.count if self.count else 0.0
+
+	# Upper bound of the bucket holding the p'th percentile (0-100), capped
+	# at the largest value seen.
+	def percentile(self, p):
+		if not self.count:
+			return 0.0
+		rank = p / 100.0 * self.count
+		seen = 0
+		for i, n in enumerate(self.counts):
+			seen += n
+			if seen >= rank and n:
+				return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+		return self.max
+
+	def snapshot(self):
+		return {
+		  'count': self.count,
+		  'mean' : self.mean(),
+		  'p50'  : self.percentile(50),
+		  'p90'  : self.percentile(90),
+		  'p99'  : self.percentile(99),
+		  'max'  : self.max }
+
+histograms = OrderedDict()
+gauges     = {}
+overhead   = None # Seconds per record(), once measured
+
+def histogram(name):
+	h = histograms.get(name)
+	if h is None:
+		h = histograms[name] = Histogram(name)
+	return h
+
+def setGauge(name, value):
+	gauges[name] = value
+
+# Seconds spent per timed sample: two clock reads plus record().
+def measureOverhead(samples=10000):
+	global overhead
+	h     = Histogram('overhead')
+	clock = time.time
+	start = clock()
+	for i in range(samples):
+		t = clock()
+		h.record(clock() - t)
+	overhead = (clock() - start) / samples
+	return overhead
+
+def export():
+	if overhead is None:
+		measureOverhead(1000)
+	return {
+	  'histograms': dict((name, h.snapshot()) for name, h in histograms.items()),
+	  'gauges'    : dict(gauges),
+	  'overhead'  : overhead,
+	  'time'      : time.time() }
+
+# Write export() to 'path' as JSON, replacing the old file in one rename.
+def writeFile(path):
+	temp = path + '.tmp'
+	with open(temp, 'w') as f:
+		json.dump(export(), f, indent=1, sort_keys=True)
+	os.rename(temp, path)
@@ -0,0 +1,268 @@
+# Capture/write pipeline for lapse.py
+#
+# The capture loop shouldn't wait on JPEG encoding or on the SD card.  It
+# copies each frame into a slot of a small ring of preallocated buffers and
+# carries on; one or more writer threads take filled slots, encode them
+# (when the backend produced raw RGB) and write the %07d.jpg file, then
+# hand the slot back to the ring.
+#
+# The ring is bounded, so a card that can't keep up shows up as
+# backpressure: submit() waits briefly for a free slot and, failing that,
+# drops the frame.  Both are counted for the status screen.
+#
+# Sinks (e.g. the streaming video encoder) see the same slots, in capture
+# order, on their own threads.  A slot only goes back to the ring once the
+# writer and every sink are done with it, so nothing is copied for them.
+#
+# A frame from a capture.BufferPool isn't copied into its slot either: the
+# slot keeps the Frame, and with it the capture buffer, until it's handed
+# back.  Only other frames (JPEGs from fswebcam, say) are copied, into a
+# buffer the slot allocates the first time it needs one.
+
+import os
+import threading
+import time
+
+import metrics
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+# Slot is one frame buffer plus the metadata of the frame it currently
+# holds.  'buf' is the pooled frame's own buffer or the slot's copy of the
+# frame; 'length' is the number of valid bytes in it.
+
+class Slot:
+
+	def __init__(self, nbytes):
+		self.nbytes = nbytes
+		self.own    = None # The slot's buffer, for frames it has to copy
+		self.buf    = None
+		self.frame  = None # Pooled frame being shared
+		self.length = 0
+		self.size   = None
+		self.format = None
+		self.path   = None
+		self.info   = None # Caller's metadata, handed back to onWrite
+		self.refs   = 0 # Writer + sinks still using this slot
+
+	# Returns True if the frame's buffer is shared rather than copied.
+	def load(self, frame, path, info=None):
+		n = len(frame.data)
+		if frame.pool is not None:
+			self.frame = frame
+			self.buf   = frame.data
+		else:
+			if self.own is None or n > len(self.own):
+				self.own = bytearray(max(n, self.nbytes)) # Grows once if oversized
+			self.own[:n] = frame.data
+			self.buf     = self.own
+		self.length  = n
+		self.size    = frame.size
+		self.format  = frame.format
+		self.path    = path
+		self.info    = info
+		return self.frame is not None
+
+	# Let go of a shared frame, returning its buffer to the capture pool.
+	def clear(self):
+		self.frame = None
+		self.buf   = self.own
+
+	# The valid part of the buffer, without copying it.
+	def view(self):
+		return memoryview(self.buf)[:self.length]
+
+# FramePipeline owns the ring of slots and the writer threads.
+#  - frameBytes : bytes per frame; what a slot allocates to copy a frame
+#  - slots      : ring depth, i.e. frames that can be in flight
+#  - writers    : number of writer threads
+#  - fsync      : force each file to the card before freeing its slot
+#  - sinks      : objects with a consume(slot) method, fed in frame order
+#  - onWrite    : called as onWrite(slot, nbytes) once a file is written
+#  - onError    : called as onError(slot, error) when a write fails
+
+class FramePipeline:
+
+	def __init__(self, frameBytes, slots=4, writers=1, fsync=False, sinks=(),
+	  onWrite=None, onError=None):
+		self.fsync        = fsync
+		self.onWrite      = onWrite
+		self.onError      = onError
+		self.depth        = slots
+		self.free         = queue.Queue()
+		self.filled       = queue.Queue()
+		for i in range(slots):
+			self.free.put(Slot(frameBytes))
+		self.lock         = threading.Lock()
+		self.submitted    = 0 # Frames accepted into the ring
+		self.written      = 0 # Frames on the card
+		self.dropped      = 0 # Frames lost because the ring was full
+		self.copied       = 0 # Frames copied into a slot rather than shared
+		self.backpressure = 0 # Submits that had to wait for a slot
+		self.errors       = 0 # Failed writes
+		self.errorsInRow  = 0 # Failed writes since the last one that worked
+		self.lastError    = None
+		self.workers      = []
+		for i in range(writers):
+			w = threading.Thread(target=self._writer)
+			w.daemon = True
+			w.start()
+			self.workers.append(w)
+		self.sinks        = []
+		for sink in sinks:
+			q = queue.Queue()
+			w = threading.Thread(target=self._feeder, args=(sink, q))
+			w.daemon = True
+			w.start()
+			self.sinks.append((q, w))
+
+	# Queue 'frame' to be written to 'path'.  Waits up to 'timeout' seconds
+	# for a free slot; returns False (and counts a drop) if none came free.
+	# 'info' is passed back to onWrite with the slot.
+	def submit(self, frame, path, timeout=0.0, info=None):
+		slot = self.reserve(timeout)
+		if slot is None:
+			return False
+		self.fill(slot, frame, path, info)
+		return True
+
+	# Take a free slot for a frame, waiting up to 'timeout' seconds; None
+	# (and a drop counted) if none came free.  A reserved slot must be
+	# passed to fill() or unreserve().  Reserving in several pipelines
+	# before filling any lets frames that belong together (one per camera)
+	# all go in, or none.
+	def reserve(self, timeout=0.0):
+		try:
+			return self.free.get(False)
+		except queue.Empty:
+			with self.lock:
+				self.backpressure += 1
+			try:
+				slot = self.free.get(True, timeout) if timeout > 0 else None
+			except queue.Empty:
+				slot = None
+			if slot is None:
+				with self.lock:
+					self.dropped += 1
+			return slot
+
+	# Give back a reserved slot unused; its frame counts as dropped.
+	def unreserve(self, slot):
+		with self.lock:
+			self.dropped += 1
+		self.free.put(slot)
+
+	# Queue 'frame' in the reserved 'slot', as submit() does.
+	def fill(self, slot, frame, path, info=None):
+		shared    = slot.load(frame, path, info)
+		slot.refs = 1 + len(self.sinks)
+		with self.lock:
+			self.submitted += 1
+			if not shared:
+				self.copied += 1
+		self.filled.put(slot)
+		for q, w in self.sinks:
+			q.put(slot)
+
+	def release(self, slot):
+		with self.lock:
+			slot.refs -= 1
+			done = slot.refs == 0
+		if done:
+			slot.clear()
+			self.free.put(slot)
+
+	# Frames waiting for (or being handled by) a writer
+	def pending(self):
+		return self.depth - self.free.qsize()
+
+	def _writer(self):
+		while True:
+			slot = self.filled.get()
+			if slot is None:
+				break
+			try:
+				nbytes = self._write(slot)
+				with self.lock:
+					self.written    += 1
+					self.errorsInRow = 0
+				if self.onWrite:
+					self.onWrite(slot, nbytes)
+			except Exception as e:
+				print("Write failed for %s: %s" % (slot.path, e))
+				with self.lock:
+					self.errors      += 1
+					self.errorsInRow += 1
+					self.lastError    = str(e)
+				if self.onError:
+					self.onError(slot, e)
+			self.filled.task_done()
+			self.release(slot)
+		self.filled.task_done()
+
+	def _feeder(self, sink, q):
+		while True:
+			slot = q.get()
+			if slot is None:
+				break
+			try:
+				sink.consume(slot)
+			except Exception as e:
+				print("Sink %s failed: %s" % (sink, e))
+			q.task_done()
+			self.release(slot)
+		q.task_done()
+
+	# Times go to the 'write', 'encode' and 'sync' histograms (metrics.py).
+	def _write(self, slot):
+		if slot.format == 'JPEG':
+			with open(slot.path, 'wb') as f:
+				start = time.time()
+				f.write(slot.view())
+				f.flush()
+				written = time.time()
+				metrics.histogram('write').record(written - start)
+				if self.fsync:
+					os.fsync(f.fileno())
+					metrics.histogram('sync').record(time.time() - written)
+			return slot.length
+		import pygame
+		if slot.length == len(slot.buf):
+			data = slot.buf
+		else:
+			data = slot.view().tobytes()
+		start = time.time()
+		pygame.image.save(pygame.image.frombuffer(data, slot.size, 'RGB'),
+		  slot.path)
+		written = time.time()
+		metrics.histogram('encode').record(written - start)
+		if self.fsync:
+			fd = os.open(slot.path, os.O_RDONLY)
+			try:
+				os.fsync(fd)
+			finally:
+				os.close(fd)
+			metrics.histogram('sync').record(time.time() - written)
+		return os.path.getsize(slot.path)
+
+	# Block until every submitted frame has been written and consumed.
+	def drain(self):
+		self.filled.join()
+		for q, w in self.sinks:
+			q.join()
+
+	def close(self):
+		self.drain()
+		for w in self.workers:
+			self.filled.put(None)
+		for q, w in self.sinks:
+			q.put(None)
+		for w in self.workers:
+			w.join()
+		for q, w in self.sinks:
+			w.join()
+		self.workers = []
+		self.sinks   = []
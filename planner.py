@@ -0,0 +1,247 @@
+# Capture planner for lapse.py
+#
+# A plan is a list of Windows, each a start and stop time when a sequence
+# should run by itself.  Times are written as
+#   "2026-10-20 06:00"   a date and local time: a one-off window
+#   "06:00"              a local time: the window recurs every day
+#   "sunrise", "sunset"  the day's sunrise or sunset (also daily)
+# and any of them can be followed by an offset in minutes, "sunset-30" or
+# "07:00+15".  A stop time earlier than the start is on the next day, so
+# "22:00" to "05:00" runs overnight.
+#
+# A window can also ramp its interval: with ramp=(interval, minutes) the
+# interval falls linearly from the sequence's usual one to 'interval' (in
+# ms) over the 'minutes' before sunrise or sunset, and back up over the
+# 'minutes' after, so the light changing fastest gets the most frames.
+#
+# Sunrise and sunset come from the NOAA approximation of the sunrise
+# equation for 'latitude' and 'longitude' (degrees, north and east
+# positive), good to a minute or two outside the polar circles, and
+# computed on the device: no network needed.  A day without a sunrise or
+# sunset has no window that depends on it.
+
+import datetime
+import math
+import re
+import time
+
+# Julian date of the Unix epoch
+unixEpoch = 2440587.5
+
+# (sunrise, sunset) on 'date' (a datetime.date) as Unix times, or None for
+# either if the sun doesn't rise or set that day.
+def sunTimes(date, latitude, longitude):
+	rad  = math.radians
+	n    = date.toordinal() - datetime.date(2000, 1, 1).toordinal()
+	mean = n - longitude / 360.0 # Mean solar noon, days since J2000
+	m    = (357.5291 + 0.98560028 * mean) % 360 # Mean anomaly
+	c    = (1.9148 * math.sin(rad(m)) + 0.02 * math.sin(rad(2 * m)) +
+	  0.0003 * math.sin(rad(3 * m))) # Equation of the center
+	lam  = (m + c + 180 + 102.9372) % 360 # Ecliptic longitude
+	noon = (2451545.0 + mean + 0.0053 * math.sin(rad(m)) -
+	  0.0069 * math.sin(rad(2 * lam)))
+	dec  = math.asin(math.sin(rad(lam)) * math.sin(rad(23.44)))
+	cosH = ((math.sin(rad(-0.833)) - math.sin(rad(latitude)) * math.sin(dec)) /
+	  (math.cos(rad(latitude)) * math.cos(dec)))
+	if not -1 <= cosH <= 1:
+		return None, None # Midnight sun or polar night
+	half = math.degrees(math.acos(cosH)) / 360.0
+	return ((noon - half - unixEpoch) * 86400, (noon + half - unixEpoch) * 86400)
+
+timeSpec = re.compile(r'^\s*(?:(\d{4})-(\d\d)-(\d\d)\s+)?'
+  r'(sunrise|sunset|(\d\d?):(\d\d))\s*(?:([+-])\s*(\d+))?\s*$')
+
+# Occurrence is one concrete run of a Window: Unix times 'start' and 'stop'.
+
+class Occurrence:
+
+	def __init__(self, window, start, stop):
+		self.window = window
+		self.start  = start
+		self.stop   = stop
+
+	def key(self):
+		return (self.start, self.stop)
+
+	def describe(self):
+		start = time.localtime(self.start)
+		return "%s %s-%s" % (time.strftime('%a', start),
+		  time.strftime('%H:%M', start),
+		  time.strftime('%H:%M', time.localtime(self.stop)))
+
+# Window is one entry of a plan; 'start' and 'stop' are specs as above.
+# A malformed spec, a dated window that stops before it starts, or a ramp
+# whose interval or minutes aren't positive raises ValueError.
+
+class Window:
+
+	def __init__(self, start, stop, ramp=None):
+		self.start = self._parse(start)
+		self.stop  = self._parse(stop)
+		self.ramp  = ramp
+		self.daily = self.start[0] is None
+		if (self.stop[0] is None) != self.daily:
+			raise ValueError("window %s-%s mixes dated and daily times" %
+			  (start, stop))
+		if self.ramp is not None:
+			fast, minutes = self.ramp
+			if fast <= 0 or minutes <= 0:
+				raise ValueError("ramp %r needs a positive interval and minutes" %
+				  (self.ramp,))
+		if not self.daily and self._before(self.stop, self.start):
+			raise ValueError("window %s-%s stops before it starts" % (start, stop))
+		self.spec  = "%s-%s" % (start, stop)
+
+	def _parse(self, spec):
+		m = timeSpec.match(spec)
+		if not m:
+			raise ValueError("bad time %r" % spec)
+		year, month, day, name, hour, minute, sign, offset = m.groups()
+		date   = (int(year), int(month), int(day)) if year else None
+		offset = int(offset or 0) * (-60 if sign == '-' else 60)
+		if hour is not None:
+			if int(hour) > 23 or int(minute) > 59:
+				raise ValueError("bad time %r" % spec)
+			return date, int(hour), int(minute), offset
+		return date, name, None, offset
+
+	# Dated spec 'a' is at or before 'b'.  Sun times aren't known without a
+	# location, so with one only the dates are compared.
+	def _before(self, a, b):
+		if a[0] != b[0] or a[2] is None or b[2] is None:
+			return a[0] < b[0]
+		return a[1] * 3600 + a[2] * 60 + a[3] <= b[1] * 3600 + b[2] * 60 + b[3]
+
+	# The Unix time of 'spec' on local 'date', or None.
+	def _resolve(self, spec, date, planner):
+		if spec[0] is not None:
+			date = datetime.date(*spec[0])
+		if spec[2] is not None:
+			base = time.mktime((date.year, date.month, date.day, spec[1], spec[2],
+			  0, 0, 0, -1))
+		else:
+			base = planner.sun(date)[0 if spec[1] == 'sunrise' else 1]
+			if base is None:
+				return None
+		return base + spec[3]
+
+	# The occurrence starting on local 'date', or None.
+	def on(self, date, planner):
+		start = self._resolve(self.start, date, planner)
+		stop  = self._resolve(self.stop, date, planner)
+		if start is not None and stop is not None and stop <= start:
+			stop = self._resolve(self.stop, date + datetime.timedelta(1), planner)
+		if start is None or stop is None:
+			return None
+		return Occurrence(self, start, stop)
+
+# Seconds between frames at 't' for a window ramping to 'ramp' ((interval
+# ms, minutes)) around the sun 'events', for a usual interval of 'base'.
+
+def rampInterval(ramp, events, t, base):
+	fast, minutes = ramp
+	fast = fast / 1000.0
+	span = minutes * 60.0
+	nearest = min([abs(t - e) for e in events] or [None])
+	if nearest is None or nearest >= span or fast >= base:
+		return base
+	return fast + (base - fast) * nearest / span
+
+# Planner answers questions about a list of Windows.  Sun times are cached
+# per date, and forecasts for a minute at a time, since the main screen
+# asks for them on every refresh.
+
+class Planner:
+
+	def __init__(self, windows=(), latitude=0.0, longitude=0.0, days=1):
+		self.windows   = list(windows)
+		self.latitude  = latitude
+		self.longitude = longitude
+		self.days      = days # How far ahead forecasts look
+		self.sunCache  = {}
+		self.cache     = {}
+
+	def sun(self, date):
+		if date not in self.sunCache:
+			self.sunCache[date] = sunTimes(date, self.latitude, self.longitude)
+		return self.sunCache[date]
+
+	# Occurrences that haven't ended by 'now' and start within 'days', in
+	# order of starting.
+	def occurrences(self, now, days=None):
+		days  = self.days if days is None else days
+		today = datetime.date.fromtimestamp(now)
+		found = []
+		for window in self.windows:
+			if window.daily:
+				dates = [today + datetime.timedelta(d) for d in range(-1, days + 1)]
+			else:
+				dates = [today]
+			for date in dates:
+				occ = window.on(date, self)
+				if occ and occ.stop > now and occ.start < now + days * 86400:
+					found.append(occ)
+		found.sort(key=Occurrence.key)
+		return found
+
+	# The occurrence under way at 'now', or the next one to start, or None.
+	def next(self, now, days=7):
+		found = self.occurrences(now, days)
+		return found[0] if found else None
+
+	# Sunrises and sunsets within a day of local dates 'first' to 'last',
+	# in order.
+	def events(self, first, last):
+		found = []
+		for d in range(-1, (last - first).days + 2):
+			found.extend(e for e in self.sun(first + datetime.timedelta(d))
+			  if e is not None)
+		return sorted(found)
+
+	# Seconds between frames at time 't' in 'occ', for a usual interval of
+	# 'base' seconds.
+	def intervalAt(self, occ, t, base):
+		if not occ.window.ramp:
+			return base
+		date = datetime.date.fromtimestamp(t)
+		return rampInterval(occ.window.ramp, self.events(date, date), t, base)
+
+	# Frames 'occ' will take from 'now' (or its start) to its stop.  Stretches
+	# at the usual interval are counted in one step; only the ramps around
+	# sunrise and sunset are stepped through frame by frame.
+	def frames(self, occ, base, now=0):
+		t, n = max(occ.start, now), 0
+		if occ.stop <= t:
+			return 0
+		if not occ.window.ramp or occ.window.ramp[0] / 1000.0 >= base:
+			return int(math.ceil((occ.stop - t) / base))
+		fast   = occ.window.ramp[0] / 1000.0
+		span   = occ.window.ramp[1] * 60.0
+		events = [e for e in self.events(datetime.date.fromtimestamp(t),
+		  datetime.date.fromtimestamp(occ.stop)) if e + span > t]
+		while t < occ.stop:
+			if not events or events[0] - span > t:
+				# Usual interval until the next ramp starts (or the stop)
+				end = min(events[0] - span, occ.stop) if events else occ.stop
+				k   = max(1, int(math.ceil((end - t) / base)))
+				n  += k
+				t  += k * base
+				continue
+			# Step through the ramps around this event and any overlapping it
+			near = [events.pop(0)]
+			while events and events[0] - span < near[-1] + span:
+				near.append(events.pop(0))
+			end = min(near[-1] + span, occ.stop)
+			while t < end:
+				n += 1
+				t += fast + (base - fast) * min(abs(t - e) for e in near) / span
+		return n
+
+	# (frames, occurrences) for everything planned in the next 'days' days.
+	def forecast(self, now, base):
+		key = (int(now // 60), base)
+		if key not in self.cache:
+			found = self.occurrences(now)
+			self.cache = {key: (sum(self.frames(o, base, now) for o in found),
+			  found)}
+		return self.cache[key]
@@ -0,0 +1,273 @@
+# Thumbnail pyramid and playback for lapse.py
+#
+# Each session gets one packed thumbnail file, thumbs.bin, written as
+# frames are captured (ThumbnailWriter is a pipeline sink, see
+# pipeline.py).  Every frame is stored at each level of the pyramid, by
+# default the largest size with the frame's aspect ratio that fits
+# 320x240 and one that fits 80x60, as raw RGB:
+#
+#   header   "LPTHUMB1", level count, (width, height) per level,
+#            padded to headerSize bytes
+#   record   frame 1: level 0 pixels, level 1 pixels, ...
+#   record   frame 2: ...
+#
+# Records are all the same size, so frame n's level k lives at a fixed
+# offset and nothing needs an index.  ThumbnailFile memory-maps the file
+# and slices out only the bytes of the thumbnail asked for, so scrubbing
+# through thousands of frames never decodes a JPEG or reads a whole file.
+#
+# Player steps or plays through a ThumbnailFile on the playback screen.
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+import pygame
+
+import capture
+import preview
+
+thumbsName = 'thumbs.bin'
+magic      = b'LPTHUMB1'
+headerSize = 64
+levelSizes = ((320, 240), (80, 60)) # Boxes each level is fitted into
+
+# ThumbnailWriter is the pipeline sink.  The level sizes are fixed by the
+# first frame; each frame's record goes at the offset of its index (from
+# slot.info), so a resumed session carries on in the same file.  'latest'
+# is (index, pixels, size) of the last frame's level 0.  'onWrite' is
+# called as onWrite(nbytes) with the bytes each write added to the file.
+
+class ThumbnailWriter:
+
+	def __init__(self, sessionDir, boxes=levelSizes, onWrite=None):
+		self.path    = os.path.join(sessionDir, thumbsName)
+		self.boxes   = boxes
+		self.onWrite = onWrite
+		self.lock    = threading.Lock()
+		self.file    = None
+		self.sizes   = None
+		self.count   = 0
+		self.time    = 0.0
+		self.latest  = None
+		self.scratch = {} # preview.downscale()'s buffers
+
+	def _open(self, frameSize):
+		if os.path.exists(self.path):
+			self.file  = open(self.path, 'r+b')
+			self.sizes = readHeader(self.file)
+		if self.sizes is None: # New (or unreadable) file
+			self.sizes = [preview.fit(frameSize, box) for box in self.boxes]
+			self.file  = open(self.path, 'w+b')
+			self.file.write(makeHeader(self.sizes))
+
+	def consume(self, slot):
+		start = time.time()
+		data  = slot.buf if slot.format == 'RGB' else slot.view().tobytes()
+		frame = capture.Frame(data, slot.size, slot.format)
+		with self.lock:
+			if self.file is None:
+				self._open(slot.size)
+			image  = preview.downscale(frame, self.sizes[0], self.scratch)
+			pixels = []
+			for size in self.sizes:
+				if image.get_size() != tuple(size):
+					image = pygame.transform.smoothscale(image, size)
+				pixels.append(pygame.image.tostring(image, 'RGB'))
+			index = slot.info['index'] if slot.info else self.count + 1
+			offset = headerSize + (index - 1) * recordSize(self.sizes)
+			length = os.fstat(self.file.fileno()).st_size
+			self.file.seek(offset)
+			self.file.write(b''.join(pixels))
+			self.file.flush()
+			grown = offset + recordSize(self.sizes) - max(length, offset)
+			self.count += 1
+			self.latest = (index, pixels[0], tuple(self.sizes[0]))
+		if self.onWrite and grown > 0:
+			self.onWrite(grown)
+		self.time += time.time() - start
+
+	def meanTime(self):
+		return self.time / self.count if self.count else 0.0
+
+	def close(self):
+		with self.lock:
+			if self.file is not None:
+				self.file.close()
+				self.file = None
+
+def makeHeader(sizes):
+	header = struct.pack('<8sH', magic, len(sizes))
+	for w, h in sizes:
+		header += struct.pack('<HH', w, h)
+	return header.ljust(headerSize, b'\0')
+
+# The level sizes from a thumbnail file's header, or None.
+def readHeader(f):
+	f.seek(0)
+	header = f.read(headerSize)
+	if len(header) < headerSize or header[:8] != magic:
+		return None
+	n = struct.unpack('<H', header[8:10])[0]
+	return [struct.unpack('<HH', header[10 + 4 * i:14 + 4 * i])
+	  for i in range(n)]
+
+# What opening or reading a damaged or half-written thumbnail file raises:
+# a power cut, or a writer that hasn't flushed its header yet, can leave
+# one without a valid header or with a torn last record.
+fileErrors = (EnvironmentError, mmap.error, struct.error, ValueError)
+
+def recordSize(sizes):
+	return sum(w * h * 3 for w, h in sizes)
+
+# ThumbnailFile reads a session's thumbnails.  The file may still be
+# growing; refresh() maps whatever has been written since.
+
+class ThumbnailFile:
+
+	def __init__(self, sessionDir):
+		self.dir    = sessionDir
+		self.path   = os.path.join(sessionDir, thumbsName)
+		self.file   = open(self.path, 'rb')
+		self.sizes  = readHeader(self.file)
+		if self.sizes is None:
+			self.file.close()
+			raise IOError("%s is not a thumbnail file" % self.path)
+		self.record = recordSize(self.sizes)
+		self.map    = None
+		self.frames = 0
+		try:
+			self.refresh()
+		except fileErrors:
+			self.close()
+			raise
+
+	# Remap the file if it has grown.  Returns True if there are new frames.
+	def refresh(self):
+		length = os.fstat(self.file.fileno()).st_size
+		frames = max(0, (length - headerSize) // self.record)
+		if frames == self.frames:
+			return False
+		if self.map is not None:
+			self.map.close()
+		self.map    = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		self.frames = frames
+		return True
+
+	# Frame 'index' (from 1) at pyramid 'level' as a Surface, or None.
+	def image(self, index, level=0):
+		if not 1 <= index <= self.frames:
+			return None
+		w, h   = self.sizes[level]
+		offset = (headerSize + (index - 1) * self.record +
+		  sum(lw * lh * 3 for lw, lh in self.sizes[:level]))
+		return pygame.image.frombuffer(self.map[offset:offset + w * h * 3],
+		  (w, h), 'RGB')
+
+	def close(self):
+		if self.map is not None:
+			self.map.close()
+			self.map = None
+		self.file.close()
+
+# The directory of the most recent session under 'root' that has
+# thumbnails that can be opened, or None.  A multi-camera session keeps
+# them in its cam0 subdirectory, which is what's returned for it.
+def findLatest(root):
+	try:
+		dirs = os.listdir(root)
+	except OSError:
+		return None
+	paths = [os.path.join(root, d, sub, thumbsName) for d in dirs
+	  for sub in ('', 'cam0')]
+	paths = [(os.path.getmtime(p), p) for p in paths if os.path.isfile(p)]
+	for mtime, path in sorted(paths, reverse=True):
+		try:
+			ThumbnailFile(os.path.dirname(path)).close()
+		except fileErrors:
+			continue
+		return os.path.dirname(path)
+	return None
+
+# Player shows one frame of a ThumbnailFile in 'rect' (level 0) and a strip
+# of evenly spaced frames across the whole session in 'strip' (the
+# smallest level), with the current position marked.  Tapping the strip
+# seeks to that point.  While 'playing', update() advances at 'fps'.
+# 'changed' is set whenever what draw() would show has changed.
+
+class Player:
+
+	def __init__(self, thumbs, rect, strip, fps=10.0):
+		self.thumbs    = thumbs
+		self.rect      = pygame.Rect(rect)
+		self.strip     = pygame.Rect(strip)
+		self.fps       = fps
+		self.index     = 1
+		self.playing   = False
+		self.lastStep  = 0.0
+		self.surface   = None
+		self.stripBase = None # Strip thumbnails, rebuilt as the file grows
+		self.changed   = False
+		self.seek(1)
+
+	def seek(self, index):
+		self.index   = max(1, min(index, self.thumbs.frames))
+		self.surface = self.thumbs.image(self.index)
+		self.changed = True
+
+	def step(self, n):
+		self.seek(self.index + n)
+
+	# Seek to the frame under x on the strip.
+	def scrub(self, x):
+		fraction = float(x - self.strip.left) / max(1, self.strip.width - 1)
+		self.seek(1 + int(round(fraction * (self.thumbs.frames - 1))))
+
+	def play(self, on=True):
+		self.playing  = on
+		self.lastStep = time.time()
+
+	# Returns True when there's something new to draw.
+	def update(self):
+		if self.thumbs.refresh():
+			self.stripBase = None
+			self.changed   = True
+			if self.surface is None:
+				self.seek(self.index)
+		if self.playing and time.time() - self.lastStep >= 1.0 / self.fps:
+			self.lastStep = time.time()
+			if self.index < self.thumbs.frames:
+				self.step(1)
+			else:
+				self.playing = False
+		changed, self.changed = self.changed, False
+		return changed
+
+	def _buildStrip(self):
+		level  = len(self.thumbs.sizes) - 1
+		tw, th = self.thumbs.sizes[level]
+		base   = pygame.Surface(self.strip.size)
+		slots  = max(1, self.strip.width // tw)
+		frames = self.thumbs.frames
+		for i in range(min(slots, frames)):
+			index = 1 + (i * (frames - 1) // max(1, slots - 1) if slots > 1 else 0)
+			thumb = self.thumbs.image(index, level)
+			base.blit(thumb, (i * tw, (self.strip.height - th) // 2))
+		self.stripBase = base
+
+	def draw(self, screen, clip):
+		if self.surface is not None and clip.colliderect(self.rect):
+			screen.set_clip(clip.clip(self.rect))
+			screen.blit(self.surface, self.surface.get_rect(center=self.rect.center))
+		if self.thumbs.frames and clip.colliderect(self.strip):
+			if self.stripBase is None:
+				self._buildStrip()
+			screen.set_clip(clip.clip(self.strip))
+			screen.blit(self.stripBase, self.strip)
+			x = self.strip.left + (self.index - 1) * (self.strip.width - 1) // max(
+			  1, self.thumbs.frames - 1)
+			pygame.draw.line(screen, (255, 0, 0), (x, self.strip.top),
+			  (x, self.strip.bottom - 1), 2)
+		screen.set_clip(None)
@@ -0,0 +1,116 @@
+# Live viewfinder for lapse.py
+#
+# The preview never talks to the camera itself.  It takes whatever frame
+# the shared capture session grabbed last (capture.latest()), so it can't
+# reopen the device, hold it, or make a scheduled capture wait.  Each new
+# frame is shrunk to the viewport in one vectorized step: an area average
+# with NumPy when it's installed, otherwise pygame's nearest-neighbour
+# scale (both in C, nothing per pixel in Python).  The average reads the
+# frame's buffer in place through a strided view and sums into buffers
+# kept from one frame to the next, so nothing frame-sized is copied or
+# allocated.
+#
+# update() is called from the UI loop at most maxFps times a second and
+# returns True when there's a new image to blit.
+
+import time
+
+try:
+	import numpy
+	from numpy.lib.stride_tricks import as_strided
+except ImportError:
+	numpy = None
+
+import pygame
+
+# Shrink an RGB frame to fit 'size' (w, h), keeping its aspect ratio.
+# Returns a pygame Surface.  'scratch' is a dict the caller keeps between
+# calls for the averaging buffers; the Surface returned is then over one of
+# them, and only valid until the next call with the same scratch.
+def downscale(frame, size, scratch=None):
+	w, h = frame.size
+	if frame.format == 'JPEG':
+		import io
+		source = pygame.image.load(io.BytesIO(frame.data), 'frame.jpg')
+		return pygame.transform.scale(source, fit((w, h), size))
+	tw, th = fit((w, h), size)
+	if numpy is not None and w >= tw * 2 and h >= th * 2:
+		# Average over whole fx-by-fy blocks ("area" resampling): sum each
+		# block's rows, then its columns
+		fx, fy = w // tw, h // th
+		key    = (w, h, tw, th)
+		if scratch is None or scratch.get('key') != key:
+			out  = bytearray(tw * th * 3)
+			bufs = {'key': key, 'out': out,
+			  'rows'  : numpy.zeros((th, tw * fx * 3), numpy.uint32),
+			  'sums'  : numpy.zeros((th, tw, 3), numpy.uint32),
+			  'result': numpy.frombuffer(out, numpy.uint8,
+			    tw * th * 3).reshape(th, tw, 3)}
+			if scratch is not None:
+				scratch.clear()
+				scratch.update(bufs)
+		else:
+			bufs = scratch
+		pixels = numpy.frombuffer(frame.data, numpy.uint8, w * h * 3)
+		rows   = as_strided(pixels, (th, fy, tw * fx * 3), (fy * w * 3, w * 3, 1))
+		rows.sum(axis=1, dtype=numpy.uint32, out=bufs['rows'])
+		bufs['rows'].reshape(th, tw, fx, 3).sum(axis=2, out=bufs['sums'])
+		numpy.floor_divide(bufs['sums'], fx * fy, out=bufs['sums'])
+		bufs['result'][...] = bufs['sums']
+		return pygame.image.frombuffer(bufs['out'], (tw, th), 'RGB')
+	source = pygame.image.frombuffer(frame.data, (w, h), 'RGB')
+	return pygame.transform.scale(source, (tw, th))
+
+# Largest size with the aspect ratio of 'source' that fits in 'box'.
+def fit(source, box):
+	scale = min(float(box[0]) / source[0], float(box[1]) / source[1])
+	return (max(1, int(source[0] * scale)), max(1, int(source[1] * scale)))
+
+# Preview holds the current viewfinder image for a viewport rect.
+# 'shown' counts images produced and 'scaleTime' accumulates the time spent
+# downscaling them, for fps() and meanScaleTime().
+
+class Preview:
+
+	def __init__(self, camera, rect, maxFps=5.0):
+		self.camera    = camera
+		self.rect      = pygame.Rect(rect)
+		self.maxFps    = maxFps
+		self.surface   = None
+		self.lastSeq   = None
+		self.lastTime  = 0.0
+		self.started   = time.time()
+		self.shown     = 0
+		self.scaleTime = 0.0
+		self.scratch   = {} # downscale()'s buffers
+
+	def update(self):
+		now = time.time()
+		if self.maxFps and now - self.lastTime < 1.0 / self.maxFps:
+			return False
+		frame = self.camera.latest() if self.camera else None
+		if frame is None or frame.seq == self.lastSeq:
+			return False
+		image = downscale(frame, self.rect.size, self.scratch)
+		done  = time.time()
+		self.scaleTime += done - now
+		self.shown     += 1
+		self.lastSeq    = frame.seq
+		self.lastTime   = now
+		self.surface    = image
+		return True
+
+	# Blit the current image centered in the viewport, within 'clip'.
+	def draw(self, screen, clip):
+		if self.surface is None: return
+		area = self.surface.get_rect(center=self.rect.center)
+		screen.set_clip(clip.clip(self.rect))
+		screen.blit(self.surface, area)
+		screen.set_clip(None)
+
+	def fps(self):
+		elapsed = time.time() - self.started
+		return self.shown / elapsed if elapsed > 0 else 0.0
+
+	def meanScaleTime(self):
+		return self.scaleTime / self.shown if self.shown else 0.0
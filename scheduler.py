@@ -0,0 +1,157 @@
+# Deadline-based interval scheduler for the capture loop
+#
+# Captures fire at absolute deadlines, start + n * interval, measured on a
+# monotonic clock.  Time spent capturing therefore doesn't accumulate into
+# the period the way "capture; sleep(interval)" does, and wall-clock
+# changes (NTP syncing after boot, for instance) can't stretch or shrink a
+# sequence.
+#
+# When a capture takes longer than the interval the next deadline has
+# already passed.  That overrun is logged and handled by policy:
+#  - 'skip'    : drop the missed slots and resume on the next future one
+#  - 'catchup' : fire the missed slots back to back until on schedule
+
+import time
+
+# A monotonic clock.  Python 2 has no time.monotonic(), so go straight to
+# clock_gettime(CLOCK_MONOTONIC) through ctypes on Linux, and fall back to
+# wall-clock time if even that isn't available.
+
+try:
+	from time import monotonic
+except ImportError:
+	try:
+		import ctypes
+		import ctypes.util
+
+		class _timespec(ctypes.Structure):
+			_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+		_librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+		  use_errno=True)
+		_clock_gettime = _librt.clock_gettime
+		_clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+		_CLOCK_MONOTONIC = 1
+
+		def monotonic():
+			ts = _timespec()
+			if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+				raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+			return ts.tv_sec + ts.tv_nsec * 1e-9
+	except Exception:
+		monotonic = time.time
+
+# Tick describes one scheduled firing: 'slot' is the deadline number n
+# (start + slot * interval), 'deadline' its absolute monotonic time,
+# 'fired' when wait() actually returned and 'jitter' the difference.
+
+class Tick:
+
+	def __init__(self, slot, deadline, fired):
+		self.slot     = slot
+		self.deadline = deadline
+		self.fired    = fired
+		self.jitter   = fired - deadline
+
+# IntervalScheduler hands out Ticks from wait() and keeps running timing
+# statistics: jitter (how late each firing was), overruns, skipped slots
+# and the measured cadence between consecutive firings.
+
+class IntervalScheduler:
+
+	def __init__(self, interval, policy='skip', clock=monotonic):
+		if policy not in ('skip', 'catchup'):
+			raise ValueError("Unknown overrun policy: %s" % policy)
+		self.interval = max(0.0, float(interval))
+		self.policy   = policy
+		self.clock    = clock
+		self.start()
+
+	def start(self, t0=None):
+		self.t0         = self.clock() if t0 is None else t0
+		self.slot       = 0    # Next slot to fire
+		self.fired      = 0    # Ticks handed out
+		self.overruns   = 0    # Times a deadline was already missed
+		self.skipped    = 0    # Slots dropped by the 'skip' policy
+		self.jitterSum  = 0.0
+		self.jitterSq   = 0.0
+		self.jitterMax  = 0.0
+		self.firstFired = None
+		self.lastFired  = None
+
+	def deadline(self, slot):
+		return self.t0 + slot * self.interval
+
+	# Change the interval from the next deadline on: it comes 'interval'
+	# after the last one, and the rest follow at the new spacing.
+	def setInterval(self, interval):
+		interval = max(0.0, float(interval))
+		if self.slot > 0:
+			self.t0 = self.deadline(self.slot - 1) - (self.slot - 1) * interval
+		self.interval = interval
+
+	# Sleep until the next deadline and return its Tick, or None if 'stop'
+	# (a threading.Event) is set before then; waiting on the Event rather
+	# than sleeping means a stop is noticed as soon as it's asked for.
+	def wait(self, stop=None):
+		now      = self.clock()
+		deadline = self.deadline(self.slot)
+		late     = now - deadline
+		# Any deadline already passed is an overrun, except slot 0's being
+		# passed by less than a slot: that deadline is the start itself.
+		if self.interval > 0 and late > 0 and (self.slot > 0 or
+		  late >= self.interval):
+			missed = int(late // self.interval) # Whole slots that went by
+			self.overruns += 1
+			if not missed:
+				print("Overrun: capture %d ran %.3fs late" % (self.fired, late))
+			elif self.policy == 'skip':
+				# This slot and the ones since have all passed; the next is
+				# the first still to come
+				print("Overrun: capture %d ran %.3fs late, skipping %d slot(s)" %
+				  (self.fired, late, missed + 1))
+				self.skipped += missed + 1
+				self.slot    += missed + 1
+				deadline      = self.deadline(self.slot)
+			else:
+				print("Overrun: capture %d ran %.3fs late, catching up" %
+				  (self.fired, late))
+		while True:
+			if stop is not None and stop.is_set():
+				return None
+			remaining = deadline - self.clock()
+			if remaining <= 0:
+				break
+			if stop is not None:
+				stop.wait(remaining)
+			else:
+				time.sleep(remaining)
+		tick = Tick(self.slot, deadline, self.clock())
+		self.slot  += 1
+		self.fired += 1
+		self.jitterSum += tick.jitter
+		self.jitterSq  += tick.jitter * tick.jitter
+		self.jitterMax  = max(self.jitterMax, tick.jitter)
+		if self.firstFired is None:
+			self.firstFired = tick.fired
+		self.lastFired = tick.fired
+		return tick
+
+	def meanJitter(self):
+		return self.jitterSum / self.fired if self.fired else 0.0
+
+	def jitterStdDev(self):
+		if self.fired < 2: return 0.0
+		mean = self.meanJitter()
+		return max(0.0, self.jitterSq / self.fired - mean * mean) ** 0.5
+
+	# Average time between firings as actually measured, or the nominal
+	# interval until there are at least two firings to measure.
+	def cadence(self):
+		if self.fired < 2:
+			return self.interval
+		return (self.lastFired - self.firstFired) / (self.fired - 1)
+
+	# Estimated seconds until 'frames' more captures have fired.
+	def remaining(self, frames):
+		return max(0, frames) * self.cadence()
@@ -0,0 +1,161 @@
+# Settings store for lapse.py
+#
+# Settings live in settings.json as named profiles, one of which is
+# current:
+#   {"version": 1, "current": "default",
+#    "profiles": {"default": {"Interval": 3000, ...}, "sunset": {...}}}
+#
+# Every value is checked against 'schema' on the way in and out, so a
+# bad or missing value falls back to its default instead of reaching the
+# capture code.  The file is replaced atomically: written to a temporary
+# file in the same directory, fsynced, then renamed over the old one, so
+# a power cut leaves either the old or the new settings, never a torn
+# file.  A lapse.pkl from older versions is migrated into the "default"
+# profile the first time the store is loaded, and renamed out of the way.
+
+import json
+import os
+
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+
+from collections import OrderedDict
+
+version    = 1
+videoSizes = ['1920x1080', '1280x720', '854x480']
+
+# name: (type, default, minimum, maximum), or (type, default, choices)
+schema = OrderedDict([
+  ('Interval', (int, 3000, 1, 24 * 3600 * 1000)), # ms between frames
+  ('Images',   (int, 150, 1, 10000000)),          # frames in a sequence
+  ('Fps',      (int, 12, 1, 120)),                # frame rate of timelapse.mp4
+  ('Size',     (str, '1920x1080', videoSizes))])  # and its resolution
+
+# Profiles a new store starts with
+presets = OrderedDict([
+  ('default',   {}),
+  ('sunset',    {'Interval': 5000,  'Images': 720}),
+  ('night sky', {'Interval': 30000, 'Images': 480, 'Fps': 24})])
+
+def defaults():
+	return dict((name, spec[1]) for name, spec in schema.items())
+
+# 'value' converted to setting 'name's type; raises ValueError if it
+# can't be or is out of range.
+def check(name, value):
+	spec = schema[name]
+	try:
+		value = spec[0](value)
+	except (TypeError, ValueError):
+		raise ValueError("%s: %r is not a %s" % (name, value, spec[0].__name__))
+	if len(spec) == 3 and value not in spec[2]:
+		raise ValueError("%s: %r is not one of %s" % (name, value,
+		  ", ".join(spec[2])))
+	if len(spec) == 4 and not spec[2] <= value <= spec[3]:
+		raise ValueError("%s: %r is outside %d-%d" % (name, value, spec[2],
+		  spec[3]))
+	return value
+
+# A complete, valid settings dict from 'values': unknown names are dropped
+# and bad or missing values replaced by their defaults.
+def validate(values):
+	clean = defaults()
+	for name, value in values.items():
+		if name not in schema:
+			continue
+		try:
+			clean[name] = check(name, value)
+		except ValueError as e:
+			print("Ignoring setting %s" % e)
+	return clean
+
+# Write 'data' to 'path' as JSON, atomically.
+def writeAtomic(path, data):
+	directory = os.path.dirname(os.path.abspath(path))
+	temp = path + '.tmp'
+	with open(temp, 'w') as f:
+		json.dump(data, f, indent=1, sort_keys=True)
+		f.flush()
+		os.fsync(f.fileno())
+	os.rename(temp, path)
+	try: # Make the rename itself durable
+		fd = os.open(directory, os.O_RDONLY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+	except OSError:
+		pass
+
+class SettingsStore:
+
+	def __init__(self, path='settings.json', legacyPath='lapse.pkl'):
+		self.path       = path
+		self.legacyPath = legacyPath
+		self.current    = 'default'
+		self.profiles   = OrderedDict()
+
+	# Read the store (migrating or creating it if need be) and return the
+	# current profile's settings.
+	def load(self):
+		data = None
+		if os.path.exists(self.path):
+			try:
+				with open(self.path) as f:
+					data = json.load(f)
+			except (IOError, ValueError) as e:
+				print("Can't read %s, using defaults: %s" % (self.path, e))
+				os.rename(self.path, self.path + '.bad') # Keep it for a look
+		if isinstance(data, dict) and isinstance(data.get('profiles'), dict):
+			for name in sorted(data['profiles']):
+				self.profiles[name] = validate(data['profiles'][name])
+			self.current = data.get('current')
+		if not self.profiles:
+			for name, values in presets.items():
+				self.profiles[name] = validate(values)
+			self.migrate()
+			self.write()
+		if self.current not in self.profiles:
+			self.current = next(iter(self.profiles))
+		return self.values()
+
+	# Fold an old lapse.pkl into the default profile.
+	def migrate(self):
+		if not self.legacyPath or not os.path.exists(self.legacyPath):
+			return
+		try:
+			with open(self.legacyPath, 'rb') as f:
+				old = pickle.load(f)
+			self.profiles['default'] = validate(old)
+			print("Migrated settings from %s" % self.legacyPath)
+		except Exception as e: # Anything can come out of a bad pickle
+			print("Can't migrate %s: %s" % (self.legacyPath, e))
+		os.rename(self.legacyPath, self.legacyPath + '.migrated')
+
+	def write(self):
+		writeAtomic(self.path, {'version': version, 'current': self.current,
+		  'profiles': self.profiles})
+
+	def names(self):
+		return sorted(self.profiles)
+
+	def values(self):
+		return dict(self.profiles[self.current])
+
+	# Make profile 'name' current and return its settings.
+	def select(self, name):
+		self.current = name
+		self.write()
+		return self.values()
+
+	# The profile after the current one, wrapping around.
+	def nextName(self):
+		names = self.names()
+		return names[(names.index(self.current) + 1) % len(names)]
+
+	# Store 'values' as profile 'name' (by default the current one).
+	def save(self, values, name=None):
+		self.profiles[name or self.current] = validate(values)
+		self.write()
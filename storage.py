@@ -0,0 +1,138 @@
+# Storage manager for lapse.py
+#
+# Keeps an eye on the card a sequence is written to:
+#  - free space, from statvfs() cached for 'refresh' seconds and adjusted
+#    by the bytes written since, so checking it every frame costs nothing
+#  - the actual bytes per frame of the running sequence, to forecast
+#    whether the rest of the sequence fits
+#  - an optional ring-buffer mode that keeps only the newest 'keepFrames'
+#    frames and/or 'keepBytes' bytes, deleting the oldest, for continuous
+#    monitoring.  A frame is a tick's files from every camera: they're kept
+#    and deleted together, so the cameras' directories hold the same frames
+
+import heapq
+import os
+import threading
+import time
+
+# Human-readable byte count, e.g. "3.4G"
+def formatBytes(n):
+	for unit in ('', 'K', 'M', 'G'):
+		if abs(n) < 1024 or unit == 'G':
+			return ("%d%s" if unit == '' else "%.1f%s") % (n, unit)
+		n /= 1024.0
+
+class StorageManager:
+
+	def __init__(self, path, refresh=30.0, reserve=32 << 20,
+	  estimate=400 << 10):
+		self.path       = path
+		self.refresh    = refresh  # Seconds between statvfs() calls
+		self.reserve    = reserve  # Bytes to leave free on the card
+		self.estimate   = estimate # Bytes per frame before any are measured
+		self.keepFrames = 0        # Ring-buffer limits; 0 means unlimited
+		self.keepBytes  = 0
+		self.lock       = threading.Lock()
+		self.checked    = 0.0
+		self.freeBytes  = 0
+		self.kept       = {} # Frame index -> [(path, bytes)]
+		self.oldest     = [] # Heap of the indexes in kept
+		self.gone       = 0  # Highest index deleted
+		self.keptBytes  = 0
+		self.deleted    = 0
+		self.reset()
+
+	# Start measuring a new sequence, of 'cameras' files per frame.
+	def reset(self, keepFrames=0, keepBytes=0, cameras=1):
+		with self.lock:
+			self.frames     = 0
+			self.written    = 0
+			self.keepFrames = keepFrames
+			self.keepBytes  = keepBytes
+			self.cameras    = cameras
+			self.kept       = {}
+			self.oldest     = []
+			self.gone       = 0
+			self.keptBytes  = 0
+			self.deleted    = 0
+
+	def ringMode(self):
+		return bool(self.keepFrames or self.keepBytes)
+
+	# Bytes available to us, from a cached statvfs().
+	def free(self):
+		with self.lock:
+			now = time.time()
+			if now - self.checked >= self.refresh:
+				path = self.path
+				while not os.path.exists(path) and os.path.dirname(path) != path:
+					path = os.path.dirname(path) # Not created yet; ask its parent
+				st = os.statvfs(path)
+				self.freeBytes = st.f_bavail * st.f_frsize
+				self.checked   = now
+			return max(0, self.freeBytes - self.reserve)
+
+	# Account for a file of frame 'index' that has been written; in
+	# ring-buffer mode this also deletes the oldest frames beyond the
+	# limits, every camera's file of each.
+	def recordFrame(self, path, nbytes, index):
+		with self.lock:
+			self.frames    += 1
+			self.written   += nbytes
+			self.freeBytes -= nbytes
+			if not (self.keepFrames or self.keepBytes):
+				return
+			if index <= self.gone: # A late camera; its frame's already gone
+				self._remove([(path, nbytes)])
+				return
+			if index not in self.kept:
+				self.kept[index] = []
+				heapq.heappush(self.oldest, index)
+			self.kept[index].append((path, nbytes))
+			self.keptBytes += nbytes
+			while len(self.kept) > 1 and (
+			  (self.keepFrames and len(self.kept) > self.keepFrames) or
+			  (self.keepBytes and self.keptBytes > self.keepBytes)):
+				self.gone = heapq.heappop(self.oldest)
+				files     = self.kept.pop(self.gone)
+				self.keptBytes -= sum(n for p, n in files)
+				self._remove(files)
+
+	def _remove(self, files):
+		for path, nbytes in files:
+			try:
+				os.remove(path)
+				self.freeBytes += nbytes
+				self.deleted   += 1
+			except OSError as e:
+				print("Can't remove %s: %s" % (path, e))
+
+	# Account for other bytes written along with the frames (thumbnails,
+	# say), so they're part of the bytes per frame forecasts go by.
+	def recordBytes(self, nbytes):
+		with self.lock:
+			self.written   += nbytes
+			self.freeBytes -= nbytes
+
+	def bytesPerFrame(self):
+		if self.frames:
+			return self.written / float(self.frames)
+		return self.estimate
+
+	# (bytes needed for 'frames' more frames, bytes free, whether they fit).
+	# In ring-buffer mode only the ring has to fit.
+	def forecast(self, frames):
+		needed = self.bytesPerFrame() * max(0, frames)
+		if self.ringMode():
+			ring = []
+			if self.keepFrames:
+				ring.append(self.bytesPerFrame() * self.cameras * self.keepFrames)
+			if self.keepBytes:
+				ring.append(self.keepBytes)
+			needed = max(0, min(ring) - self.keptBytes)
+		free = self.free()
+		return needed, free, needed <= free
+
+	# True when there isn't room for another frame.
+	def full(self):
+		return self.free() < self.bytesPerFrame()
@@ -0,0 +1,46 @@
+# Tests for analysis.py: run with "python -m unittest discover -s tests"
+# from the top directory.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analysis
+import capture
+import pipeline
+
+# A JPEG of a flat grey frame, as fswebcam would hand it over.
+def greyJpeg(size=(64, 48), level=128):
+	import pygame
+	work = tempfile.mkdtemp()
+	try:
+		path = os.path.join(work, 'grey.jpg')
+		surface = pygame.Surface(size)
+		surface.fill((level, level, level))
+		pygame.image.save(surface, path)
+		with open(path, 'rb') as f:
+			return f.read()
+	finally:
+		shutil.rmtree(work)
+
+@unittest.skipIf(analysis.numpy is None, "numpy not installed")
+class AnalyzerJpegTest(unittest.TestCase):
+
+	def test_consume_jpeg_slot(self):
+		size = (64, 48)
+		slot = pipeline.Slot(size[0] * size[1] * 3)
+		slot.load(capture.Frame(greyJpeg(size), size, 'JPEG'), None, {'index': 1})
+		seen = []
+		analyzer = analysis.Analyzer(onStats=lambda i, s: seen.append((i, s)))
+		analyzer.consume(slot)
+		self.assertEqual(len(seen), 1)
+		self.assertEqual(seen[0][0], 1)
+		self.assertAlmostEqual(seen[0][1]['mean'], 128, delta=3)
+		self.assertEqual(list(analyzer.gains()), [1])
+
+if __name__ == '__main__':
+	unittest.main()